@@ -65,7 +65,7 @@ class Controller:
     def shutdown(self):
         if app.local_metadata_manager is not None:
             logging.info("Sending pending metadata updates")
-            app.local_metadata_manager.run_updates()
+            app.local_metadata_manager.shutdown()
         logging.info("Shutting down donation manager")
         if app.donate_manager is not None:
             app.donate_manager.shutdown()
@@ -43,6 +43,12 @@ def setup_fulltext_search(connection, table='item', path_column='filename'):
     column_list = ', '.join(c for c in columns)
     column_list_for_new = ', '.join("new.%s" % c for c in columns)
     column_list_with_types = ', '.join('%s text' % c for c in columns)
+    # Only touch item_fts when one of the indexed columns actually changes.
+    # Most updates to the item table are for things like download stats,
+    # watched_time and resume_time.  Re-indexing the row for those is
+    # wasted work.
+    column_changed = ' OR '.join('old.%s IS NOT new.%s' % (c, c)
+                                 for c in columns)
     connection.execute("CREATE VIRTUAL TABLE item_fts USING fts4(%s)" %
                        column_list_with_types)
     connection.execute("INSERT INTO item_fts(docid, %s)"
@@ -50,9 +56,10 @@ def setup_fulltext_search(connection, table='item', path_column='filename'):
                        (column_list, table, column_list, table))
     # make triggers to keep item_fts up to date
     connection.execute("CREATE TRIGGER item_bu "
-                       "BEFORE UPDATE ON %s BEGIN "
+                       "BEFORE UPDATE OF %s ON %s "
+                       "WHEN %s BEGIN "
                        "DELETE FROM item_fts WHERE docid=old.id; "
-                       "END;" % (table,))
+                       "END;" % (column_list, table, column_changed))
 
     connection.execute("CREATE TRIGGER item_bd "
                        "BEFORE DELETE ON %s BEGIN "
@@ -60,10 +67,12 @@ def setup_fulltext_search(connection, table='item', path_column='filename'):
                        "END;" % (table,))
 
     connection.execute("CREATE TRIGGER item_au "
-                       "AFTER UPDATE ON %s BEGIN "
+                       "AFTER UPDATE OF %s ON %s "
+                       "WHEN %s BEGIN "
                        "INSERT INTO item_fts(docid, %s) "
                        "VALUES(new.id, %s); "
-                       "END;" % (table, column_list, column_list_for_new))
+                       "END;" % (column_list, table, column_changed,
+                                 column_list, column_list_for_new))
 
     connection.execute("CREATE TRIGGER item_ai "
                        "AFTER INSERT ON %s BEGIN "
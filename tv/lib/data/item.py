@@ -263,6 +263,10 @@ class ItemInfoBase(object):
     """
 
     __metaclass__ = ItemInfoMeta
+    # ItemInfos can be shared between all the item lists, so keep them
+    # compact.  All the data is stored in the row_data tuple, plus a cached
+    # copy of the stripped description.
+    __slots__ = ('row_data', '_description_stripped')
 
     #: ItemSelectInfo object that describes what to select to create an
     #: ItemInfoMeta
@@ -600,6 +604,7 @@ def fetch_device_item_infos(device, item_ids):
     return [DeviceItemInfo(device.id, row) for row in result_set]
 
 class ItemInfo(ItemInfoBase):
+    __slots__ = ()
     source_type = 'database'
     select_info = ItemSelectInfo()
 
@@ -706,6 +711,7 @@ class DeviceItemSelectInfo(ItemSelectInfo):
 class DeviceItemInfo(ItemInfoBase):
     """ItemInfo for devices """
 
+    __slots__ = ('device_info', 'device_id', 'mount')
     select_info = DeviceItemSelectInfo()
     source_type = 'device'
 
@@ -839,6 +845,7 @@ class SharingItemSelectInfo(ItemSelectInfo):
 class SharingItemInfo(ItemInfoBase):
     """ItemInfo for devices """
 
+    __slots__ = ('share_info',)
     select_info = SharingItemSelectInfo()
     source_type = 'sharing'
 
@@ -882,6 +889,8 @@ class ItemSource(object):
     """
 
     select_info = ItemSelectInfo()
+    #: cache_key() for the main database
+    MAIN_CACHE_KEY = ('main',)
 
     def __init__(self):
         self.connection_pool = app.connection_pools.get_main_pool()
@@ -910,6 +919,14 @@ class ItemSource(object):
         """Create an ItemInfo from a result row."""
         return ItemInfo(row_data)
 
+    def cache_key(self):
+        """Get a key that identifies this source in an ItemInfoCache.
+
+        ItemSources that return the same key must create identical
+        ItemInfos for a given row.
+        """
+        return self.MAIN_CACHE_KEY
+
 class DeviceItemSource(ItemSource):
 
     select_info = DeviceItemSelectInfo()
@@ -922,6 +939,9 @@ class DeviceItemSource(ItemSource):
     def make_item_info(self, row_data):
         return DeviceItemInfo(self.device_info, row_data)
 
+    def cache_key(self):
+        return ('device', self.device_info.id, self.device_info.mount)
+
 class SharingItemSource(ItemSource):
     select_info = SharingItemSelectInfo()
 
@@ -932,3 +952,6 @@ class SharingItemSource(ItemSource):
 
     def make_item_info(self, row_data):
         return SharingItemInfo(self.share_info, row_data)
+
+    def cache_key(self):
+        return ('sharing', self.share_info.id)
@@ -33,6 +33,7 @@ import collections
 import logging
 import string
 import random
+import time
 import weakref
 
 from miro import app
@@ -66,6 +67,52 @@ ItemTrackerOrderBy = util.namedtuple(
     :attribute descending: should we add the DESC clause?
     """)
 
+ItemTrackerListChanges = util.namedtuple(
+    "ItemTrackerListChanges",
+    "removed inserted",
+
+    """ItemTrackerListChanges describes how an ItemTracker's list changed.
+
+    This gets passed with the list-changed signal when ItemTracker was able
+    to update its list without refetching it.
+
+    :attribute removed: sorted list of indexes in the old list that were
+    removed.
+    :attribute inserted: sorted list of indexes in the new list that were
+    inserted.
+    """)
+
+def _sqlite_type_rank(value):
+    """Get the rank of a value's type in SQLite's sort order."""
+    if value is None:
+        return 0
+    elif isinstance(value, (int, long, float)):
+        return 1
+    elif isinstance(value, basestring):
+        return 2
+    else:
+        return 3
+
+def _compare_sqlite_values(connection, value1, value2, collation):
+    """Compare 2 values the same way an SQLite ORDER BY clause would."""
+    rank1 = _sqlite_type_rank(value1)
+    rank2 = _sqlite_type_rank(value2)
+    if rank1 != rank2:
+        return cmp(rank1, rank2)
+    if rank1 == 2 and collation is not None:
+        # let SQLite handle the collation
+        sql = "SELECT ? < ? COLLATE %s, ? = ? COLLATE %s" % (collation,
+                                                             collation)
+        less, equal = connection.execute(sql, (value1, value2,
+                                               value1, value2)).fetchone()
+        if equal:
+            return 0
+        elif less:
+            return -1
+        else:
+            return 1
+    return cmp(value1, value2)
+
 class ItemTrackerQuery(object):
     """Query used to select item ids for ItemTracker.  """
 
@@ -198,6 +245,17 @@ class ItemTrackerQuery(object):
                        if ob.table == self.table_name())
         return columns
 
+    def could_update_incrementally(self, message):
+        """Can ItemTracker handle an ItemChanges message by checking the
+        added/changed items against this query?
+
+        If this returns False, ItemTracker will refetch the entire id list.
+        """
+        if message.dlstats_changed and self.tracking_download_columns():
+            # download stats can change without the item being changed
+            return False
+        return True
+
     def tracking_download_columns(self):
         for c in self.conditions:
             if c.table == 'remote_downloader':
@@ -225,6 +283,59 @@ class ItemTrackerQuery(object):
         logging.debug("ItemTracker: done running query")
         return item_ids
 
+    def select_sort_keys(self, connection, id_list):
+        """Get sort keys for items that match this query.
+
+        :param id_list: ids of the items to check
+        :returns: dict mapping item ids to their sort key.  Items that don't
+        match the query won't be included.  Use compare_sort_keys() to
+        compare the keys.
+        """
+        sql_parts = []
+        arg_list = []
+        # Use "+column" to get the raw values that SQLite sorts on, rather
+        # than having PARSE_DECLTYPES convert them.
+        sql_parts.append("SELECT %s.id, %s FROM %s" %
+                         (self.table_name(),
+                          ', '.join('+%s.%s' % (ob.table, ob.column)
+                                    for ob in self._order_by_with_id()),
+                          self.table_name()))
+        self._add_joins(sql_parts, arg_list)
+        id_condition = "%s.id IN (%s)" % (self.table_name(),
+                                          ', '.join(str(int(id_))
+                                                    for id_ in id_list))
+        self._add_conditions(sql_parts, arg_list, [id_condition])
+        sql = ' '.join(sql_parts)
+        return dict((row[0], row[1:])
+                    for row in connection.execute(sql, arg_list))
+
+    def compare_sort_keys(self, connection, key1, key2):
+        """Compare sort keys from select_sort_keys().
+
+        :returns: -1, 0, or 1 like cmp()
+        """
+        for ob, value1, value2 in zip(self._order_by_with_id(), key1, key2):
+            result = _compare_sqlite_values(connection, value1, value2,
+                                            ob.collation)
+            if ob.descending:
+                result = -result
+            if result != 0:
+                return result
+        return 0
+
+    def _order_by_with_id(self):
+        """Get our ORDER BY terms, ending with the id column.
+
+        Sorting by id last means the order is always well defined, which we
+        need to insert items into an existing list.
+        """
+        if self.order_by and (self.order_by[-1].table, self.order_by[-1].column
+                             ) == (self.table_name(), 'id'):
+            return self.order_by
+        return self.order_by + [
+            ItemTrackerOrderBy(self.table_name(), 'id', None, False),
+        ]
+
     def _calc_tables(self):
         """Calculate which tables we need to execute the query."""
         all_tables = ([c.table for c in self.conditions] +
@@ -238,10 +349,10 @@ class ItemTrackerQuery(object):
         if self.match_string:
             sql_parts.append(self.join_sql('item_fts'))
 
-    def _add_conditions(self, sql_parts, arg_list):
-        if not (self.conditions or self.match_string):
+    def _add_conditions(self, sql_parts, arg_list, extra_where_parts=()):
+        if not (self.conditions or self.match_string or extra_where_parts):
             return
-        where_parts = []
+        where_parts = list(extra_where_parts)
         for c in self.conditions:
             where_parts.append(c.sql)
             arg_list.extend(c.values)
@@ -252,7 +363,7 @@ class ItemTrackerQuery(object):
 
     def _add_order_by(self, sql_parts, arg_list):
         order_by_parts = [self._make_order_by_expression(ob)
-                          for ob in self.order_by]
+                          for ob in self._order_by_with_id()]
         sql_parts.append("ORDER BY %s" % ', '.join(order_by_parts))
 
     def _make_order_by_expression(self, ob):
@@ -295,6 +406,79 @@ class SharingItemTrackerQuery(ItemTrackerQuery):
         else:
             return ItemTrackerQuery.could_list_change(self, message)
 
+    def could_update_incrementally(self, message):
+        if message.changed_playlists and self.tracking_playlist_map():
+            return False
+        else:
+            return ItemTrackerQuery.could_update_incrementally(self, message)
+
+class ItemInfoCache(util.Cache):
+    """LRU cache of ItemInfo objects that can be shared by ItemTrackers.
+
+    When the same item is displayed in several lists (for example the videos
+    tab, a feed tab and a playlist), sharing the cache means we only fetch
+    the row and build the ItemInfo once.
+
+    Entries are keyed by (item_source.cache_key(), item_id).  The cache
+    doesn't know when items change, the code that handles ItemChanges
+    messages must call invalidate() for the changed ids.
+    """
+
+    DEFAULT_SIZE = 10000
+
+    def __init__(self, size=None):
+        if size is None:
+            size = self.DEFAULT_SIZE
+        util.Cache.__init__(self, size)
+        self.hits = self.misses = 0
+
+    def lookup(self, source_key, id_list):
+        """Lookup ItemInfos in the cache.
+
+        :returns: (infos, missing_ids) tuple.  infos is a list of the
+            ItemInfos that were found, missing_ids is a list of ids that
+            weren't.
+        """
+        infos = []
+        missing_ids = []
+        for id_ in id_list:
+            key = (source_key, id_)
+            try:
+                info = self.dict[key]
+            except KeyError:
+                missing_ids.append(id_)
+            else:
+                self.access_times[key] = self.counter.next()
+                infos.append(info)
+        self.hits += len(infos)
+        self.misses += len(missing_ids)
+        return infos, missing_ids
+
+    def add(self, source_key, infos):
+        """Add ItemInfos to the cache.
+
+        If we already have an ItemInfo for an id, we keep the one we have.
+        This way a tracker reading from an older transaction can't replace
+        newer data.
+        """
+        for info in infos:
+            key = (source_key, info.id)
+            if key not in self.dict:
+                self.set(key, info)
+
+    def invalidate(self, source_key, id_list):
+        """Remove ItemInfos for items that have changed."""
+        for id_ in id_list:
+            self.remove((source_key, id_))
+
+    def invalidate_source(self, source_key):
+        """Remove all ItemInfos from an item source."""
+        for key in [k for k in self.dict if k[0] == source_key]:
+            self.remove(key)
+
+    def create_new_value(self, key, invalidator=None):
+        raise KeyError(key)
+
 class ItemTracker(signals.SignalEmitter):
     """Track items in the database
 
@@ -313,13 +497,28 @@ class ItemTracker(signals.SignalEmitter):
 
     - "items-changed" (changed_id_list): some items have been changed, but the
     list is the same.
-    - "list-changed": items have been added, removed, or reorded in the list.
+    - "list-changed" (changes): items have been added, removed, or reorded in
+    the list.  If we updated the list in place, changes is an
+    ItemTrackerListChanges object that says which rows were removed and
+    inserted.  If we had to refetch the entire list, changes is None.
     """
 
-    # how many rows we fetch at one time in _ensure_row_loaded()
+    # how many rows we fetch at one time in _ensure_row_loaded().  This is
+    # also the starting chunk size for idle fetches.
     FETCH_ROW_CHUNK_SIZE = 25
-
-    def __init__(self, idle_scheduler, query, item_source):
+    # max number of rows to fetch in a single idle callback
+    MAX_FETCH_ROW_CHUNK_SIZE = 1000
+    # how long we want each idle fetch to take.  We grow/shrink the chunk
+    # size to stay around this.
+    IDLE_FETCH_TARGET_TIME = 0.02
+    # how many rows past the visible range to prefetch
+    VISIBLE_RANGE_LOOKAHEAD = 100
+    # If an ItemChanges message has more added/changed items than this, we
+    # refetch the entire id list rather than updating it in place.
+    INCREMENTAL_UPDATE_LIMIT = 200
+
+    def __init__(self, idle_scheduler, query, item_source,
+                 item_info_cache=None, background_fetch_limit=None):
         """Create an ItemTracker
 
         :param idle_scheduler: function to schedule idle callback functions.
@@ -327,6 +526,12 @@ class ItemTracker(signals.SignalEmitter):
         idletime.
         :param query: ItemTrackerQuery to use
         :param item_source: ItemSource to use.
+        :param item_info_cache: ItemInfoCache shared with other trackers.  If
+        this is given, the owner of the cache must invalidate it when items
+        change.
+        :param background_fetch_limit: If set, we won't load all the rows in
+        idle callbacks for lists with more than this many items.  Instead we
+        only load the rows around the range passed to set_visible_range().
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("will-change")
@@ -336,6 +541,10 @@ class ItemTracker(signals.SignalEmitter):
         self.idle_work_scheduled = False
         self.item_fetcher = None
         self.item_source = item_source
+        self.item_info_cache = item_info_cache
+        self.background_fetch_limit = background_fetch_limit
+        self.visible_range = None
+        self.fetch_chunk_size = self.FETCH_ROW_CHUNK_SIZE
         self._set_query(query)
         self._fetch_id_list()
         self._schedule_idle_work()
@@ -378,6 +587,8 @@ class ItemTracker(signals.SignalEmitter):
         self.id_list = self.query.select_ids(connection)
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
         self.row_data = {}
+        # rows before this index have all been loaded
+        self._background_fetch_pos = 0
         self.item_fetcher = self.make_item_fetcher(connection, self.id_list)
 
     def _schedule_idle_work(self):
@@ -394,27 +605,95 @@ class ItemTracker(signals.SignalEmitter):
             # destroy() was called while the idle callback was still
             # scheduled.  Just return.
             return
-        for i in xrange(len(self.id_list)):
+        rows_to_load = self._rows_to_prefetch()
+        if rows_to_load:
+            start = time.time()
+            self._load_rows(rows_to_load)
+            self._adjust_fetch_chunk_size(time.time() - start)
+            self._schedule_idle_work()
+        elif self._all_rows_loaded():
+            self.item_fetcher.done_fetching()
+        # Otherwise we've stopped background fetching for a large list.
+        # set_visible_range() will schedule more work if needed.
+
+    def set_visible_range(self, first_row, last_row):
+        """Tell the ItemTracker which rows the user is looking at.
+
+        Idle callbacks will load these rows, plus some rows after them,
+        before loading anything else.
+
+        :param first_row: index of the first visible row
+        :param last_row: index of the last visible row
+        """
+        self.visible_range = (first_row, last_row)
+        if self.item_fetcher is None:
+            return
+        if self._visible_rows_to_prefetch():
+            self._schedule_idle_work()
+
+    def _should_background_fetch(self):
+        return (self.background_fetch_limit is None or
+                len(self.id_list) <= self.background_fetch_limit)
+
+    def _rows_to_prefetch(self):
+        """Pick the rows to load in the next idle callback."""
+        rows_to_load = self._visible_rows_to_prefetch()
+        if rows_to_load or not self._should_background_fetch():
+            return rows_to_load
+        # nothing visible needs loading, continue loading the entire list
+        for i in xrange(self._background_fetch_pos, len(self.id_list)):
             if not self._row_loaded(i):
-                # row data unloaded, call _ensure_row_loaded to load this row
-                # and adjecent rows then schedule another run later
-                self._ensure_row_loaded(i)
-                self._schedule_idle_work()
-                return
-        # no rows need loading
-        self.item_fetcher.done_fetching()
+                rows_to_load.append(i)
+                if len(rows_to_load) >= self.fetch_chunk_size:
+                    break
+            elif not rows_to_load:
+                self._background_fetch_pos = i + 1
+        return rows_to_load
+
+    def _visible_rows_to_prefetch(self):
+        if self.visible_range is None:
+            return []
+        first_row, last_row = self.visible_range
+        start = max(first_row, 0)
+        end = min(last_row + self.VISIBLE_RANGE_LOOKAHEAD + 1,
+                  len(self.id_list))
+        rows_to_load = []
+        for i in xrange(start, end):
+            if not self._row_loaded(i):
+                rows_to_load.append(i)
+                if len(rows_to_load) >= self.fetch_chunk_size:
+                    break
+        return rows_to_load
+
+    def _adjust_fetch_chunk_size(self, fetch_time):
+        """Grow or shrink fetch_chunk_size based on how long a fetch took."""
+        if fetch_time < self.IDLE_FETCH_TARGET_TIME / 2:
+            self.fetch_chunk_size = min(self.fetch_chunk_size * 2,
+                                        self.MAX_FETCH_ROW_CHUNK_SIZE)
+        elif fetch_time > self.IDLE_FETCH_TARGET_TIME:
+            self.fetch_chunk_size = max(self.fetch_chunk_size // 2,
+                                        self.FETCH_ROW_CHUNK_SIZE)
+
+    def _all_rows_loaded(self):
+        return len(self.row_data) >= len(self.id_list)
+
+    def _finished_fetching(self):
+        """Have our idle callbacks loaded all the rows in the list?"""
+        return (not self.idle_work_scheduled and
+                self._should_background_fetch())
 
     def _uncache_row_data(self, id_list):
         for id_ in id_list:
             if id_ in self.row_data:
                 del self.row_data[id_]
+                self._background_fetch_pos = 0
 
     def _refetch_id_list(self):
         """Refetch a new id list after we already have one."""
 
         self.emit('will-change')
         self._fetch_id_list()
-        self.emit("list-changed")
+        self.emit("list-changed", None)
 
     def get_items(self):
         """Get a list of all items in sorted order."""
@@ -423,14 +702,14 @@ class ItemTracker(signals.SignalEmitter):
     def get_playable_ids(self):
         """Get a list of ids for items that can be played."""
         # If we have loaded all items, then we can just use that data
-        if not self.idle_work_scheduled:
+        if self._finished_fetching():
             return [i.id for i in self.get_items() if i.is_playable]
         else:
             return self.item_fetcher.select_playable_ids()
 
     def has_playables(self):
         """Can we play any items from this item list?"""
-        if not self.idle_work_scheduled:
+        if self._finished_fetching():
             return any(i for i in self.get_items() if i.is_playable)
         else:
             return self.item_fetcher.select_has_playables()
@@ -469,9 +748,17 @@ class ItemTracker(signals.SignalEmitter):
         :param rows_to_load: indexes of the rows to load.
         """
         ids_to_load = [self.id_list[i] for i in rows_to_load]
-        items = self.item_fetcher.fetch_items(ids_to_load)
+        if self.item_info_cache is not None:
+            source_key = self.item_source.cache_key()
+            items, ids_to_load = self.item_info_cache.lookup(source_key,
+                                                             ids_to_load)
+            if ids_to_load:
+                fetched = self.item_fetcher.fetch_items(ids_to_load)
+                self.item_info_cache.add(source_key, fetched)
+                items.extend(fetched)
+        else:
+            items = self.item_fetcher.fetch_items(ids_to_load)
         for item in items:
-            pos = self.id_to_index[item.id]
             self.row_data[item.id] = item
 
     def item_in_list(self, item_id):
@@ -533,7 +820,8 @@ class ItemTracker(signals.SignalEmitter):
                        if self.item_in_list(item_id)]
         self._uncache_row_data(changed_ids)
         if self._could_list_change(message):
-            self._refetch_id_list()
+            if not self._update_id_list(message):
+                self._refetch_id_list()
         else:
             self.item_fetcher.refresh_items(changed_ids)
             self.emit('will-change')
@@ -543,6 +831,82 @@ class ItemTracker(signals.SignalEmitter):
         """Calculate if an ItemsChanged means the list may have changed."""
         return self.query.could_list_change(message)
 
+    def _update_id_list(self, message):
+        """Update our id list in place for an ItemChanges message.
+
+        Rather than re-running the query for the entire list, we check the
+        added and changed items against our query with a single select, then
+        insert the matching ones into our list using a binary search on
+        their sort keys.
+
+        :returns: True if we updated the list, False if the caller needs to
+        refetch the entire list
+        """
+        check_ids = set(message.added)
+        check_ids.update(message.changed)
+        if (len(check_ids) > self.INCREMENTAL_UPDATE_LIMIT or
+                not self.query.could_update_incrementally(message) or
+                self.item_fetcher is None or
+                self.item_fetcher.connection is None):
+            return False
+        remove_ids = set(id_ for id_ in message.removed
+                         if id_ in self.id_to_index)
+        # changed items may have moved, so we remove them then add them back
+        # in their new position.
+        remove_ids.update(id_ for id_ in check_ids if id_ in self.id_to_index)
+        # make sure ItemFetcher has the current data before we select
+        self.item_fetcher.refresh_items(list(check_ids))
+        connection = self.item_fetcher.connection
+        new_keys = self.query.select_sort_keys(connection, check_ids)
+        if not remove_ids and not new_keys:
+            return True
+
+        removed = sorted(self.id_to_index[id_] for id_ in remove_ids)
+        new_id_list = [id_ for id_ in self.id_list if id_ not in remove_ids]
+        key_cache = new_keys.copy()
+        def sort_key(id_):
+            if id_ not in key_cache:
+                key_cache.update(self.query.select_sort_keys(connection,
+                                                             [id_]))
+            return key_cache[id_]
+        try:
+            for id_ in new_keys:
+                key = new_keys[id_]
+                low, high = 0, len(new_id_list)
+                while low < high:
+                    mid = (low + high) // 2
+                    if self.query.compare_sort_keys(
+                            connection, key, sort_key(new_id_list[mid])) < 0:
+                        high = mid
+                    else:
+                        low = mid + 1
+                new_id_list.insert(low, id_)
+        except KeyError:
+            # One of the rows in our list was deleted or no longer matches
+            # our query in the snapshot that refresh_items() moved us to.
+            # We can't place the new rows, so refetch the whole list.
+            return False
+        self.emit('will-change')
+        self._uncache_row_data(remove_ids)
+        self.id_list = new_id_list
+        self.item_fetcher.id_list = new_id_list
+        self.id_to_index = dict((id_, i) for i, id_ in enumerate(new_id_list))
+        self._background_fetch_pos = 0
+        inserted = sorted(self.id_to_index[id_] for id_ in new_keys)
+        self._id_list_updated()
+        if new_keys:
+            self._schedule_idle_work()
+        self.emit("list-changed", ItemTrackerListChanges(removed, inserted))
+        return True
+
+    def _id_list_updated(self):
+        """Called after _update_id_list() changes our id list.
+
+        Subclasses can override this to update data that depends on
+        the position of items in the list.
+        """
+        pass
+
 class ItemFetcher(object):
     """Create ItemInfo objects for ItemTracker
 
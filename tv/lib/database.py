@@ -29,12 +29,15 @@
 
 import itertools
 import logging
+import operator
+import re
 import traceback
 import threading
 
 from miro import app
 from miro import signals
 from miro import threadcheck
+from miro import util
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -114,9 +117,10 @@ class ViewObjectFetcher(object):
         pass
 
 class DDBObjectFetcher(ViewObjectFetcher):
-    def __init__(self, klass, db_info):
+    def __init__(self, klass, db_info, columns=None):
         self.klass = klass
         self.db_info = db_info
+        self.columns = columns
 
     def fetch_obj(self, id_):
         return self.db_info.db.get_obj_by_id(id_, self.klass)
@@ -129,7 +133,7 @@ class DDBObjectFetcher(ViewObjectFetcher):
 
     def prepare_objects(self, id_list):
         if self.db_info.db.ensure_objects_loaded(self.klass, id_list,
-                                                 self.db_info):
+                                                 self.db_info, self.columns):
             # sometimes objects will call remove() in setup_restored().
             # We need to filter those out.
             new_id_list = [i for i in id_list
@@ -203,6 +207,166 @@ class View(object):
         return ViewTracker(self.fetcher, self.where, self.values, self.joins,
                           self.db_info)
 
+# regexes used to parse WHERE clauses in compile_where_predicate()
+_column_re = r'(?:(\w+)\.)?(\w+)'
+_and_re = re.compile(r'\s+AND\s+', re.IGNORECASE)
+_comparison_re = re.compile(r"^%s\s*(==|=|!=|<>|<=|>=|<|>)\s*"
+                            r"(\?|'[^']*'|-?\d+)$" % _column_re)
+_null_check_re = re.compile(r'^%s\s+IS\s+(NOT\s+)?NULL$' % _column_re,
+                            re.IGNORECASE)
+_truth_check_re = re.compile(r'^(NOT\s+)?%s$' % _column_re, re.IGNORECASE)
+
+_comparison_operators = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+def _make_comparison_check(op, other):
+    def check(value):
+        # comparisons with NULL are never true in SQL
+        return value is not None and op(value, other)
+    return check
+
+def _make_null_check(negate):
+    if negate:
+        return lambda value: value is not None
+    else:
+        return lambda value: value is None
+
+def _make_truth_check(negate):
+    if negate:
+        return lambda value: value is not None and not value
+    else:
+        return lambda value: value is not None and bool(value)
+
+def compile_where_predicate(where, values, table_name, fields):
+    """Try to convert a view's WHERE clause to a python function.
+
+    We only handle simple WHERE clauses: a series of terms joined by AND.
+    Each term must be a comparison between a column and a placeholder or a
+    literal, an IS NULL/IS NOT NULL check, or a column used as a boolean.
+    Only integer, boolean, float, and string columns are supported and
+    ordering comparisons are only supported for numeric columns.
+
+    :param where: WHERE clause for the view
+    :param values: values for the placeholders in where
+    :param table_name: table that the view selects from
+    :param fields: schema fields for table_name
+    :returns: function that inputs a DDBObject and returns True if it matches
+        where, or None if the clause is too complex for us to handle.
+    """
+    # import here to avoid a circular import
+    from miro import schema
+
+    if where is None:
+        if values:
+            return None
+        return lambda obj: True
+    column_kinds = {}
+    for name, schema_item in fields:
+        if isinstance(schema_item, (schema.SchemaBool, schema.SchemaInt,
+                                    schema.SchemaFloat)):
+            column_kinds[name] = 'numeric'
+        elif isinstance(schema_item, (schema.SchemaString,
+                                      schema.SchemaURL)):
+            column_kinds[name] = 'text'
+    value_types = {
+        'numeric': (int, long, float, bool),
+        'text': basestring,
+    }
+
+    def lookup_column(table, column):
+        if table is not None and table != table_name:
+            return None
+        return column_kinds.get(column)
+
+    checks = []
+    values = list(values)
+    for term in _and_re.split(where.strip()):
+        if term.count("'") % 2 != 0:
+            # quote char inside a literal, don't try to parse it
+            return None
+        m = _comparison_re.match(term)
+        if m is not None:
+            table, column, op, value = m.groups()
+            kind = lookup_column(table, column)
+            if kind is None:
+                return None
+            if op in ('<', '>', '<=', '>=') and kind != 'numeric':
+                return None
+            if value == '?':
+                if not values:
+                    return None
+                value = values.pop(0)
+            elif value.startswith("'"):
+                value = value[1:-1].decode('utf-8')
+            else:
+                value = int(value)
+            if not isinstance(value, value_types[kind]):
+                return None
+            checks.append((column,
+                           _make_comparison_check(
+                               _comparison_operators[op], value)))
+            continue
+        m = _null_check_re.match(term)
+        if m is not None:
+            table, column, negate = m.groups()
+            if lookup_column(table, column) is None:
+                return None
+            checks.append((column, _make_null_check(negate)))
+            continue
+        m = _truth_check_re.match(term)
+        if m is not None:
+            negate, table, column = m.groups()
+            if lookup_column(table, column) != 'numeric':
+                return None
+            checks.append((column, _make_truth_check(negate)))
+            continue
+        return None
+    if values:
+        # didn't use up all our placeholder values
+        return None
+
+    def predicate(obj):
+        for column, check in checks:
+            if not check(getattr(obj, column)):
+                return False
+        return True
+    return predicate
+
+class ViewTrackerStats(object):
+    """Tracks how ViewTrackers check objects against their views.
+
+    Attributes:
+
+    - objects_checked -- objects checked against a view.  Before we
+      batched things, this was the number of SQL queries we would run.
+    - memory_checks -- objects checked using an in-memory predicate
+    - queries_run -- SQL queries actually run
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.objects_checked = 0
+        self.memory_checks = 0
+        self.queries_run = 0
+
+    def queries_saved(self):
+        return self.objects_checked - self.queries_run
+
+    def __str__(self):
+        return ('ViewTrackerStats: %d objects checked, %d in memory, '
+                '%d queries run, %d queries saved' %
+                (self.objects_checked, self.memory_checks, self.queries_run,
+                 self.queries_saved()))
+
 class ViewTrackerManager(object):
     def __init__(self, db):
         self.db = db
@@ -210,6 +374,7 @@ class ViewTrackerManager(object):
         self.table_to_tracker = {}
         # maps joined tables to trackers
         self.joined_table_to_tracker = {}
+        self.stats = ViewTrackerStats()
 
     def trackers_for_table(self, table_name):
         try:
@@ -227,6 +392,20 @@ class ViewTrackerManager(object):
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
+    def update_view_trackers_for_objects(self, objects):
+        """Update view trackers based on a list of changed objects.
+
+        Each tracker checks all of the objects for its table at once, which
+        means at most one query per tracker (per chunk of ids).
+        """
+        objects_by_table = {}
+        for obj in objects:
+            table_name = self.db.table_name(obj.__class__)
+            objects_by_table.setdefault(table_name, []).append(obj)
+        for table_name, table_objects in objects_by_table.items():
+            for tracker in list(self.trackers_for_table(table_name)):
+                tracker.check_objects(table_objects)
+
     def bulk_update_view_trackers(self, table_name):
         for tracker in self.trackers_for_table(table_name):
             tracker.check_all_objects()
@@ -254,10 +433,24 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        self.predicate = self._compile_predicate()
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
 
+    def _compile_predicate(self):
+        """Try to make a python function that checks if an object is in our
+        view without running SQL.
+        """
+        if self.joins is not None:
+            return None
+        try:
+            fields = self.db_info.db.schema_fields_for_table(self.table_name)
+        except KeyError:
+            return None
+        return compile_where_predicate(self.where, self.values,
+                                       self.table_name, fields)
+
     def unlink(self):
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).discard(self)
@@ -271,15 +464,42 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
-    def _obj_in_view(self, obj):
-        """Check if a single object is in our view."""
-        where = '%s.id = ?' % (self.table_name,)
-        if self.where:
-            where += ' AND (%s)' % (self.where,)
+    def _objects_in_view(self, objects):
+        """Check which objects from a list are in our view.
+
+        If we have a predicate, we use it for all objects whose attributes
+        match what's stored in the DB.  Otherwise we run a single
+        "id IN (...)" query for each chunk of objects.
 
-        values = (obj.id,) + self.values
-        return self.db_info.db.query_count(self.table_name, where, values,
-                self.joins) > 0
+        :returns: set of ids for objects in our view
+        """
+        stats = self.db_info.view_tracker_manager.stats
+        stats.objects_checked += len(objects)
+        in_view = set()
+        if self.predicate is not None:
+            to_query = []
+            for obj in objects:
+                if obj.changed_attributes:
+                    # the object has changes that haven't been saved yet.
+                    # Use SQL so that we check the values stored in the DB.
+                    to_query.append(obj)
+                elif self.predicate(obj):
+                    in_view.add(obj.id)
+            stats.memory_checks += len(objects) - len(to_query)
+        else:
+            to_query = objects
+
+        for objects_chunk in util.split_values_for_sqlite(to_query):
+            where = '%s.id IN (%s)' % (self.table_name,
+                    ', '.join('?' for i in xrange(len(objects_chunk))))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            values = tuple(obj.id for obj in objects_chunk) + self.values
+            in_view.update(self.db_info.db.query_ids(self.table_name, where,
+                                                     values,
+                                                     joins=self.joins))
+            stats.queries_run += 1
+        return in_view
 
     def _view_object_ids(self):
         """Get all object ids in our view."""
@@ -304,8 +524,20 @@ class ViewTracker(signals.SignalEmitter):
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
     def check_object(self, obj):
+        self._update_for_check(obj, obj.id in self._objects_in_view([obj]))
+
+    def check_objects(self, objects):
+        """Check a list of objects against our view.
+
+        This is the same as calling check_object() for each object, but it
+        only needs a single query to check all of them.
+        """
+        in_view = self._objects_in_view(objects)
+        for obj in objects:
+            self._update_for_check(obj, obj.id in in_view)
+
+    def _update_for_check(self, obj, now):
         before = (obj.id in self.current_ids)
-        now = self._obj_in_view(obj)
         if before and not now:
             self.current_ids.remove(obj.id)
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
@@ -358,6 +590,8 @@ class BulkSQLManager(object):
         self.active = False
         self.to_insert = {}
         self.to_remove = {}
+        # maps object ids -> PendingUpdate objects
+        self.to_update = {}
         self.pending_inserts = set()
         self.pending_removes = set()
 
@@ -391,12 +625,16 @@ class BulkSQLManager(object):
     def commit(self):
         for x in range(100):
             to_insert = self.to_insert
+            to_update = self.to_update
             to_remove = self.to_remove
             self.to_insert = {}
+            self.to_update = {}
             self.to_remove = {}
-            self._commit_sql(to_insert, to_remove)
+            self._commit_sql(to_insert, to_update, to_remove)
             self._update_view_trackers(to_insert, to_remove)
-            if len(self.to_insert) == len(self.to_remove) == 0:
+            self._update_view_trackers_for_updates(to_update)
+            if (len(self.to_insert) == len(self.to_update) ==
+                    len(self.to_remove) == 0):
                 break
             # inside _commit_sql() or _update_view_trackers(), we were
             # asked to insert or remove more items, repeat the
@@ -405,17 +643,24 @@ class BulkSQLManager(object):
             raise AssertionError("Called _commit_sql 100 times and still "
                     "have items to commit.  Are we in a circular loop?")
         self.to_insert = {}
+        self.to_update = {}
         self.to_remove = {}
         self.pending_inserts = set()
         self.pending_removes = set()
 
-    def _commit_sql(self, to_insert, to_remove):
+    def _commit_sql(self, to_insert, to_update, to_remove):
         for table_name, objects in to_insert.items():
             logging.debug('bulk insert: %s %s', table_name, len(objects))
             self.db.bulk_insert(objects)
             for obj in objects:
                 obj.inserted_into_db()
 
+        objects = [update.obj for update in to_update.values()
+                   if update.needs_save]
+        if objects:
+            logging.debug('bulk update: %s', len(objects))
+            self.db.bulk_update(objects)
+
         for table_name, objects in to_remove.items():
             logging.debug('bulk remove: %s %s', table_name, len(objects))
             self.db.bulk_remove(objects)
@@ -424,25 +669,43 @@ class BulkSQLManager(object):
 
     def _update_view_trackers(self, to_insert, to_remove):
         # figure out the total number of objects that have changed
-        changed_objs = set()
-        for table_name, objects in to_insert.items():
-            changed_objs.update(objects)
-        for table_name, objects in to_remove.items():
-            changed_objs.update(objects)
+        changed_count = (sum(len(objects) for objects in to_insert.values()) +
+                         sum(len(objects) for objects in to_remove.values()))
         # Figure out which strategy is fastest based on the number of objects
         # that have changed
-        if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
+        if changed_count < 100:
+            self._update_view_trackers_by_object(to_insert, to_remove)
         else:
             self._update_view_trackers_by_table(to_insert, to_remove)
 
-    def _update_view_trackers_by_object(self, changed_objs):
-        """Update view trackers by checking each changed object.
+    def _update_view_trackers_by_object(self, to_insert, to_remove):
+        """Update view trackers by checking the changed objects.
 
         This method is the fastest when there are not a lot of changed objects
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
+        inserted_objs = []
+        for objects in to_insert.values():
+            inserted_objs.extend(objects)
+        self.view_tracker_manager.update_view_trackers_for_objects(
+            inserted_objs)
+        for table_name, objects in to_remove.items():
+            self.view_tracker_manager.bulk_remove_from_view_trackers(
+                table_name, objects)
+
+    def _update_view_trackers_for_updates(self, to_update):
+        """Update view trackers for objects that were changed.
+
+        Objects that can change views are checked all at once, which only
+        needs one query per tracker.
+        """
+        to_check = []
+        for update in to_update.values():
+            if update.can_change_views:
+                to_check.append(update.obj)
+            else:
+                self.view_tracker_manager.update_view_trackers(update.obj,
+                                                               False)
+        self.view_tracker_manager.update_view_trackers_for_objects(to_check)
 
     def _update_view_trackers_by_table(self, to_insert, to_remove):
         """Update view trackers by checking each table
@@ -469,6 +732,24 @@ class BulkSQLManager(object):
         inserts_for_table.append(obj)
         self.pending_inserts.add(obj.id)
 
+    def add_update(self, obj, needs_save, can_change_views):
+        """Schedule an UPDATE and view tracker check for an object.
+
+        If the object is changed several times before we commit, we only
+        send one UPDATE for it.
+        """
+        if self.will_remove(obj.id):
+            return
+        try:
+            update = self.to_update[obj.id]
+        except KeyError:
+            self.to_update[obj.id] = PendingUpdate(obj, needs_save,
+                                                   can_change_views)
+        else:
+            update.needs_save = update.needs_save or needs_save
+            update.can_change_views = (update.can_change_views or
+                                       can_change_views)
+
     def will_insert(self, id_):
         return id_ in self.pending_inserts
 
@@ -482,6 +763,8 @@ class BulkSQLManager(object):
             self.pending_inserts.remove(obj.id)
             self.db.forget_object(obj)
             return
+        # no need to update an object that we're about to remove
+        self.to_update.pop(obj.id, None)
         try:
             removes_for_table = self.to_remove[table_name]
         except KeyError:
@@ -490,6 +773,13 @@ class BulkSQLManager(object):
         self.pending_removes.add(obj.id)
         removes_for_table.append(obj)
 
+class PendingUpdate(object):
+    """An object change that BulkSQLManager will commit later."""
+    def __init__(self, obj, needs_save, can_change_views):
+        self.obj = obj
+        self.needs_save = needs_save
+        self.can_change_views = can_change_views
+
 class AttributeUpdateTracker(object):
     """Used by DDBObject to track changes to attributes."""
 
@@ -503,6 +793,10 @@ class AttributeUpdateTracker(object):
         try:
             return instance.__dict__[self.name]
         except KeyError:
+            if self.name in instance._deferred_columns:
+                # restored with a projected view, load the column now
+                instance.db_info.db.load_deferred_columns(instance)
+                return instance.__dict__[self.name]
             raise AttributeError(self.name)
         except AttributeError:
             if instance is None:
@@ -515,11 +809,24 @@ class AttributeUpdateTracker(object):
         if instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
             instance.changed_attributes.add(self.name)
         instance.__dict__[self.name] = value
+        if self.name in instance._deferred_columns:
+            # _deferred_columns may be shared with other objects, so don't
+            # modify it in-place
+            instance._deferred_columns = instance._deferred_columns.difference(
+                [self.name])
 
 class DDBObject(signals.SignalEmitter):
     """Dynamic Database object
+
+    Attributes:
+
+    - _deferred_columns -- columns that weren't loaded when we were
+      restored from a projected view.  They get loaded from the DB on first
+      access.
     """
 
+    _deferred_columns = frozenset()
+
     def __init__(self, *args, **kwargs):
         self.confirm_db_thread()
         self.in_db_init = True
@@ -530,6 +837,7 @@ class DDBObject(signals.SignalEmitter):
             self.db_info = kwargs.pop('db_info')
         else:
             self.db_info = app.db_info
+        deferred_columns = kwargs.pop('deferred_columns', None)
 
         if len(args) == 0 and kwargs.keys() == ['restored_data']:
             restoring = True
@@ -538,6 +846,8 @@ class DDBObject(signals.SignalEmitter):
 
         if restoring:
             self.__dict__.update(kwargs['restored_data'])
+            if deferred_columns:
+                self._deferred_columns = deferred_columns
             self.db_info.db.remember_object(self)
             self.setup_restored()
             # handle setup_restored() calling remove()
@@ -575,12 +885,17 @@ class DDBObject(signals.SignalEmitter):
 
     @classmethod
     def make_view(cls, where=None, values=None, order_by=None, joins=None,
-            limit=None, db_info=None):
+            limit=None, db_info=None, columns=None):
+        """Make a View for objects of this class
+
+        :param columns: if given, only these columns are loaded when objects
+            are restored from the DB.  The rest get loaded on first access.
+        """
         if values is None:
             values = ()
         if db_info is None:
             db_info = app.db_info
-        fetcher = DDBObjectFetcher(cls, db_info)
+        fetcher = DDBObjectFetcher(cls, db_info, columns)
         return View(fetcher, where, values, order_by, joins, limit, db_info)
 
     @classmethod
@@ -675,6 +990,11 @@ class DDBObject(signals.SignalEmitter):
         """
         self.__dict__.update(dct)
         self.changed_attributes.update(dct.keys())
+        if self._deferred_columns.intersection(dct):
+            # We just set these, so don't load them from the DB later.
+            # _deferred_columns may be shared with other objects, so don't
+            # modify it in-place
+            self._deferred_columns = self._deferred_columns.difference(dct)
 
     def get_id(self):
         """Returns unique integer associated with this object
@@ -737,6 +1057,13 @@ class DDBObject(signals.SignalEmitter):
             # view trackers in this case.  Both will be done when the
             # BulkSQLManager.finish() is called.
             return
+        if self.db_info.bulk_sql_manager.active:
+            # Wait until BulkSQLManager.finish() to send the UPDATE and
+            # check the view trackers.  This way we can update all objects
+            # at once.
+            self.db_info.bulk_sql_manager.add_update(self, needs_save,
+                                                     can_change_views)
+            return
         if needs_save:
             self.db_info.db.update_obj(self)
         self.db_info.view_tracker_manager.update_view_trackers(
@@ -122,23 +122,44 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
     if new_types is None:
         new_types = {}
     cursor.execute("PRAGMA table_info('%s')" % table)
-    old_columns = []
-    new_columns = []
-    columns_with_type = []
+    columns = []
     for column_info in cursor.fetchall():
         column = column_info[1]
         col_type = column_info[2]
         if column in delete_columns:
             continue
-        old_columns.append(column)
+        old_column = column
         if column in rename_columns:
             column = rename_columns[column]
         if column in new_types:
             col_type = new_types[column]
-        new_columns.append(column)
-        if column == 'id':
+        columns.append((column, col_type, old_column))
+    rebuild_table(cursor, table, columns)
+
+def rebuild_table(cursor, table, columns, where=None, values=()):
+    """Rebuild a SQLITE table using a single INSERT ... SELECT statement.
+
+    Use this for upgrades that can be expressed purely in SQL.  The data
+    never gets loaded into python, so it's much faster than selecting the
+    rows and updating them one by one.
+
+    .. Note::
+
+       This does **NOT** handle renaming the column in an index.  Indexes
+       are re-created using their old SQL.
+
+    :param table: the table to rebuild
+    :param columns: list of (name, type, expression) tuples for the columns
+        of the new table.  expression is SQL that calculates the value from
+        the columns in the old table.
+    :param where: WHERE clause to select which rows to keep
+    :param values: values for the WHERE clause
+    """
+    columns_with_type = []
+    for name, col_type, expression in columns:
+        if name == 'id':
             col_type += ' PRIMARY KEY'
-        columns_with_type.append("%s %s" % (column, col_type))
+        columns_with_type.append("%s %s" % (name, col_type))
 
     # Note: This does not fix indexes that use the old column name.
     cursor.execute("PRAGMA index_list('%s')" % table)
@@ -147,17 +168,140 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
         name = index_info[1]
         cursor.execute("SELECT sql FROM sqlite_master "
                        "WHERE name=? and type='index'", (name,))
-        index_sql.append(cursor.fetchone()[0])
-
+        sql = cursor.fetchone()[0]
+        # automatic indexes (for example from UNIQUE) don't have any SQL
+        if sql is not None:
+            index_sql.append(sql)
+
+    sql = ("INSERT INTO %s(%s) SELECT %s FROM old_%s" %
+           (table, ', '.join(c[0] for c in columns),
+            ', '.join(c[2] for c in columns), table))
+    if where is not None:
+        sql += " WHERE %s" % where
     cursor.execute("ALTER TABLE %s RENAME TO old_%s" % (table, table))
     cursor.execute("CREATE TABLE %s (%s)" %
                    (table, ', '.join(columns_with_type)))
-    cursor.execute("INSERT INTO %s(%s) SELECT %s FROM old_%s" %
-                   (table, ', '.join(new_columns), ', '.join(old_columns), table))
+    cursor.execute(sql, values)
     cursor.execute("DROP TABLE old_%s" % table)
     for sql in index_sql:
         cursor.execute(sql)
 
+# number of rows to load at once in iter_row_pages() and rewrite_rows()
+UPGRADE_PAGE_SIZE = 1000
+
+def iter_row_pages(cursor, table, columns, where=None, values=(),
+                   page_size=None):
+    """Iterate through the rows of a table in pages.
+
+    Rows are returned ordered by id.  Each page is a list of rows, the first
+    column of each row is the id and the rest are the columns in
+    ``columns``.  Only one page is loaded into memory at once and it's safe
+    to execute other statements with cursor between pages.
+
+    :param table: the table to select from
+    :param columns: list of columns to select
+    :param where: WHERE clause to filter the rows with
+    :param values: values for the WHERE clause
+    :param page_size: number of rows per page (default: UPGRADE_PAGE_SIZE)
+    """
+    if page_size is None:
+        page_size = UPGRADE_PAGE_SIZE
+    sql = "SELECT id, %s FROM %s WHERE id > ?" % (', '.join(columns), table)
+    if where is not None:
+        sql += " AND (%s)" % where
+    sql += " ORDER BY id LIMIT %d" % page_size
+    last_id = None
+    while True:
+        if last_id is None:
+            # ids can be negative, so use a value that's lower than any
+            # possible id
+            cursor.execute(sql, (-(2 ** 63),) + tuple(values))
+        else:
+            cursor.execute(sql, (last_id,) + tuple(values))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield rows
+        if len(rows) < page_size:
+            return
+
+def rewrite_rows(cursor, table, columns, update_columns, func, where=None,
+                 values=(), page_size=None):
+    """Rewrite the rows of a table using a python function.
+
+    This selects rows a page at a time, calls func for each one and
+    writes the results back with executemany().  Progress is reported to
+    dbupgradeprogress as each page is written.
+
+    :param table: the table to update
+    :param columns: columns to select.  func is called with the id followed
+        by these values.
+    :param update_columns: columns to update
+    :param func: function that takes a row and returns a list of values for
+        update_columns, or None to leave the row alone.
+    :param where: WHERE clause to select which rows to rewrite
+    :param values: values for the WHERE clause
+    :param page_size: number of rows to handle at once
+    :returns: number of rows that were updated
+    """
+    count_sql = "SELECT COUNT(*) FROM %s" % table
+    if where is not None:
+        count_sql += " WHERE %s" % where
+    cursor.execute(count_sql, values)
+    total = cursor.fetchone()[0]
+    update_sql = "UPDATE %s SET %s WHERE id=?" % (
+        table, ', '.join("%s=?" % name for name in update_columns))
+    done = updated = 0
+    for page in iter_row_pages(cursor, table, columns, where, values,
+                               page_size):
+        new_values = []
+        for row in page:
+            result = func(*row)
+            if result is not None:
+                new_values.append(tuple(result) + (row[0],))
+        if new_values:
+            cursor.executemany(update_sql, new_values)
+            updated += len(new_values)
+        done += len(page)
+        report_upgrade_progress(done, total)
+    return updated
+
+class _UpgradeProgress(object):
+    """Tracks progress for the upgrade function that's currently running."""
+    def __init__(self, start_version, version, end_version):
+        self.start_version = start_version
+        self.version = version
+        self.end_version = end_version
+        self.last_sent = 0.0
+
+    def report(self, done, total):
+        if total <= 0:
+            return
+        fraction = min(float(done) / total, 1.0)
+        # don't flood the frontend with messages
+        if fraction - self.last_sent < 0.01 and fraction < 1.0:
+            return
+        self.last_sent = fraction
+        dbupgradeprogress.new_style_progress(self.start_version,
+                                             self.version - 1 + fraction,
+                                             self.end_version)
+
+_current_progress = None
+
+def report_upgrade_progress(done, total):
+    """Report progress for the upgrade function that's currently running.
+
+    Upgrade functions that work through a lot of rows can call this to
+    move the progress bar while they run.  It does nothing if we aren't
+    showing progress.
+
+    :param done: number of units of work done
+    :param total: total number of units of work
+    """
+    if _current_progress is not None:
+        _current_progress.report(done, total)
+
 def get_object_tables(cursor):
     """Returns a list of tables that store ``DDBObject`` subclasses.
     """
@@ -253,6 +397,8 @@ def new_style_upgrade(cursor, saved_version, upgrade_to, context,
                "(db version is %s)" % saved_version)
         raise DatabaseTooNewError(msg)
 
+    global _current_progress
+
     if show_progress:
         dbupgradeprogress.new_style_progress(saved_version, saved_version,
                                              upgrade_to)
@@ -261,9 +407,15 @@ def new_style_upgrade(cursor, saved_version, upgrade_to, context,
             logging.info("upgrading database to version %s", version)
         upgrade_func = get_upgrade_func(version)
         if context in contexts_for_upgrade_func(upgrade_func):
-            cursor.execute("BEGIN TRANSACTION")
-            upgrade_func(cursor)
-            cursor.execute("COMMIT TRANSACTION")
+            if show_progress:
+                _current_progress = _UpgradeProgress(saved_version, version,
+                                                     upgrade_to)
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                upgrade_func(cursor)
+                cursor.execute("COMMIT TRANSACTION")
+            finally:
+                _current_progress = None
         if show_progress:
             dbupgradeprogress.new_style_progress(saved_version, version,
                                                  upgrade_to)
@@ -2970,24 +3122,17 @@ def upgrade128(cursor):
 def upgrade129(cursor):
     """Separate DisplayState.columns into columns_enabled and column_widths
     """
-    cursor.execute("SELECT id, columns FROM display_state")
-    columns = {}
-    for id_, column_state in cursor.fetchall():
-        if column_state is None:
-            name_list, width_map = None, None
-        else:
-            column_state = eval(column_state)
-            names, widths = zip(*column_state)
-            name_list = repr(list(names))
-            width_map = repr(dict(column_state))
-        columns[id_] = (name_list, width_map)
-    remove_column(cursor, 'display_state', ['columns'])
     cursor.execute("ALTER TABLE display_state ADD COLUMN columns_enabled pythonrepr")
     cursor.execute("ALTER TABLE display_state ADD COLUMN column_widths pythonrepr")
-    for id_, column_state in columns.items():
-        name_list, width_map = column_state[0], column_state[1]
-        cursor.execute("UPDATE display_state SET columns_enabled=?,"
-            "column_widths=? WHERE id=?", (name_list, width_map, id_))
+    def split_columns(id_, column_state):
+        if column_state is None:
+            return None
+        column_state = eval(column_state)
+        names, widths = zip(*column_state)
+        return (repr(list(names)), repr(dict(column_state)))
+    rewrite_rows(cursor, 'display_state', ['columns'],
+                 ['columns_enabled', 'column_widths'], split_columns)
+    remove_column(cursor, 'display_state', ['columns'])
 
 def upgrade130(cursor):
     """
@@ -3114,30 +3259,24 @@ def upgrade133(cursor):
 def upgrade134(cursor):
     """Split item.metadata into scalar fields.
     """
-    cursor.execute("SELECT id, metadata FROM item")
-    items = []
-    for id_, metadata in cursor.fetchall():
-        try:
-            data = eval(metadata)
-        except TypeError:
-            data = {}
-        album = data.get('album', None)
-        artist = data.get('artist', None)
-        title_tag = data.get('title', None)
-        track = data.get('track', None)
-        year = data.get('year', None)
-        genre = data.get('genre', None)
-        items.append((album, artist, title_tag, track, year, genre, id_))
-    remove_column(cursor, 'item', ['metadata'])
     cursor.execute("ALTER TABLE item ADD COLUMN album text")
     cursor.execute("ALTER TABLE item ADD COLUMN artist text")
     cursor.execute("ALTER TABLE item ADD COLUMN title_tag text")
     cursor.execute("ALTER TABLE item ADD COLUMN track integer")
     cursor.execute("ALTER TABLE item ADD COLUMN year integer")
     cursor.execute("ALTER TABLE item ADD COLUMN genre text")
-    for data in items:
-        cursor.execute("UPDATE item SET album=?, artist=?, title_tag=?,"
-            "track=?, year=?, genre=? WHERE id=?", data)
+    def split_metadata(id_, metadata):
+        try:
+            data = eval(metadata)
+        except TypeError:
+            data = {}
+        return (data.get('album', None), data.get('artist', None),
+                data.get('title', None), data.get('track', None),
+                data.get('year', None), data.get('genre', None))
+    rewrite_rows(cursor, 'item', ['metadata'],
+                 ['album', 'artist', 'title_tag', 'track', 'year', 'genre'],
+                 split_metadata)
+    remove_column(cursor, 'item', ['metadata'])
  
 def upgrade135(cursor):
     """Basic metadata versioning
@@ -3856,6 +3995,8 @@ def upgrade179(cursor):
     # Rename title -> metadata_title and add a title column that stores the
     # computed title (AKA what get_title() returned)
 
+    from miro.plat.utils import filename_to_unicode
+
     # translated from Item.get_title() circa 5ed4c4a6
     def get_title(metadata_title, torrent_title, entry_title, filename):
         if metadata_title:
@@ -3870,14 +4011,16 @@ def upgrade179(cursor):
             return _('no title')
     cursor.execute("ALTER TABLE item ADD COLUMN metadata_title text")
     cursor.execute("UPDATE item SET metadata_title=title")
-    cursor.execute("SELECT id, metadata_title, torrent_title, entry_title, "
-                   "filename FROM item")
-    rows = cursor.fetchall()
-    for id_, metadata_title, torrent_title, entry_title, filename in rows:
+    def update_title(id_, metadata_title, torrent_title, entry_title,
+                     filename):
         title = get_title(metadata_title, torrent_title, entry_title,
                           filename)
         if title != metadata_title:
-            cursor.execute("UPDATE item SET title=? WHERE id=?", (title, id_))
+            return (title,)
+    rewrite_rows(cursor, 'item',
+                 ['metadata_title', 'torrent_title', 'entry_title',
+                  'filename'],
+                 ['title'], update_title)
 
 def upgrade180(cursor):
     # Rename columns in the item table
@@ -3973,15 +4116,12 @@ def upgrade182(cursor):
         'upload_size': 'uploadSize',
     }
 
-    cursor.execute("SELECT id, status from remote_downloader")
-    update_sql = ("UPDATE remote_downloader SET %s WHERE id=?" %
-                  ", ".join("%s=? " % name for name in columns))
-    for id_, status_repr in cursor.fetchall():
+    def unroll_status(id_, status_repr):
         try:
             status = eval(status_repr, {}, {'datetime': datetime})
         except StandardError:
             logging.warn("Error evaluating status repr: %r" % status_repr)
-            continue
+            return None
         values = []
         for column in columns:
             status_key = rename_map.get(column, column)
@@ -3998,8 +4138,9 @@ def upgrade182(cursor):
             elif (column in ['start_time', 'end_time'] and value is not None):
                 value = int(value)
             values.append(value)
-        values.append(id_)
-        cursor.execute(update_sql, values)
+        return values
+    rewrite_rows(cursor, 'remote_downloader', ['status'], columns,
+                 unroll_status)
 
     remove_column(cursor, 'remote_downloader', ['status'])
 
@@ -4258,3 +4399,46 @@ def upgrade193(cursor):
                    "VALUES(new.id, %s); "
                    "END;" % (column_list, column_list_for_new))
 
+
+@run_on_both
+def upgrade194(cursor):
+    """Only update item_fts when the indexed columns change."""
+
+    cursor.execute("SELECT tbl_name FROM sqlite_master "
+                   "WHERE type='trigger' AND name='item_bu'")
+    row = cursor.fetchone()
+    if row is None:
+        # no full text search triggers to fix
+        return
+    table = row[0]
+
+    columns = ['title', 'description', 'artist', 'album', 'genre',
+               'filename', 'parent_title', ]
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
+    column_changed = ' OR '.join('old.%s IS NOT new.%s' % (c, c)
+                                 for c in columns)
+    cursor.execute("DROP TRIGGER item_bu")
+    cursor.execute("CREATE TRIGGER item_bu "
+                   "BEFORE UPDATE OF %s ON %s "
+                   "WHEN %s BEGIN "
+                   "DELETE FROM item_fts WHERE docid=old.id; "
+                   "END;" % (column_list, table, column_changed))
+
+    cursor.execute("DROP TRIGGER item_au")
+    cursor.execute("CREATE TRIGGER item_au "
+                   "AFTER UPDATE OF %s ON %s "
+                   "WHEN %s BEGIN "
+                   "INSERT INTO item_fts(docid, %s) "
+                   "VALUES(new.id, %s); "
+                   "END;" % (column_list, table, column_changed,
+                             column_list, column_list_for_new))
+
+@run_on_both
+def upgrade195(cursor):
+    """Add moviedata_attempts and moviedata_time to metadata_status."""
+    cursor.execute("ALTER TABLE metadata_status "
+                   "ADD COLUMN moviedata_attempts integer")
+    cursor.execute("ALTER TABLE metadata_status "
+                   "ADD COLUMN moviedata_time real")
+    cursor.execute("UPDATE metadata_status SET moviedata_attempts=0")
@@ -255,13 +255,14 @@ class OldItemImporter(object):
         sql = ("INSERT INTO metadata_status "
                "(id, path, file_type, finished_status, mutagen_status, "
                "moviedata_status, echonest_status, net_lookup_enabled, "
-               "mutagen_thinks_drm, max_entry_priority) "
-               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+               "mutagen_thinks_drm, max_entry_priority, "
+               "moviedata_attempts) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
 
         self.cursor.execute(sql, (status_id, path, file_type, finished_status,
                              mutagen_status, moviedata_status,
                              echonest_status, self.net_lookup_enabled,
-                             has_drm, max_entry_priority))
+                             has_drm, max_entry_priority, 0))
         return status_id
 
     def add_device_item(self, file_type, path, old_item, metadata_manager):
@@ -116,8 +116,12 @@ class BatchUpdateDownloadStatus(Command):
         from miro.messages import DownloaderSyncCommandComplete
 
         cmd_done = self.args[1]
-        fresh = all(RemoteDownloader.update_status(status, cmd_done=cmd_done)
-                    for status in self.args[0])
+        # decode everything before updating, so our decoder stays in sync
+        # even if we stop at a stale status.
+        statuses = self.daemon.status_decoder.decode(self.args[0])
+        fresh = all(RemoteDownloader.update_status(status, cmd_done=cmd_done,
+                                                   unicodified=True)
+                    for status in statuses)
         if cmd_done and fresh:
             DownloaderSyncCommandComplete().send_to_frontend()
 
@@ -28,6 +28,7 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro.dl_daemon import command
+from miro.dl_daemon import statusupdates
 import os
 import cPickle
 from struct import pack, unpack, calcsize
@@ -143,6 +144,11 @@ class Daemon(ConnectionHandler):
         self.states['command'] = self.on_command
         self.queued_commands = []
         self.shutdown = False
+        # BatchUpdateDownloadStatus data gets encoded with status_encoder
+        # by the downloader and decoded with status_decoder by the main
+        # process.
+        self.status_encoder = statusupdates.StatusEncoder()
+        self.status_decoder = statusupdates.StatusDecoder()
         # disable read timeouts for the downloader daemon
         # communication.  Our normal state is to wait for long periods
         # of time for without seeing any data.
@@ -433,9 +433,7 @@ class DownloadStatusUpdater(object):
                 statuses.append(downloader.get_status())
             self.to_update = set()
             if statuses or self.cmds_done:
-                command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                                  statuses,
-                                                  self.cmds_done).send()
+                send_statuses(statuses, self.cmds_done)
                 self.cmds_done = False
         finally:
             if periodic:
@@ -451,6 +449,26 @@ class DownloadStatusUpdater(object):
 
 DOWNLOAD_UPDATER = DownloadStatusUpdater()
 
+# states where we don't expect any more status updates for a download
+_FINAL_STATES = (u'finished', u'failed', u'stopped')
+
+def send_statuses(statuses, cmds_done=False):
+    """Send a BatchUpdateDownloadStatus command for a list of statuses.
+
+    We only send the fields that changed since the last update for each
+    download (see statusupdates.StatusEncoder).
+    """
+    encoder = daemon.LAST_DAEMON.status_encoder
+    encoded = encoder.encode(statuses)
+    command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON, encoded,
+                                      cmds_done).send()
+    # Don't keep delta state around for downloads that we won't send more
+    # updates for.
+    for status in statuses:
+        if (status['dlid'] not in _downloads or
+                status['state'] in _FINAL_STATES):
+            encoder.forget(status['dlid'])
+
 # retry times in seconds.  60 seconds, 5 minutes, ...
 RETRY_TIMES = (
     60,
@@ -504,8 +522,7 @@ class BGDownloader(object):
         if not now:
             DOWNLOAD_UPDATER.queue_update(self)
         else:
-            command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                              [self.get_status()]).send()
+            send_statuses([self.get_status()])
 
     def pick_initial_filename(self, suffix=".part", torrent=False,
                               is_directory=False, exists=False):
@@ -0,0 +1,190 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.dl_daemon.statusupdates`` -- Compact encoding for download status
+updates.
+
+The downloader sends the status of its active downloads to the main process
+every second.  Most of that data doesn't change between updates (URLs,
+filenames, ...), so instead of sending full status dicts, StatusEncoder
+only sends the fields that changed since the last update for each dlid.
+Numeric fields like rates and sizes get packed into a single array of
+doubles, which is much cheaper to pickle than lots of small ints and floats.
+
+StatusDecoder, on the other end of the connection, keeps a copy of the last
+status for each dlid and applies the changes to rebuild full status dicts.
+
+Each connection end has its own encoder/decoder, so they start from scratch
+when the downloader reconnects.  The first message from a new encoder is
+marked as a full resync, which makes the decoder throw away its old state.
+
+When a download goes away, the downloader calls StatusEncoder.forget().  The
+next message tells the decoder to drop its copy too, so neither side keeps
+state for old downloads.  Forgetting a download that's still active is
+harmless, its next update just sends the full status.
+"""
+
+import array
+
+from miro.util import unicodify
+
+# fields that we send packed into an array of doubles.  The order matters,
+# since it's used for the bitmasks in the encoded data.
+NUMERIC_FIELDS = ('current_size', 'total_size', 'rate', 'eta', 'upload_size',
+                  'upload_rate', 'seeders', 'leechers', 'connections',
+                  'start_time', 'end_time', 'retry_count')
+_NUMERIC_INDEXES = dict((name, i) for i, name in enumerate(NUMERIC_FIELDS))
+# fields that shouldn't be passed through unicodify()
+NON_UNICODE_FIELDS = ('filename', 'short_filename', 'metainfo')
+# we use NaN to send None values for numeric fields
+_NONE_VALUE = float('nan')
+
+_NUMBER_TYPES = (int, long, float)
+
+class StatusEncoder(object):
+    """Encodes status dicts from the downloader.
+
+    Encoded data is a tuple containing:
+        - True if this is a full resync
+        - a list of dlids that the decoder should forget about (or None)
+        - a list of (dlid, numeric_mask, int_mask, changed, removed) tuples,
+          one for each status.  numeric_mask has bits set for the
+          NUMERIC_FIELDS that changed, int_mask has bits set for the ones
+          whose values are ints.  changed is a dict of the other fields that
+          changed and removed is a list of the fields that are no longer
+          present (both can be None).
+        - the changed numeric values, packed with array.tostring().  Values
+          are stored in order of the statuses, then NUMERIC_FIELDS.
+    """
+    def __init__(self):
+        self.last_sent = {}
+        self.needs_full_resync = True
+        self.forgotten = []
+
+    def forget(self, dlid):
+        """Stop tracking the status for a download.
+
+        Call this when a download is removed or we won't be sending updates
+        for it anymore.
+        """
+        self.last_sent.pop(dlid, None)
+        self.forgotten.append(dlid)
+
+    def encode(self, statuses):
+        full_resync = self.needs_full_resync
+        self.needs_full_resync = False
+        forgotten = self.forgotten
+        self.forgotten = []
+        records = []
+        numbers = array.array('d')
+        for status in statuses:
+            dlid = status['dlid']
+            last = self.last_sent.get(dlid, {})
+            try:
+                changed_items = status.viewitems() - last.viewitems()
+            except TypeError:
+                # unhashable values, do things the slow way
+                changed_items = [(key, value)
+                                 for key, value in status.iteritems()
+                                 if key not in last or last[key] != value]
+            changed = {}
+            numeric_values = {}
+            for key, value in changed_items:
+                if key in _NUMERIC_INDEXES and (value is None or
+                        type(value) in _NUMBER_TYPES):
+                    numeric_values[_NUMERIC_INDEXES[key]] = value
+                else:
+                    changed[key] = value
+            numeric_mask = int_mask = 0
+            for index in sorted(numeric_values):
+                value = numeric_values[index]
+                numeric_mask |= 1 << index
+                if value is None:
+                    numbers.append(_NONE_VALUE)
+                else:
+                    if not isinstance(value, float):
+                        int_mask |= 1 << index
+                    numbers.append(value)
+            removed = list(last.viewkeys() - status.viewkeys())
+            self.last_sent[dlid] = status.copy()
+            records.append((dlid, numeric_mask, int_mask, changed or None,
+                            removed or None))
+        return (full_resync, forgotten or None, records, numbers.tostring())
+
+class StatusDecoder(object):
+    """Decodes data from StatusEncoder.encode() back into status dicts.
+
+    All the values in the status dicts we return have already gone through
+    unicodify() (except the NON_UNICODE_FIELDS).
+    """
+    def __init__(self):
+        self.statuses = {}
+
+    def decode(self, data):
+        """Decode encoded status data.
+
+        :returns: list of status dicts.  The caller is free to modify them.
+        """
+        full_resync, forgotten, records, packed_numbers = data
+        if full_resync:
+            self.statuses = {}
+        if forgotten:
+            # do this before handling records, in case a forgotten download
+            # was restarted.  The encoder sends its full status in that case.
+            for dlid in forgotten:
+                self.statuses.pop(dlid, None)
+        numbers = array.array('d')
+        numbers.fromstring(packed_numbers)
+        number_iter = iter(numbers)
+        rv = []
+        for dlid, numeric_mask, int_mask, changed, removed in records:
+            status = self.statuses.get(dlid)
+            if status is None:
+                status = self.statuses[dlid] = {}
+            if removed:
+                for key in removed:
+                    status.pop(key, None)
+            if changed:
+                for key, value in changed.iteritems():
+                    if key not in NON_UNICODE_FIELDS:
+                        value = unicodify(value)
+                    status[key] = value
+            index = 0
+            while numeric_mask >> index:
+                if numeric_mask & (1 << index):
+                    value = number_iter.next()
+                    if value != value:
+                        # NaN means None
+                        value = None
+                    elif int_mask & (1 << index):
+                        value = int(value)
+                    status[NUMERIC_FIELDS[index]] = value
+                index += 1
+            rv.append(status.copy())
+        return rv
@@ -35,7 +35,7 @@ import time
 
 from miro.gtcache import gettext as _
 from miro.database import DDBObject, ObjectNotFoundError
-from miro.dl_daemon import daemon, command
+from miro.dl_daemon import daemon, command, statusupdates
 from miro.download_utils import (next_free_filename, get_file_url_path,
         next_free_directory, filter_directory_name)
 from miro.util import (get_torrent_info_hash, returns_unicode, check_u,
@@ -443,10 +443,19 @@ class RemoteDownloader(DDBObject):
             app.download_state_manager.total_up_rate += rates[1]
 
     @classmethod
-    def update_status(cls, data, cmd_done=False):
-        for field in data:
-            if field not in ['filename', 'short_filename', 'metainfo']:
-                data[field] = unicodify(data[field])
+    def update_status(cls, data, cmd_done=False, unicodified=False):
+        """Update a RemoteDownloader with a status dict from the
+        downloader.
+
+        :param unicodified: True if the values in data have already been
+            passed through unicodify() (statusupdates.StatusDecoder does
+            this)
+        :returns: False if the status was stale and ignored
+        """
+        if not unicodified:
+            for field in data:
+                if field not in statusupdates.NON_UNICODE_FIELDS:
+                    data[field] = unicodify(data[field])
 
         self = get_downloader_by_dlid(dlid=data['dlid'])
         # FIXME: how do we get all of the possible bit torrent
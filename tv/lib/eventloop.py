@@ -35,12 +35,17 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import bisect
+import collections
 import errno
 import heapq
+import itertools
 import logging
-import Queue
+import math
+import multiprocessing
 import select
 import socket
+import sys
 import threading
 import traceback
 
@@ -52,15 +57,26 @@ from miro import util
 from miro.clock import clock
 from miro.plat.utils import thread_body
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 cumulative = {}
 
 class DelayedCall(object):
-    def __init__(self, function, name, args, kwargs):
+    def __init__(self, function, name, args, kwargs, kind='idle'):
         self.function = function
         self.name = name
         self.args = args
         self.kwargs = kwargs
+        self.kind = kind
         self.canceled = False
+        # Scheduler that has us in its heap
+        self.scheduler = None
+        # when we should have run.  Used to calculate the queue wait time
+        # for EventLoopProfiler.
+        self.queued_at = clock()
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -70,10 +86,13 @@ class DelayedCall(object):
         self.function = self.args = self.kwargs = None
 
     def cancel(self):
+        already_canceled = self.canceled
         self.canceled = True
         self._unlink()
+        if not already_canceled and self.scheduler is not None:
+            self.scheduler.timeout_canceled()
 
-    def dispatch(self):
+    def dispatch(self, profiler=None):
         success = True
         if not self.canceled:
             when = "While handling %s" % self.name
@@ -94,12 +113,33 @@ class DelayedCall(object):
                 logging.timing("%s cumulative is too slow (%.3f secs)",
                                self.name, total)
                 cumulative[self.name] = 0
+            if profiler is not None:
+                profiler.record_call(self.kind, self.name,
+                                     start - self.queued_at, end - start)
         self._unlink()
         return success
 
 class Scheduler(object):
+    """Handles timeouts for the event loop.
+
+    Timeouts are stored in a heap.  Canceled timeouts stay in the heap until
+    they reach the top, or until they make up most of the heap, at which
+    point we remove all of them at once.
+    """
+
+    # don't bother compacting the heap until we have this many canceled
+    # timeouts in it.
+    MIN_CANCELED_TO_COMPACT = 100
+
     def __init__(self):
         self.heap = []
+        self.profiler = None
+        # add_timeout() can be called from other threads
+        self.lock = threading.Lock()
+        # number of canceled DelayedCalls currently in the heap
+        self.canceled_count = 0
+        self.total_canceled = 0
+        self.compactions = 0
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
@@ -107,118 +147,465 @@ class Scheduler(object):
         if kwargs is None:
             kwargs = {}
         scheduled_time = clock() + delay
-        dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs,
+                         kind='timeout')
+        dc.queued_at = scheduled_time
+        dc.scheduler = self
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap, (scheduled_time, dc))
+        finally:
+            self.lock.release()
         return dc
 
+    def timeout_canceled(self):
+        """Called by DelayedCall.cancel() for timeouts in our heap."""
+        self.lock.acquire()
+        try:
+            self.canceled_count += 1
+            self.total_canceled += 1
+            if (self.canceled_count >= self.MIN_CANCELED_TO_COMPACT and
+                    self.canceled_count * 2 > len(self.heap)):
+                self._compact()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        """Remove all canceled timeouts from the heap.
+
+        Must be called with our lock held.
+        """
+        for time, dc in self.heap:
+            if dc.canceled:
+                dc.scheduler = None
+        self.heap = [entry for entry in self.heap if not entry[1].canceled]
+        heapq.heapify(self.heap)
+        self.canceled_count = 0
+        self.compactions += 1
+
+    def _pop_canceled_timeouts(self):
+        """Pop canceled timeouts off the top of the heap.
+
+        Must be called with our lock held.
+        """
+        heap = self.heap
+        while heap and heap[0][1].canceled:
+            time, dc = heapq.heappop(heap)
+            dc.scheduler = None
+            self.canceled_count -= 1
+
     def next_timeout(self):
-        if len(self.heap) == 0:
-            return None
-        else:
-            return max(0, self.heap[0][0] - clock())
+        self.lock.acquire()
+        try:
+            self._pop_canceled_timeouts()
+            if len(self.heap) == 0:
+                return None
+            else:
+                return max(0, self.heap[0][0] - clock())
+        finally:
+            self.lock.release()
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        heap = self.heap
+        return len(heap) > 0 and heap[0][0] < clock()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
-        return dc.dispatch()
+        self.lock.acquire()
+        try:
+            time, dc = heapq.heappop(self.heap)
+            dc.scheduler = None
+            if dc.canceled:
+                self.canceled_count -= 1
+        finally:
+            self.lock.release()
+        return dc.dispatch(self.profiler)
+
+    def stats(self):
+        return ('Scheduler: %d timeouts, %d canceled in heap, '
+                '%d canceled total, %d compactions' %
+                (len(self.heap), self.canceled_count, self.total_canceled,
+                 self.compactions))
+
+# Priorities for idle callbacks.  Lower values run first.
+PRIORITY_HIGH = -10
+PRIORITY_DEFAULT = 0
+PRIORITY_LOW = 10
 
 class CallQueue(object):
-    def __init__(self):
-        self.queue = Queue.Queue()
+    """Queue of DelayedCalls to run in the event loop.
+
+    Calls are run in priority order, and in the order they were added for
+    calls with the same priority.
+
+    Calls can be added with a coalesce_key.  If a call with the same key is
+    still waiting to run, then we don't add a new one.  Instead, the waiting
+    call is changed to use the new function and arguments, and returned.
+    """
+    def __init__(self, kind='idle'):
+        self.heap = []
+        self.counter = itertools.count()
+        # maps coalesce keys to DelayedCalls waiting to run
+        self.pending_keys = {}
+        # add_idle() gets called from multiple threads
+        self.lock = threading.Lock()
         self.quit_flag = False
         self.queue_size_warning_count = 0
+        self.kind = kind
+        self.profiler = None
+        self.coalesced_count = 0
 
-    def add_idle(self, function, name, args=None, kwargs=None):
+    def add_idle(self, function, name, args=None, kwargs=None, kind=None,
+                 priority=PRIORITY_DEFAULT, coalesce_key=None):
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
-        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
-        self.queue.put(dc)
+        if kind is None:
+            kind = self.kind
+        self.lock.acquire()
+        try:
+            if coalesce_key is not None:
+                dc = self._coalesce(coalesce_key, function, name, args,
+                                    kwargs, priority)
+                if dc is not None:
+                    return dc
+            dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs,
+                             kind)
+            dc.priority = priority
+            dc.coalesce_key = coalesce_key
+            if coalesce_key is not None:
+                self.pending_keys[coalesce_key] = dc
+            heapq.heappush(self.heap, (priority, self.counter.next(), dc))
+            queue_size = len(self.heap)
+        finally:
+            self.lock.release()
 
         # Check if our queue size is too big and log a warning if so.  Only do
         # this a few times.  That should be enough to track down errors, but
         # not too much to kill the log file.
-        #
-        # NOTE: the code below doesn't take into account that this method
-        # runs on multiple threads.  However, the worst that can happen is
-        # we log an extra warning or two, so this doesn't seem bad.
-        if self.queue_size_warning_count < 5 and self.queue.qsize() > 1000:
+        if self.queue_size_warning_count < 5 and queue_size > 1000:
             if self.queue_size_warning_count < 5:
                 logging.stacktrace("Queued called size too large")
                 self.queue_size_warning_count += 1
 
         return dc
 
+    def _coalesce(self, coalesce_key, function, name, args, kwargs,
+                  priority):
+        """Try to merge a call into the call waiting for coalesce_key.
+
+        Must be called with our lock held.
+
+        :returns: the waiting DelayedCall, or None if we couldn't merge.
+        """
+        dc = self.pending_keys.get(coalesce_key)
+        if dc is None or dc.canceled:
+            return None
+        if priority < dc.priority:
+            # The new call is more urgent.  Cancel the old one and let our
+            # caller add a new one with the higher priority.
+            dc.canceled = True
+            dc._unlink()
+            return None
+        dc.function = function
+        dc.name = "idle (%s)" % (name,)
+        dc.args = args
+        dc.kwargs = kwargs
+        self.coalesced_count += 1
+        return dc
+
     def process_next_idle(self):
-        dc = self.queue.get()
-        return dc.dispatch()
+        self.lock.acquire()
+        try:
+            priority, count, dc = heapq.heappop(self.heap)
+            if (dc.coalesce_key is not None and
+                    self.pending_keys.get(dc.coalesce_key) is dc):
+                del self.pending_keys[dc.coalesce_key]
+        finally:
+            self.lock.release()
+        return dc.dispatch(self.profiler)
 
     def has_pending_idle(self):
-        return not self.queue.empty()
+        return len(self.heap) > 0
+
+    def qsize(self):
+        return len(self.heap)
 
     def process_idles(self):
         # Note: used for testing purposes
         while self.has_pending_idle() and not self.quit_flag:
             self.process_next_idle()
 
+# Lanes for ThreadPool tasks.  Each lane has its own queue and threads, so
+# slow tasks in one lane don't hold up the others.
+LANE_DEFAULT = 'default'
+LANE_DNS = 'dns'
+LANE_IO = 'io'
+LANE_CPU = 'cpu'
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class ThreadPoolTask(object):
+    """A function queued to run in the ThreadPool.
+
+    Returned by call_in_thread() so that callers can cancel the task.
+    """
+    def __init__(self, lane, callback, errback, function, name, args,
+                 kwargs):
+        self.lane = lane
+        self.callback = callback
+        self.errback = errback
+        self.function = function
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = clock()
+        self.started = False
+        self.canceled = False
+
+    def cancel(self):
+        """Cancel this task.
+
+        If the task hasn't started, it's removed from the queue.  If it's
+        running, we can't stop it, but its callback/errback won't get
+        called.
+
+        :returns: True if the task was removed before it started running
+        """
+        return self.lane.cancel_task(self)
+
+class _ThreadPoolLane(object):
+    """Queue and threads for one ThreadPool lane."""
+    def __init__(self, name, min_threads, max_threads):
+        self.name = name
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.tasks = collections.deque()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.idle_threads = 0
+        self.running_count = 0
+        self.completed_count = 0
+        self.canceled_count = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_run_time = 0.0
+
+    def cancel_task(self, task):
+        self.condition.acquire()
+        try:
+            if task.canceled:
+                return False
+            task.canceled = True
+            self.canceled_count += 1
+            if task.started:
+                return False
+            self.tasks.remove(task)
+            return True
+        finally:
+            self.condition.release()
+
+    def stats(self):
+        if self.completed_count > 0:
+            avg_wait = self.total_wait_time / self.completed_count
+            avg_run = self.total_run_time / self.completed_count
+        else:
+            avg_wait = avg_run = 0.0
+        return ('%s: %d threads (%d-%d), %d queued, %d running, '
+                '%d completed, %d canceled, avg wait %0.3fs (max %0.3fs), '
+                'avg run %0.3fs' %
+                (self.name, len(self.threads), self.min_threads,
+                 self.max_threads, len(self.tasks), self.running_count,
+                 self.completed_count, self.canceled_count, avg_wait,
+                 self.max_wait_time, avg_run))
 
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Tasks are put in lanes, for example DNS lookups and CPU-heavy tasks each
+    have their own lane.  Each lane starts min_threads threads and adds
+    threads as tasks queue up, up to max_threads.  Threads that sit idle for
+    IDLE_THREAD_TIMEOUT seconds exit, down to min_threads.
     """
-    THREADS = 4
+    # maps lane names to (min_threads, max_threads)
+    LANE_SIZES = {
+        LANE_DEFAULT: (1, 4),
+        LANE_DNS: (1, 8),
+        LANE_IO: (1, 4),
+        LANE_CPU: (0, _cpu_count()),
+    }
+    IDLE_THREAD_TIMEOUT = 30.0
 
     def __init__(self, event_loop):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
-        self.threads = []
+        self.lanes = {}
+        for name, (min_threads, max_threads) in self.LANE_SIZES.items():
+            self.lanes[name] = _ThreadPoolLane(name, min_threads, max_threads)
+        self.running = False
+        self.thread_counter = itertools.count()
+
+    def set_lane_size(self, lane_name, min_threads, max_threads):
+        """Change the number of threads a lane can use."""
+        lane = self.lanes[lane_name]
+        lane.condition.acquire()
+        try:
+            lane.min_threads = min_threads
+            lane.max_threads = max_threads
+            if self.running:
+                self._start_threads(lane)
+            # wake up idle threads so that extra ones can exit
+            lane.condition.notifyAll()
+        finally:
+            lane.condition.release()
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
+        self.running = True
+        for lane in self.lanes.values():
+            lane.condition.acquire()
+            try:
+                self._start_threads(lane)
+            finally:
+                lane.condition.release()
+
+    def _start_threads(self, lane):
+        """Start threads for a lane if needed.
+
+        Must be called with the lane's condition acquired.
+        """
+        wanted = max(lane.min_threads,
+                     min(lane.max_threads,
+                         len(lane.threads) - lane.idle_threads +
+                         len(lane.tasks)))
+        while len(lane.threads) < wanted:
+            name = 'ThreadPool %s - %d' % (lane.name,
+                                           self.thread_counter.next())
+            t = threading.Thread(name=name, target=thread_body,
+                                 args=[self.thread_loop, lane])
             t.setDaemon(True)
+            lane.threads.append(t)
             t.start()
-            self.threads.append(t)
 
-    def thread_loop(self):
+    def _get_task(self, lane):
+        """Wait for the next task in a lane.
+
+        :returns: a ThreadPoolTask, or None if the calling thread should exit
+        """
+        current_thread = threading.currentThread()
+        lane.condition.acquire()
+        try:
+            while not lane.tasks:
+                if (not self.running or
+                        len(lane.threads) > lane.max_threads):
+                    lane.threads.remove(current_thread)
+                    return None
+                lane.idle_threads += 1
+                start = clock()
+                lane.condition.wait(self.IDLE_THREAD_TIMEOUT)
+                lane.idle_threads -= 1
+                if (not lane.tasks and
+                        clock() - start >= self.IDLE_THREAD_TIMEOUT and
+                        len(lane.threads) > lane.min_threads):
+                    lane.threads.remove(current_thread)
+                    return None
+            if not self.running:
+                lane.threads.remove(current_thread)
+                return None
+            task = lane.tasks.popleft()
+            task.started = True
+            wait_time = clock() - task.queued_at
+            lane.total_wait_time += wait_time
+            lane.max_wait_time = max(lane.max_wait_time, wait_time)
+            lane.running_count += 1
+            return task
+        finally:
+            lane.condition.release()
+
+    def thread_loop(self, lane):
         while True:
-            next_item = self.queue.get()
-            if next_item == "QUIT":
+            task = self._get_task(lane)
+            if task is None:
                 break
-            else:
-                callback, errback, func, name, args, kwargs, = next_item
-            try:
-                result = func(*args, **kwargs)
-            except KeyboardInterrupt:
-                raise
-            except Exception, exc:
-                logging.debug(">>> thread_loop: %s %s %s %s\n%s",
-                              func, name, args, kwargs,
-                              "".join(traceback.format_exc()))
-                func = errback
-                name = 'Thread Pool Errback (%s)' % name
-                args = (exc,)
-            else:
-                func = callback
-                name = 'Thread Pool Callback (%s)' % name
-                args = (result,)
-            if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
-                self.event_loop.wakeup()
+            self._run_task(lane, task)
+
+    def _run_task(self, lane, task):
+        func, name, args, kwargs = (task.function, task.name, task.args,
+                                    task.kwargs)
+        start = clock()
+        try:
+            result = func(*args, **kwargs)
+        except KeyboardInterrupt:
+            raise
+        except Exception, exc:
+            logging.debug(">>> thread_loop: %s %s %s %s\n%s",
+                          func, name, args, kwargs,
+                          "".join(traceback.format_exc()))
+            func = task.errback
+            name = 'Thread Pool Errback (%s)' % name
+            args = (exc,)
+        else:
+            func = task.callback
+            name = 'Thread Pool Callback (%s)' % name
+            args = (result,)
+        lane.condition.acquire()
+        try:
+            lane.running_count -= 1
+            lane.completed_count += 1
+            lane.total_run_time += clock() - start
+            canceled = task.canceled
+        finally:
+            lane.condition.release()
+        if not canceled and not self.event_loop.quit_flag:
+            self.event_loop.idle_queue.add_idle(func, name, args=args,
+                                                kind='thread')
+            self.event_loop.wakeup()
 
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        return self.queue_call_in_lane(LANE_DEFAULT, callback, errback,
+                                       function, name, *args, **kwargs)
+
+    def queue_call_in_lane(self, lane_name, callback, errback, function,
+                           name, *args, **kwargs):
+        lane = self.lanes[lane_name]
+        task = ThreadPoolTask(lane, callback, errback, function, name, args,
+                              kwargs)
+        lane.condition.acquire()
+        try:
+            lane.tasks.append(task)
+            if self.running:
+                lane.condition.notify()
+                self._start_threads(lane)
+        finally:
+            lane.condition.release()
+        return task
+
+    def has_pending_tasks(self):
+        """Are there tasks waiting to run?"""
+        for lane in self.lanes.values():
+            if lane.tasks:
+                return True
+        return False
+
+    def stats(self):
+        return 'ThreadPool: ' + '; '.join(lane.stats()
+                                         for lane in self.lanes.values())
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+        threads = []
+        for lane in self.lanes.values():
+            lane.condition.acquire()
+            try:
+                self.running = False
+                lane.condition.notifyAll()
+                threads.extend(lane.threads)
+            finally:
+                lane.condition.release()
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -226,12 +613,350 @@ class ThreadPool(object):
         # in a blocking operation which is exactly the point of having them
         # so eventloop.join() in turn blocks.  So if it doesn't clean up
         # in time let the daemon flag in the Thread() do its job.  See #16584.
-        for t in self.threads:
+        for t in threads:
             try:
                 t.join(0.5)
             except StandardError:
                 pass
-        self.threads = []
+
+class _CallbackStats(object):
+    """Timing info for one callback name."""
+    __slots__ = ('count', 'total_run_time', 'max_run_time', 'run_histogram',
+                 'total_wait_time', 'max_wait_time', 'wait_histogram')
+
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.total_run_time = self.max_run_time = 0.0
+        self.total_wait_time = self.max_wait_time = 0.0
+        self.run_histogram = [0] * bucket_count
+        self.wait_histogram = [0] * bucket_count
+
+class EventLoopProfiler(object):
+    """Records timing info for event loop callbacks.
+
+    For each callback we track how long it ran and how long it waited to be
+    run, keyed by the kind of callback (idle, urgent, timeout, thread or
+    socket) and its name.  We also sample the queue depths over time.
+
+    Use EventLoop.start_profiling() to turn this on.
+    """
+    # Upper bounds of our histogram buckets in seconds.  There's an extra
+    # bucket for everything above the last bound.
+    HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+    # Max number of callback names to track per kind.  Calls for other names
+    # get grouped together.
+    MAX_NAMES = 1000
+    OTHER_NAME = '<other>'
+    # How often to sample the queue depths and how many samples to keep
+    DEPTH_SAMPLE_INTERVAL = 1.0
+    MAX_DEPTH_SAMPLES = 600
+
+    def __init__(self):
+        self.start_time = clock()
+        self.callback_stats = {}
+        self.name_counts = collections.defaultdict(int)
+        self.depth_samples = collections.deque(maxlen=self.MAX_DEPTH_SAMPLES)
+        self._sample_end = self.start_time + self.DEPTH_SAMPLE_INTERVAL
+        self._max_depths = None
+
+    def record_call(self, kind, name, wait_time, run_time):
+        """Record a callback running.
+
+        :param kind: type of callback ('idle', 'timeout', etc)
+        :param name: name of the callback
+        :param wait_time: seconds between when the callback should have run
+            and when it actually ran
+        :param run_time: seconds that the callback took
+        """
+        key = (kind, name)
+        try:
+            stats = self.callback_stats[key]
+        except KeyError:
+            if self.name_counts[kind] >= self.MAX_NAMES:
+                key = (kind, self.OTHER_NAME)
+            else:
+                self.name_counts[kind] += 1
+            stats = self.callback_stats.get(key)
+            if stats is None:
+                stats = _CallbackStats(len(self.HISTOGRAM_BOUNDS) + 1)
+                self.callback_stats[key] = stats
+        wait_time = max(wait_time, 0.0)
+        stats.count += 1
+        stats.total_run_time += run_time
+        stats.max_run_time = max(stats.max_run_time, run_time)
+        stats.run_histogram[self._bucket(run_time)] += 1
+        stats.total_wait_time += wait_time
+        stats.max_wait_time = max(stats.max_wait_time, wait_time)
+        stats.wait_histogram[self._bucket(wait_time)] += 1
+
+    def _bucket(self, value):
+        return bisect.bisect_left(self.HISTOGRAM_BOUNDS, value)
+
+    def sample_queue_depths(self, idle_depth, urgent_depth, timeout_count):
+        """Record the current queue depths.
+
+        We keep the max depths for each DEPTH_SAMPLE_INTERVAL period.
+        """
+        now = clock()
+        if now >= self._sample_end:
+            self._finish_depth_sample()
+            self._sample_end = now + self.DEPTH_SAMPLE_INTERVAL
+        if self._max_depths is None:
+            self._max_depths = [idle_depth, urgent_depth, timeout_count]
+        else:
+            current = (idle_depth, urgent_depth, timeout_count)
+            self._max_depths = [max(old, new) for old, new in
+                                zip(self._max_depths, current)]
+
+    def _finish_depth_sample(self):
+        if self._max_depths is None:
+            return
+        idle_depth, urgent_depth, timeout_count = self._max_depths
+        self.depth_samples.append({
+            'time': self._sample_end - self.start_time,
+            'idle': idle_depth,
+            'urgent': urgent_depth,
+            'timeouts': timeout_count,
+        })
+        self._max_depths = None
+
+    def get_stats(self):
+        """Get our timing info.
+
+        :returns: dict containing only basic types, suitable for sending in
+        a message or dumping as JSON.  Callbacks are sorted by total run
+        time.
+        """
+        callbacks = []
+        for (kind, name), stats in self.callback_stats.iteritems():
+            callbacks.append({
+                'kind': kind,
+                'name': name,
+                'count': stats.count,
+                'total_run_time': stats.total_run_time,
+                'max_run_time': stats.max_run_time,
+                'run_histogram': list(stats.run_histogram),
+                'total_wait_time': stats.total_wait_time,
+                'max_wait_time': stats.max_wait_time,
+                'wait_histogram': list(stats.wait_histogram),
+            })
+        callbacks.sort(key=lambda info: info['total_run_time'], reverse=True)
+        depth_samples = list(self.depth_samples)
+        if self._max_depths is not None:
+            idle_depth, urgent_depth, timeout_count = self._max_depths
+            depth_samples.append({
+                'time': clock() - self.start_time,
+                'idle': idle_depth,
+                'urgent': urgent_depth,
+                'timeouts': timeout_count,
+            })
+        return {
+            'elapsed_time': clock() - self.start_time,
+            'histogram_bounds': list(self.HISTOGRAM_BOUNDS),
+            'callbacks': callbacks,
+            'queue_depths': depth_samples,
+        }
+
+    def dump_json(self, path):
+        """Write the output of get_stats() to a JSON file."""
+        f = open(path, 'w')
+        try:
+            json.dump(self.get_stats(), f, indent=2)
+        finally:
+            f.close()
+
+class SelectPoller(object):
+    """Track sockets we want to wait on and wait for them to be ready.
+
+    This is the simplest poller.  It calls select.select(), so it works
+    everywhere, but it's O(n) for each call and can't handle file
+    descriptors greater than FD_SETSIZE.
+
+    All pollers have the same interface.  Sockets are registered with
+    add_reader()/add_writer() and stay registered until they are removed, so
+    the event loop doesn't need to rebuild anything on each iteration.
+    """
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+
+    def add_reader(self, fd):
+        self.read_fds.add(fd)
+
+    def remove_reader(self, fd):
+        self.read_fds.discard(fd)
+
+    def add_writer(self, fd):
+        self.write_fds.add(fd)
+
+    def remove_writer(self, fd):
+        self.write_fds.discard(fd)
+
+    def poll(self, timeout):
+        """Wait for our sockets to be ready.
+
+        :param timeout: max time to wait in seconds, or None to wait forever
+        :returns: (read_fds_ready, write_fds_ready, exc_fds_ready) lists
+        """
+        return select.select(list(self.read_fds), list(self.write_fds), [],
+                             timeout)
+
+    def close(self):
+        pass
+
+class _MaskPoller(SelectPoller):
+    """Base class for pollers that track an event mask for each fd."""
+
+    READ_EVENTS = None
+    WRITE_EVENTS = None
+    ERROR_EVENTS = None
+
+    def __init__(self):
+        SelectPoller.__init__(self)
+        self.masks = {}
+
+    def add_reader(self, fd):
+        SelectPoller.add_reader(self, fd)
+        self._update_mask(fd)
+
+    def remove_reader(self, fd):
+        SelectPoller.remove_reader(self, fd)
+        self._update_mask(fd)
+
+    def add_writer(self, fd):
+        SelectPoller.add_writer(self, fd)
+        self._update_mask(fd)
+
+    def remove_writer(self, fd):
+        SelectPoller.remove_writer(self, fd)
+        self._update_mask(fd)
+
+    def _update_mask(self, fd):
+        mask = 0
+        if fd in self.read_fds:
+            mask |= self.READ_EVENTS
+        if fd in self.write_fds:
+            mask |= self.WRITE_EVENTS
+        old_mask = self.masks.get(fd, 0)
+        if mask == old_mask:
+            return
+        if mask == 0:
+            del self.masks[fd]
+            self._unregister(fd)
+        elif old_mask == 0:
+            self.masks[fd] = mask
+            self._register(fd, mask)
+        else:
+            self.masks[fd] = mask
+            self._modify(fd, mask)
+
+    def _calc_ready_lists(self, events):
+        read_fds_ready = []
+        write_fds_ready = []
+        exc_fds_ready = []
+        for fd, event in events:
+            if event & (self.READ_EVENTS | self.ERROR_EVENTS):
+                # Report errors as readable, so the read callback gets an
+                # error from recv().  If there's no read callback, report it
+                # to the write callback.
+                if fd in self.read_fds:
+                    read_fds_ready.append(fd)
+                elif event & self.ERROR_EVENTS:
+                    write_fds_ready.append(fd)
+            if event & self.WRITE_EVENTS and fd in self.write_fds:
+                write_fds_ready.append(fd)
+            if event & self.ERROR_EVENTS:
+                exc_fds_ready.append(fd)
+        return read_fds_ready, write_fds_ready, exc_fds_ready
+
+class PollPoller(_MaskPoller):
+    """Poller that uses select.poll()."""
+
+    if hasattr(select, 'poll'):
+        READ_EVENTS = select.POLLIN | select.POLLPRI
+        WRITE_EVENTS = select.POLLOUT
+        ERROR_EVENTS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def __init__(self):
+        _MaskPoller.__init__(self)
+        self.poll_obj = select.poll()
+
+    def _register(self, fd, mask):
+        self.poll_obj.register(fd, mask)
+
+    def _modify(self, fd, mask):
+        # for poll(), register() also modifies existing registrations
+        self.poll_obj.register(fd, mask)
+
+    def _unregister(self, fd):
+        try:
+            self.poll_obj.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        if timeout is not None:
+            # poll() uses milliseconds.  Round up so that we don't wake up
+            # just before a timeout is ready.
+            timeout = int(math.ceil(timeout * 1000))
+        return self._calc_ready_lists(self.poll_obj.poll(timeout))
+
+class EPollPoller(_MaskPoller):
+    """Poller that uses select.epoll() (Linux only)."""
+
+    if hasattr(select, 'epoll'):
+        READ_EVENTS = select.EPOLLIN | select.EPOLLPRI
+        WRITE_EVENTS = select.EPOLLOUT
+        ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP
+
+    def __init__(self):
+        _MaskPoller.__init__(self)
+        self.epoll = select.epoll()
+
+    def _register(self, fd, mask):
+        try:
+            self.epoll.register(fd, mask)
+        except IOError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            # A closed fd that was re-used.  epoll doesn't always drop
+            # closed fds, so just modify the old registration.
+            self.epoll.modify(fd, mask)
+
+    def _modify(self, fd, mask):
+        try:
+            self.epoll.modify(fd, mask)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # epoll dropped the fd when it was closed, and then the fd was
+            # re-used.  Register it again.
+            self.epoll.register(fd, mask)
+
+    def _unregister(self, fd):
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            # the fd was already closed
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self._calc_ready_lists(self.epoll.poll(timeout))
+
+    def close(self):
+        self.epoll.close()
+
+def make_poller():
+    """Create the best poller for this platform."""
+    if hasattr(select, 'epoll'):
+        return EPollPoller()
+    elif hasattr(select, 'poll') and sys.platform != 'darwin':
+        # poll() is broken for some file types on OS X
+        return PollPoller()
+    else:
+        return SelectPoller()
 
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
@@ -253,14 +978,13 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
             try:
                 read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
+                        self.wait_for_events(timeout)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    logging.warning ("eventloop: %s", e)
+                    read_fds_ready = write_fds_ready = exc_fds_ready = []
                 else:
                     self.emit('end-loop')
                     raise
@@ -272,6 +996,18 @@ class SimpleEventLoop(signals.SignalEmitter):
             self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
             self.emit('end-loop')
 
+    def wait_for_events(self, timeout):
+        """Wait for sockets to be ready or timeout to pass.
+
+        By default we call calc_fds() and pass the results to select().
+        Subclasses can override this to use a different method.
+
+        :returns: (read_fds_ready, write_fds_ready, exc_fds_ready) lists
+        """
+        readfds, writefds, excfds = self.calc_fds()
+        readfds.append(self.wake_receiver.fileno())
+        return select.select(readfds, writefds, excfds, timeout)
+
     def wakeup(self):
         try:
             self.wake_sender.send("b")
@@ -282,15 +1018,21 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.wake_receiver.recv(1024)
 
 class EventLoop(SimpleEventLoop):
+    # max time to spend running idle callbacks in one loop iteration
+    IDLE_TIME_BUDGET = 0.1
+
     def __init__(self):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
-        self.idle_queue = CallQueue()
-        self.urgent_queue = CallQueue()
+        self.idle_queue = CallQueue('idle')
+        self.urgent_queue = CallQueue('urgent')
+        self.profiler = None
         self.threadpool = ThreadPool(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
+        self.poller = make_poller()
+        self.poller.add_reader(self.wake_receiver.fileno())
         self.clear_removed_callbacks()
         self.idles_for_next_loop = []
 
@@ -300,22 +1042,62 @@ class EventLoop(SimpleEventLoop):
 
     def add_read_callback(self, sock, callback):
         self.read_callbacks[sock.fileno()] = callback
+        self.poller.add_reader(sock.fileno())
 
     def remove_read_callback(self, sock):
         del self.read_callbacks[sock.fileno()]
+        self.poller.remove_reader(sock.fileno())
         self.removed_read_callbacks.add(sock.fileno())
 
     def add_write_callback(self, sock, callback):
         self.write_callbacks[sock.fileno()] = callback
+        self.poller.add_writer(sock.fileno())
 
     def remove_write_callback(self, sock):
         del self.write_callbacks[sock.fileno()]
+        self.poller.remove_writer(sock.fileno())
         self.removed_write_callbacks.add(sock.fileno())
 
+    def start_profiling(self):
+        """Start recording timing info for our callbacks.
+
+        The info is stored in an EventLoopProfiler object.
+        """
+        self.profiler = EventLoopProfiler()
+        self._set_queue_profilers(self.profiler)
+
+    def stop_profiling(self):
+        self.profiler = None
+        self._set_queue_profilers(None)
+
+    def _set_queue_profilers(self, profiler):
+        self.scheduler.profiler = profiler
+        self.idle_queue.profiler = profiler
+        self.urgent_queue.profiler = profiler
+
+    def set_poller(self, poller):
+        """Switch to a different poller object.
+
+        All sockets with callbacks are registered with the new poller.
+        """
+        self.poller.close()
+        self.poller = poller
+        self.poller.add_reader(self.wake_receiver.fileno())
+        for fd in self.read_callbacks:
+            self.poller.add_reader(fd)
+        for fd in self.write_callbacks:
+            self.poller.add_writer(fd)
+
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        return self.threadpool.queue_call(callback, errback, function, name,
+                                          *args, **kwargs)
+
+    def call_in_lane(self, lane, callback, errback, function, name,
+                     *args, **kwargs):
+        return self.threadpool.queue_call_in_lane(lane, callback, errback,
+                                                  function, name, *args,
+                                                  **kwargs)
 
     def run_idle_next_loop(self, function, name, args=None, kwargs=None):
         """Add an idle callback to be called on the next event loop."""
@@ -337,12 +1119,24 @@ class EventLoop(SimpleEventLoop):
     def calc_fds(self):
         return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
 
+    def wait_for_events(self, timeout):
+        # our sockets are registered with the poller as callbacks get added
+        # and removed, so there's no need to call calc_fds() here.
+        return self.poller.poll(timeout)
+
     def calc_timeout(self):
+        if self.idle_queue.has_pending_idle():
+            # we ran out of time for idles last loop, don't block
+            return 0
         return self.scheduler.next_timeout()
 
     def do_begin_loop(self):
         self.clear_removed_callbacks()
         self._add_idles_for_next_loop()
+        if self.profiler is not None:
+            self.profiler.sample_queue_depths(self.idle_queue.qsize(),
+                                              self.urgent_queue.qsize(),
+                                              len(self.scheduler.heap))
 
     def _add_idles_for_next_loop(self):
         if not self.idles_for_next_loop:
@@ -370,18 +1164,26 @@ class EventLoop(SimpleEventLoop):
         """
         for callback in self.generate_callbacks(write_fds_ready,
                                                self.write_callbacks,
-                                               self.removed_write_callbacks):
+                                               self.removed_write_callbacks,
+                                               self.poller.remove_writer):
             yield callback
         for callback in self.generate_callbacks(read_fds_ready,
                                                self.read_callbacks,
-                                               self.removed_read_callbacks):
+                                               self.removed_read_callbacks,
+                                               self.poller.remove_reader):
             yield callback
         while self.scheduler.has_pending_timeout():
             yield self.scheduler.process_next_timeout
+        # Run idles until we run out of them or hit our time budget.  If
+        # there are idles left, we'll run them on the next loop, after
+        # checking our sockets.
+        deadline = clock() + self.IDLE_TIME_BUDGET
         while self.idle_queue.has_pending_idle():
             yield self.idle_queue.process_next_idle
+            if clock() >= deadline:
+                break
 
-    def generate_callbacks(self, ready_list, map_, removed):
+    def generate_callbacks(self, ready_list, map_, removed, unregister):
         for fd in ready_list:
             try:
                 function = map_[fd]
@@ -394,9 +1196,16 @@ class EventLoop(SimpleEventLoop):
                     continue
                 when = "While talking to the network"
                 def callback_event():
+                    if self.profiler is not None:
+                        start = clock()
                     success = trapcall.trap_call(when, function)
+                    if self.profiler is not None:
+                        self.profiler.record_call('socket',
+                                                  _callback_name(function),
+                                                  0.0, clock() - start)
                     if not success:
                         del map_[fd]
+                        unregister(fd)
                     return success
                 yield callback_event
 
@@ -405,6 +1214,14 @@ class EventLoop(SimpleEventLoop):
         self.idle_queue.quit_flag = True
         self.urgent_queue.quit_flag = True
 
+def _callback_name(function):
+    """Get a name for a socket callback to use with EventLoopProfiler."""
+    name = getattr(function, '__name__', repr(function))
+    obj = getattr(function, 'im_self', None)
+    if obj is not None:
+        name = '%s.%s' % (type(obj).__name__, name)
+    return name
+
 _eventloop = EventLoop()
 
 def add_read_callback(sock, callback):
@@ -446,6 +1263,36 @@ def stop_handling_socket(sock):
     except KeyError:
         pass
 
+def start_profiling():
+    """Start recording timing info for event loop callbacks.
+
+    Use get_profile_stats() or dump_profile_stats() to get the results.
+    """
+    _eventloop.start_profiling()
+
+def stop_profiling():
+    _eventloop.stop_profiling()
+
+def get_profile_stats():
+    """Get the timing info recorded since start_profiling() was called.
+
+    :returns: dict as returned by EventLoopProfiler.get_stats(), or None if
+    we aren't profiling.
+    """
+    if _eventloop.profiler is None:
+        return None
+    return _eventloop.profiler.get_stats()
+
+def dump_profile_stats(path):
+    """Write the timing info from get_profile_stats() to a JSON file."""
+    if _eventloop.profiler is None:
+        raise ValueError("event loop profiling not enabled")
+    _eventloop.profiler.dump_json(path)
+
+def scheduler_stats():
+    """Get a string describing the state of the event loop timeouts."""
+    return _eventloop.scheduler.stats()
+
 def add_timeout(delay, function, name, args=None, kwargs=None):
     """Schedule a function to be called at some point in the future.
     Returns a ``DelayedCall`` object that can be used to cancel the
@@ -455,12 +1302,20 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None,
+             priority=PRIORITY_DEFAULT, coalesce_key=None):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    Idles with a lower priority value run first.  If coalesce_key is given
+    and an idle with the same key is still waiting to run, that idle is
+    changed to call function with the new arguments instead of adding a new
+    one.
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs,
+                                        priority=priority,
+                                        coalesce_key=coalesce_key)
     _eventloop.wakeup()
     return dc
 
@@ -476,13 +1331,27 @@ def add_urgent_call(function, name, args=None, kwargs=None):
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
+    Returns a ``ThreadPoolTask`` object that can be used to cancel the
+    call.
+
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
     """
-    _eventloop.call_in_thread(
+    return _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_lane(lane, callback, errback, function, name, *args, **kwargs):
+    """Like call_in_thread(), but run function in a specific thread pool
+    lane (LANE_DNS, LANE_IO, LANE_CPU or LANE_DEFAULT).
+    """
+    return _eventloop.call_in_lane(
+        lane, callback, errback, function, name, *args, **kwargs)
+
+def thread_pool_stats():
+    """Get a string describing the state of the thread pool."""
+    return _eventloop.threadpool.stats()
+
 lt = None
 
 profile_file = None
@@ -68,7 +68,7 @@ from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
-from miro.item import FeedParserValues
+from miro.item import FeedParserValues, FEED_VIEW_COLUMNS
 from miro import searchengines
 from miro import workerprocess
 from miro.clock import clock
@@ -538,7 +538,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.wasUpdating = is_updating
 
     def calc_item_list(self):
-        self.items = models.Item.feed_view(self.id)
+        self.items = models.Item.feed_view(self.id,
+                                           columns=FEED_VIEW_COLUMNS)
         self.visible_items = models.Item.visible_feed_view(self.id)
         self.downloaded_items = models.Item.feed_downloaded_view(self.id)
         self.downloading_items = models.Item.feed_downloading_view(self.id)
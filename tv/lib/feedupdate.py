@@ -72,7 +72,8 @@ class FeedUpdateQueue(object):
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
-        eventloop.add_idle(self.run_update_queue, 'run feed update queue')
+        eventloop.add_idle(self.run_update_queue, 'run feed update queue',
+                           coalesce_key='run feed update queue')
 
     def run_update_queue(self):
         while (len(self.update_queue) > 0 and 
@@ -241,11 +241,15 @@ def delete(path, retry_after=10, retry_for=60, firsttime=True):
                     "Delete File Retry", args=(path, retry_after,
                         retry_for - retry_after, False))
             if firsttime:
-                from miro.workerprocess import _subprocess_manager
-                if _subprocess_manager.is_running:
-                    logging.debug('restarting subprocess_manager to hopefully '
-                                  'free file references')
-                    _subprocess_manager.restart(clean=True)
+                from miro.workerprocess import (_subprocess_manager,
+                                                _movie_data_manager)
+                # the movie data workers are the most likely to have video
+                # files open
+                for manager in (_subprocess_manager, _movie_data_manager):
+                    if manager.is_running:
+                        logging.debug('restarting worker processes to '
+                                      'hopefully free file references')
+                        manager.restart(clean=True)
 
     else:
         deletes_in_progress.discard(path)
@@ -1033,7 +1033,9 @@ class Application:
         dialogs.show_about()
 
     def diagnostics(self):
-        diagnostics.run_dialog()
+        # get the event loop stats first, then show the dialog in
+        # handle_event_loop_stats()
+        messages.QueryEventLoopStats().send_to_backend()
 
     def setup_profile_message(self):
         """Devel method: save profile time for a frontend message."""
@@ -1730,6 +1732,9 @@ class WidgetsMessageHandler(messages.MessageHandler):
     def handle_set_net_lookup_enabled_finished(self, message):
         prefpanel.enable_net_lookup_buttons()
 
+    def handle_event_loop_stats(self, message):
+        diagnostics.run_dialog(message.stats)
+
     def handle_net_lookup_counts(self, message):
         prefpanel.update_net_lookup_counts(message.net_lookup_count,
                                            message.total_count)
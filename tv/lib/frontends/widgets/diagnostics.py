@@ -46,6 +46,8 @@ from miro.frontends.widgets.dialogs import MainDialog
 from miro.dialogs import BUTTON_OK
 
 from miro import app
+from miro import eventloop
+from miro import messages
 from miro import prefs
 from miro import util
 
@@ -76,6 +78,48 @@ def get_database_object_count():
     # should be a read-only endeavor, so it should be ok.
     return app.db.persistent_object_count()
 
+def save_event_loop_stats(widget):
+    log_dir = os.path.dirname(app.config.get(prefs.LOG_PATHNAME))
+    path = os.path.join(log_dir, 'eventloop-stats.json')
+    messages.SaveEventLoopStats(path).send_to_backend()
+
+# how many callbacks to list in the event loop section
+EVENT_LOOP_CALLBACKS_TO_SHOW = 5
+
+def event_loop_stats_items(stats):
+    """Build the diagnostics items for the event loop profiling stats.
+
+    :param stats: dict from an EventLoopStats message, or None
+    """
+    if stats is None:
+        return [{"label": _("Event loop profiling:"),
+                 "data": _("Disabled")}]
+    if stats['queue_depths']:
+        max_depth = max(sample['idle'] for sample in stats['queue_depths'])
+    else:
+        max_depth = 0
+    items = [
+        {"label": _("Event loop profiling:"),
+         "data": _("%(seconds)d seconds",
+                   {"seconds": stats['elapsed_time']}),
+         "button_face": _("Save"),
+         "button_fun": save_event_loop_stats},
+        {"label": _("Max idle queue depth:"),
+         "data": "%d" % max_depth},
+        {"label": _("Slowest callbacks:"),
+         "data": ""},
+    ]
+    for info in stats['callbacks'][:EVENT_LOOP_CALLBACKS_TO_SHOW]:
+        items.append({
+            "label": "",
+            "data": ("%s (%s): %d calls, %0.1f ms total, %0.1f ms max, "
+                     "%0.1f ms max wait" % (
+                         info['name'], info['kind'], info['count'],
+                         info['total_run_time'] * 1000,
+                         info['max_run_time'] * 1000,
+                         info['max_wait_time'] * 1000))})
+    return items
+
 SEPARATOR = None
 SHOW = _("Show")
 
@@ -84,9 +128,11 @@ SHOW = _("Show")
 # Note for data that changes over time, stick the calculation in a lambda so
 # that the diagnostics dialog shows the most recent calculation.
 
-def run_dialog():
+def run_dialog(event_loop_stats=None):
     """Displays a diagnostics windows that tells a user how Miro is set
     up on their machine.
+
+    :param event_loop_stats: stats from an EventLoopStats message
     """
     window = MainDialog(_("Diagnostics"))
     try:
@@ -130,6 +176,10 @@ def run_dialog():
                  get_database_size(), "0B", False)},
             {"label": _("Total db objects in memory:"),
              "data": lambda: "%d" % get_database_object_count()},
+            {"label": _("Event loop timeouts:"),
+             "data": lambda: eventloop.scheduler_stats()},
+            {"label": _("Thread pool:"),
+             "data": lambda: eventloop.thread_pool_stats()},
 
             SEPARATOR,
 
@@ -138,8 +188,11 @@ def run_dialog():
              "button_face": _("%(databasecount)s: Delete",
                               {"databasecount": len(
                                   app.db.get_backup_databases())}),
-             "button_fun": delete_backups}
+             "button_fun": delete_backups},
+
+            SEPARATOR,
             ]
+        items.extend(event_loop_stats_items(event_loop_stats))
 
         t = widgetset.Table(3, len(items))
         t.set_column_spacing(10)
@@ -312,6 +312,20 @@ class MiroTreeView(gtk.TreeView, TreeViewScrolling):
             event.window.draw_line(gc, x1, y, x2, y)
         if self.group_lines_enabled and event.window == self.get_bin_window():
             self.draw_group_lines(event)
+        self.update_visible_range()
+
+    def update_visible_range(self):
+        """Tell our ItemList which rows are visible so that it can prefetch
+        them.
+        """
+        modelwrapper = wrappermap.wrapper(self).model
+        if not isinstance(modelwrapper, ItemListModel):
+            return
+        visible_range = self.get_visible_range()
+        if visible_range is None:
+            return
+        start, end = visible_range
+        modelwrapper.item_list.set_visible_range(start[0], end[0])
 
     def draw_group_lines(self, expose_event):
         # we need both the GTK TreeModel and the ItemList for this one
@@ -1676,10 +1690,11 @@ class ItemListModel(TableModelBase):
             self.item_list.disconnect(self.list_changed_handle)
             self.list_changed_handle = None
 
-    def on_list_changed(self, item_list):
+    def on_list_changed(self, item_list, changes):
         # When the list changes, we need to create a new FixedListStore object
         # to handle it.  ItemListModelHandler then updates the GtkTreeView
-        # with this new model.
+        # with this new model.  FixedListStore can't insert or remove rows,
+        # so we do this even if changes tells us exactly what changed.
         self._model = fixedliststore.FixedListStore(len(item_list))
 
     def get_item(self, it):
@@ -39,6 +39,8 @@ in the interface.
 import collections
 
 from miro import app
+from miro import messages
+from miro import prefs
 from miro.data import item
 from miro.data import itemtrack
 from miro.frontends.widgets import itemfilter
@@ -56,7 +58,7 @@ class ItemList(itemtrack.ItemTracker):
             - set_sort changes the sort
     """
     def __init__(self, tab_type, tab_id, sort=None, group_func=None,
-                 filters=None, search_text=None):
+                 filters=None, search_text=None, item_info_cache=None):
         """Create a new ItemList
 
         Note: outside classes shouldn't call this directly.  Instead, they
@@ -68,6 +70,7 @@ class ItemList(itemtrack.ItemTracker):
         :param group_func: initial grouping to use
         :param filters: initial filters
         :param search_text: initial search text
+        :param item_info_cache: ItemInfoCache to share with other lists
         """
         self.tab_type = tab_type
         self.tab_id = tab_id
@@ -82,9 +85,17 @@ class ItemList(itemtrack.ItemTracker):
             self.sorter = sort
         self.search_text = search_text
         self.group_func = group_func
+        background_fetch_limit = app.config.get(
+            prefs.ITEM_LIST_BACKGROUND_FETCH_LIMIT)
+        if not background_fetch_limit:
+            background_fetch_limit = None
+        # item ids we last sent in SetMetadataPriorityItems
+        self._metadata_priority_ids = None
         itemtrack.ItemTracker.__init__(self, call_on_ui_thread,
                                        self._make_query(),
-                                       self._make_item_source())
+                                       self._make_item_source(),
+                                       item_info_cache,
+                                       background_fetch_limit)
 
     def is_for_device(self):
         return self.tab_type.startswith('device-')
@@ -107,6 +118,30 @@ class ItemList(itemtrack.ItemTracker):
     def _fetch_id_list(self):
         itemtrack.ItemTracker._fetch_id_list(self)
         self._reset_group_info()
+        self._send_metadata_priority_items()
+
+    def _id_list_updated(self):
+        self._reset_group_info()
+        self._send_metadata_priority_items()
+
+    def set_visible_range(self, first_row, last_row):
+        itemtrack.ItemTracker.set_visible_range(self, first_row, last_row)
+        self._send_metadata_priority_items()
+
+    def _send_metadata_priority_items(self):
+        """Have the backend extract metadata for our visible rows first.
+
+        We send a message whenever the items in the visible range change,
+        either because the user scrolled or because the list changed.
+        """
+        if (self.visible_range is None or self.id_list is None or
+                self.is_for_device() or self.is_for_share()):
+            return
+        first_row, last_row = self.visible_range
+        item_ids = self.id_list[max(first_row, 0):last_row + 1]
+        if item_ids != self._metadata_priority_ids:
+            self._metadata_priority_ids = item_ids
+            messages.SetMetadataPriorityItems(item_ids).send_to_backend()
 
     def _make_base_query(self, tab_type, tab_id):
         if self.is_for_device():
@@ -185,8 +220,10 @@ class ItemList(itemtrack.ItemTracker):
             # for the manual tab, tab_id is a list of ids to play
             id_list = tab_id
             placeholders = ",".join("?" for i in xrange(len(id_list)))
-            sql = "item.id IN (%s)" % placeholders
-            query.add_complex_condition('item.id', sql, id_list)
+            sql = "%s.id IN (%s)" % (query.table_name(), placeholders)
+            # "id" rather than "item.id", since the item table is the one
+            # we select from, not one we can join to.
+            query.add_complex_condition('id', sql, id_list)
         else:
             raise ValueError("Can't handle tab (%r, %r)" % (tab_type, tab_id))
         return query
@@ -322,10 +359,15 @@ class ItemListPool(object):
     want changes to the item list to be shared.  For example, if a user is
     playing items from a given tab and they change the filters on that tab, we
     want the PlaybackPlaylist to reflect those changes.
+
+    All lists in the pool share an ItemInfoCache, so an item that's in
+    several lists only gets fetched once.  The pool invalidates the cache
+    when it gets ItemChanges messages.
     """
     def __init__(self):
         self.all_item_lists = set()
         self._refcounts = {}
+        self.item_info_cache = itemtrack.ItemInfoCache()
 
     def get(self, tab_type, tab_id, sort=None, group_func=None, filters=None,
            search_text=None):
@@ -347,7 +389,7 @@ class ItemListPool(object):
                     return obj
         # no existing list found, make new list
         new_list = ItemList(tab_type, tab_id, sort, group_func, filters,
-                            search_text)
+                            search_text, self.item_info_cache)
         self.all_item_lists.add(new_list)
         self._refcounts[new_list] = 1
         return new_list
@@ -376,27 +418,53 @@ class ItemListPool(object):
         if self._refcounts[item_list] <= 0:
             self.all_item_lists.remove(item_list)
             del self._refcounts[item_list]
+            source_key = item_list.item_source.cache_key()
             item_list.destroy()
+            if item_list.is_for_device() or item_list.is_for_share():
+                # We only handle change messages for devices and shares that
+                # we have lists for, so we can't keep their items cached
+                # once the last list is gone.
+                if not self._lists_for_source(source_key):
+                    self.item_info_cache.invalidate_source(source_key)
+
+    def _lists_for_source(self, source_key):
+        return [l for l in self.all_item_lists
+                if l.item_source.cache_key() == source_key]
+
+    def _invalidate_cache(self, source_keys, message):
+        changed_ids = list(message.changed) + list(message.removed)
+        for source_key in source_keys:
+            self.item_info_cache.invalidate(source_key, changed_ids)
 
     def on_item_changes(self, message):
         """Call on_item_changes for each ItemList in the pool."""
-        for item_list in self.all_item_lists:
-            if not (item_list.is_for_device() or item_list.is_for_share()):
-                item_list.on_item_changes(message)
+        item_lists = [l for l in self.all_item_lists
+                      if not (l.is_for_device() or l.is_for_share())]
+        # invalidate the main database items even if there aren't any lists
+        # for it right now.
+        self._invalidate_cache([item.ItemSource.MAIN_CACHE_KEY], message)
+        for item_list in item_lists:
+            item_list.on_item_changes(message)
 
     def on_device_item_changes(self, message):
         """Call on_item_changes for each ItemList in the pool."""
-        for item_list in self.all_item_lists:
-            if (item_list.is_for_device() and
-                item_list.device_id() == message.device_id):
-                item_list.on_item_changes(message)
+        item_lists = [l for l in self.all_item_lists
+                      if (l.is_for_device() and
+                          l.device_id() == message.device_id)]
+        self._invalidate_cache(set(l.item_source.cache_key()
+                                   for l in item_lists), message)
+        for item_list in item_lists:
+            item_list.on_item_changes(message)
 
     def on_sharing_item_changes(self, message):
         """Call on_item_changes for each ItemList in the pool."""
-        for item_list in self.all_item_lists:
-            if (item_list.is_for_share() and
-                item_list.share_id() == message.share_id):
-                item_list.on_item_changes(message)
+        item_lists = [l for l in self.all_item_lists
+                      if (l.is_for_share() and
+                          l.share_id() == message.share_id)]
+        self._invalidate_cache(set(l.item_source.cache_key()
+                                   for l in item_lists), message)
+        for item_list in item_lists:
+            item_list.on_item_changes(message)
 
 # grouping functions
 def album_grouping(info):
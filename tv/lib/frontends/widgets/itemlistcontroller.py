@@ -1034,7 +1034,7 @@ class ItemListController(object):
         self.handle_item_list_changes()
         self.on_items_changed()
 
-    def handle_list_changed(self, item_list):
+    def handle_list_changed(self, item_list, changes):
         self.handle_item_list_changes()
         self.on_items_changed()
 
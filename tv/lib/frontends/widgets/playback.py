@@ -949,7 +949,7 @@ class PlaybackPlaylist(signals.SignalEmitter):
             # was actually changed.
             self.handle_changes()
 
-    def _on_list_changed(self, item_list):
+    def _on_list_changed(self, item_list, changes):
         self.handle_changes()
 
     def handle_changes(self):
@@ -0,0 +1,380 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.httpcache`` -- Disk cache for responses fetched with grab_url().
+
+Lots of things fetch the same URLs over and over: guide pages, flash scraper
+pages, echonest/7digital lookups, etc.  HTTPCache stores the responses to
+those requests in the support directory and follows the usual HTTP rules to
+decide when we can use them:
+
+    - If the response is still fresh (Cache-Control max-age, Expires or a
+      heuristic based on Last-Modified), we use it without touching the
+      network.
+    - If it's stale but has an ETag or Last-Modified header, we send a
+      conditional GET.  If the server answers with 304, we use the cached
+      body.
+    - Otherwise we fetch it again.
+
+The cache has a size limit.  When we go over it, we throw out the least
+recently used entries.
+
+HTTPCache should only be used inside the LibCURLManager thread.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import rfc822
+import time
+
+from miro import app
+from miro import fileutil
+from miro import prefs
+
+# max time a response without explicit freshness info is considered fresh
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+# don't store responses that would take up more than this fraction of the
+# cache
+MAX_ENTRY_FRACTION = 0.125
+# headers that shouldn't be copied over from a 304 response
+_NOT_UPDATED_BY_304 = set(['content-length', 'content-encoding',
+    'content-type', 'transfer-encoding'])
+
+def parse_cache_control(value):
+    """Parse a Cache-Control header.
+
+    :returns: dict mapping directive names to their values (or None for
+        directives without a value)
+    """
+    directives = {}
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            name, arg = part.split('=', 1)
+            directives[name.strip().lower()] = arg.strip().strip('"')
+        else:
+            directives[part.lower()] = None
+    return directives
+
+def _parse_http_date(value):
+    if value is None:
+        return None
+    parsed = rfc822.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return rfc822.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def calc_expiration(headers, now):
+    """Calculate when a response stops being fresh.
+
+    :param headers: dict of response headers (with lower-case keys)
+    :param now: time the response was received
+    :returns: expiration time, or None if the response can't be stored
+    """
+    cache_control = parse_cache_control(headers.get('cache-control', ''))
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return now
+    if cache_control.get('max-age') is not None:
+        try:
+            return now + max(0, int(cache_control['max-age']))
+        except ValueError:
+            return now
+    date = _parse_http_date(headers.get('date'))
+    if date is None:
+        date = now
+    if 'expires' in headers:
+        expires = _parse_http_date(headers['expires'])
+        if expires is None:
+            # invalid dates mean "already expired"
+            return now
+        return now + max(0, expires - date)
+    last_modified = _parse_http_date(headers.get('last-modified'))
+    if last_modified is not None and last_modified < date:
+        # heuristic freshness (RFC 2616 13.2.4): 10% of the time since the
+        # resource was last modified
+        return now + min((date - last_modified) / 10,
+                         MAX_HEURISTIC_FRESHNESS)
+    return now
+
+class CacheEntry(object):
+    """A response stored in the HTTPCache.
+
+    Attributes:
+        url -- URL the response was for
+        info -- info dict that we passed to the grab_url() callback
+        expires -- time when the response is no longer fresh
+    """
+    def __init__(self, url, info, expires):
+        self.url = url
+        self.info = info
+        self.expires = expires
+
+    def is_fresh(self, now=None):
+        if now is None:
+            now = time.time()
+        return now < self.expires
+
+    def etag(self):
+        return self.info.get('etag')
+
+    def last_modified(self):
+        return self.info.get('last-modified')
+
+    def can_revalidate(self):
+        return self.etag() is not None or self.last_modified() is not None
+
+    def make_info(self):
+        """Make an info dict to pass to a grab_url() callback."""
+        info = self.info.copy()
+        info['from-cache'] = True
+        return info
+
+class HTTPCache(object):
+    """Disk-backed HTTP response cache.
+
+    Each entry is stored in a separate file named after the SHA1 of its URL.
+    We keep the size and last use time of each file in memory to handle the
+    LRU size limit, but only read the files themselves when they are looked
+    up.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        # maps keys to [size, last used time].  We load this lazily, since
+        # HTTPCache gets created in the main thread, but used in the curl
+        # thread.
+        self.entries = None
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+
+    def _ensure_loaded(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        self.total_size = 0
+        if not fileutil.exists(self.directory):
+            fileutil.makedirs(self.directory)
+            return
+        for name in fileutil.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                # left over from a crash while storing
+                self._remove_file(path)
+                continue
+            if not name.endswith('.cache'):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self.entries[name[:-len('.cache')]] = [st.st_size, st.st_mtime]
+            self.total_size += st.st_size
+
+    def _key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def _remove_file(self, path):
+        try:
+            fileutil.remove(path)
+        except OSError:
+            pass
+
+    def lookup(self, url):
+        """Find the entry for url.
+
+        :returns: CacheEntry or None
+        """
+        self._ensure_loaded()
+        key = self._key(url)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            f = fileutil.open_file(path, 'rb')
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+            entry = CacheEntry(data['url'], data['info'], data['expires'])
+        except (IOError, EOFError, cPickle.UnpicklingError, KeyError,
+                TypeError, AttributeError, ValueError), e:
+            logging.warn("error reading HTTP cache entry for %s: %s", url, e)
+            self._remove_entry(key)
+            self.misses += 1
+            return None
+        if entry.url != url:
+            # hash collision
+            self.misses += 1
+            return None
+        self.entries[key][1] = time.time()
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def store(self, url, info, now=None):
+        """Store a response.
+
+        :param url: URL that we requested
+        :param info: info dict for the response
+        :returns: True if the response was stored
+        """
+        if now is None:
+            now = time.time()
+        expires = calc_expiration(info, now)
+        if expires is None:
+            return False
+        # httpclient has already decoded the body
+        info = info.copy()
+        info.pop('content-encoding', None)
+        entry = CacheEntry(url, info, expires)
+        if not entry.is_fresh(now) and not entry.can_revalidate():
+            # we would never be able to use this
+            return False
+        return self._write_entry(entry)
+
+    def refresh(self, entry, headers, now=None):
+        """Update an entry after the server sent a 304 response for it.
+
+        :param entry: CacheEntry that we revalidated
+        :param headers: headers from the 304 response
+        """
+        if now is None:
+            now = time.time()
+        self.revalidated += 1
+        for key, value in headers.iteritems():
+            if key not in _NOT_UPDATED_BY_304:
+                entry.info[key] = value
+        expires = calc_expiration(entry.info, now)
+        if expires is None:
+            self.remove(entry.url)
+            return
+        entry.expires = expires
+        self._write_entry(entry)
+
+    def _write_entry(self, entry):
+        self._ensure_loaded()
+        data = cPickle.dumps({'url': entry.url, 'info': entry.info,
+            'expires': entry.expires}, cPickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size * MAX_ENTRY_FRACTION:
+            return False
+        key = self._key(entry.url)
+        path = self._path(key)
+        temp_path = path + '.tmp'
+        try:
+            f = fileutil.open_file(temp_path, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if fileutil.exists(path):
+                # windows can't rename on top of an existing file
+                fileutil.remove(path)
+            fileutil.rename(temp_path, path)
+        except (IOError, OSError), e:
+            logging.warn("error writing HTTP cache entry for %s: %s",
+                         entry.url, e)
+            self._remove_file(temp_path)
+            self._forget(key)
+            return False
+        self._forget(key)
+        self.entries[key] = [len(data), time.time()]
+        self.total_size += len(data)
+        self._evict()
+        return True
+
+    def _forget(self, key):
+        if key in self.entries:
+            self.total_size -= self.entries.pop(key)[0]
+
+    def _remove_entry(self, key):
+        self._forget(key)
+        self._remove_file(self._path(key))
+
+    def remove(self, url):
+        self._ensure_loaded()
+        self._remove_entry(self._key(url))
+
+    def _evict(self):
+        if self.total_size <= self.max_size:
+            return
+        by_last_use = sorted(self.entries.items(),
+                             key=lambda (key, data): data[1])
+        for key, (size, last_used) in by_last_use:
+            if self.total_size <= self.max_size:
+                break
+            self._remove_entry(key)
+            self.evicted += 1
+
+    def clear(self):
+        self._ensure_loaded()
+        for key in self.entries.keys():
+            self._remove_entry(key)
+
+    def stats(self):
+        if self.entries is None:
+            return "not loaded"
+        return ("%d entries (%d KB), %d hits, %d misses, %d revalidated, "
+                "%d evicted" % (len(self.entries), self.total_size // 1024,
+                    self.hits, self.misses, self.revalidated, self.evicted))
+
+http_cache = None
+
+def init():
+    """Create the HTTPCache that grab_url() uses.
+
+    If this isn't called (for example in the downloader process), grab_url()
+    doesn't use a cache.
+    """
+    global http_cache
+    max_size = app.config.get(prefs.HTTP_CACHE_SIZE)
+    if max_size <= 0:
+        http_cache = None
+        return
+    directory = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                             'http-cache')
+    http_cache = HTTPCache(directory, max_size)
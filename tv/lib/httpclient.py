@@ -35,6 +35,7 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import collections
 import logging
 import os
 import stat
@@ -50,10 +51,12 @@ from miro import download_utils
 from miro import eventloop
 from miro import fileutil
 from miro import httpauth
+from miro import httpcache
 from miro import net
 from miro import prefs
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
 from miro.plat import utils
@@ -239,9 +242,12 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
+    def build_handle(self, out_headers, handle=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: pycurl.Curl object to set up.  If None we create a new
+            one.
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
@@ -250,13 +256,14 @@ class TransferOptions(object):
         if self.extra_headers is not None:
             out_headers.update(self.extra_headers)
 
-        handle = self._init_handle()
+        handle = self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle=None):
+        if handle is None:
+            handle = pycurl.Curl()
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -366,6 +373,8 @@ class CurlTransfer(object):
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        self.saw_activity = False
+        self.cache_entry = None
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -455,18 +464,30 @@ class CurlTransfer(object):
                 self.proxy_auth = auth
             self._send_new_request()
 
-    def build_handle(self):
+    def build_handle(self, handle=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: pycurl.Curl object to use, normally one from the
+            LibCURLManager's CurlHandlePool.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        if self.cache_entry is not None:
+            # revalidate our cached response
+            if self.cache_entry.etag() is not None:
+                self.out_headers['If-None-Match'] = self.cache_entry.etag()
+            if self.cache_entry.last_modified() is not None:
+                self.out_headers['If-Modified-Since'] = \
+                        self.cache_entry.last_modified()
+        self.handle = self.options.build_handle(self.out_headers, handle)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
         self._setup_http_auth()
         self._setup_proxy_auth()
+        # _write_func calls _write_target after noting the activity
+        self._write_target = None
         if self.options._cancel_on_body_data:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
+            self._write_target = self._write_func_abort
         elif self.options.write_file is not None:
             if not self.saw_head_success:
                 # try a HEAD request first to see if the request will work.
@@ -477,17 +498,77 @@ class CurlTransfer(object):
             else:
                 self.handle.setopt(pycurl.URL, self.last_url)
                 self._open_file()
-                self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
+                self._write_target = self._write_file
         elif self.content_check_callback is not None:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
+            self._write_target = self._call_content_check
         else:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
+            self._write_target = self.buffer.write
+        if self._write_target is not None:
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
         if self.should_debug_request():
             logging.warn("debugging request: %s", self.options.url)
             self.handle.setopt(pycurl.VERBOSE, 1)
             self.handle.setopt(pycurl.DEBUGFUNCTION, self.debug_func)
 
+    def _can_use_cache(self):
+        options = self.options
+        return (httpcache.http_cache is not None and
+                options.post_vars is None and options.post_files is None and
+                options.write_file is None and not options.resume and
+                options.etag is None and options.modified is None and
+                options.extra_headers is None and
+                not options.head_request and
+                not options._cancel_on_body_data and
+                self.header_callback is None and
+                self.content_check_callback is None and
+                self.http_auth is None)
+
+    def check_cache(self):
+        """Check if we can handle this transfer with the HTTPCache.  This
+        should only be called inside the LibCURLManager thread.
+
+        If we have a fresh response cached, we call the callback with it.  If
+        we have a stale one, we remember it so that build_handle() sends a
+        conditional request.
+
+        :returns: True if we used a cached response and don't need to make a
+            request
+        """
+        self.cache_entry = None
+        if not self._can_use_cache():
+            return False
+        entry = httpcache.http_cache.lookup(self.options.url)
+        if entry is None:
+            return False
+        if entry.is_fresh():
+            self.call_callback(entry.make_info())
+            return True
+        if entry.can_revalidate():
+            self.cache_entry = entry
+        return False
+
+    def _update_cache(self, info):
+        """Update the HTTPCache after a transfer finishes.
+
+        :returns: info dict to pass to our callback
+        """
+        if self.cache_entry is not None and info['status'] == 304:
+            httpcache.http_cache.refresh(self.cache_entry, self.headers)
+            return self.cache_entry.make_info()
+        if info['status'] == 200 and self._can_use_cache():
+            httpcache.http_cache.store(self.options.url, info)
+        return info
+
+    def _note_activity(self):
+        if not self.saw_activity:
+            self.saw_activity = True
+            curl_manager.note_transfer_activity(self)
+
+    def _write_func(self, data):
+        self._note_activity()
+        return self._write_target(data)
+
     def _write_file(self, buf):
         if self.check_response_code(self.status_code):
             self._filehandle.write(buf)
@@ -572,6 +653,7 @@ class CurlTransfer(object):
 
 
     def header_func(self, line):
+        self._note_activity()
         line = line.strip()
         if line.startswith("HTTP"):
             # we can't use self.header.getinfo() because we're inside the
@@ -633,7 +715,8 @@ class CurlTransfer(object):
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
-        if self.options.etag or self.options.modified:
+        if (self.options.etag or self.options.modified or
+                self.cache_entry is not None):
             expected_codes.add(304)
         return code in expected_codes
 
@@ -673,6 +756,7 @@ class CurlTransfer(object):
                                     "gzip, but content is not gzip encoded")
             else:
                 info['body'] = self.buffer.getvalue()
+            info = self._update_cache(info)
 
         if self.check_response_code(info['status']):
             if not self.trying_head_request:
@@ -858,6 +942,98 @@ class TransferStats(object):
         self.initial_size = 0
         self.status_code = None
 
+class CurlHandlePool(object):
+    """Keeps finished pycurl.Curl handles around so they can be reused.
+
+    libcurl keeps a connection cache for each easy handle, so reusing a
+    handle for the same host lets us reuse its keep-alive connection instead
+    of connecting (and doing the TLS handshake) again.  All handles we give
+    out are also attached to a CurlShare object, which shares the DNS cache
+    and the SSL session cache between them.
+
+    This should only be used inside the LibCURLManager thread.
+    """
+    # max number of idle handles we keep for a single host
+    MAX_IDLE_PER_HOST = 4
+    # max number of idle handles we keep total
+    MAX_IDLE = 32
+
+    def __init__(self):
+        self.share = self._make_share()
+        # maps hosts to lists of idle handles
+        self.idle_handles = {}
+        self.idle_count = 0
+        self.created_count = 0
+        self.reused_count = 0
+
+    def _make_share(self):
+        try:
+            share = pycurl.CurlShare()
+        except AttributeError:
+            # pycurl is too old to support sharing
+            return None
+        for name in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION'):
+            lock_data = getattr(pycurl, name, None)
+            if lock_data is None:
+                continue
+            try:
+                share.setopt(pycurl.SH_SHARE, lock_data)
+            except pycurl.error:
+                logging.warn("CurlShare doesn't support %s", name)
+        return share
+
+    def get_handle(self, host):
+        """Get a handle to use for a transfer to host.
+
+        If we have an idle handle for host, we return that, otherwise we
+        create a new one.
+        """
+        handles = self.idle_handles.get(host)
+        if handles:
+            handle = handles.pop()
+            if not handles:
+                del self.idle_handles[host]
+            self.idle_count -= 1
+            self.reused_count += 1
+        else:
+            handle = pycurl.Curl()
+            self.created_count += 1
+            # reset() doesn't detach a handle from its share, and setting
+            # SHARE a second time raises an error, so only do it here.
+            if self.share is not None:
+                handle.setopt(pycurl.SHARE, self.share)
+        return handle
+
+    def release_handle(self, host, handle):
+        """Give back a handle from get_handle().
+
+        The handle must not be in use by a CurlMulti object anymore.  If we
+        have room, we reset its options and keep it for the next transfer to
+        host.  Otherwise we close it.
+        """
+        handles = self.idle_handles.get(host, [])
+        if (len(handles) >= self.MAX_IDLE_PER_HOST or
+                self.idle_count >= self.MAX_IDLE or
+                not hasattr(handle, 'reset')):
+            handle.close()
+            return
+        # reset() clears the options and callbacks we set, but keeps the
+        # connection cache.
+        handle.reset()
+        handles.append(handle)
+        self.idle_handles[host] = handles
+        self.idle_count += 1
+
+    def close(self):
+        for handles in self.idle_handles.values():
+            for handle in handles:
+                handle.close()
+        self.idle_handles = {}
+        self.idle_count = 0
+        if self.share is not None:
+            self.share.close()
+            self.share = None
+
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
 
@@ -866,12 +1042,34 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Reuses curl handles (and their connections) using a CurlHandlePool
+      - Limits the number of transfers running for each host.  Transfers
+        over the limit wait in a queue until another transfer to that host
+        finishes.
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        # We use the multi socket API.  libcurl tells us which sockets to
+        # watch and when to call it for timeouts, so we only do work for
+        # transfers that have something to do.
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket_callback)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._timer_callback)
+        self.poller = eventloop.make_poller()
+        self.poller.add_reader(self.wake_receiver.fileno())
+        # maps sockets to the pycurl.POLL_* value libcurl wants for them
+        self.socket_events = {}
+        # when libcurl wants us to call socket_action() with SOCKET_TIMEOUT
+        self.timer_deadline = None
+        # transfers that read/wrote data since we last updated stats
+        self.active_transfers = []
         self.transfer_map = {}
+        self.handle_pool = CurlHandlePool()
+        # maps hosts to the number of transfers we're running for them
+        self.host_transfer_counts = {}
+        # maps hosts to deques of transfers waiting for a free slot
+        self.waiting_transfers = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
         self.after_perform_callbacks = []
@@ -893,6 +1091,8 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
         self.multi.close()
+        self.handle_pool.close()
+        self.poller.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -905,34 +1105,80 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
-    def calc_fds(self):
-        return self.multi.fdset()
+    def note_transfer_activity(self, transfer):
+        """Called by CurlTransfer when it reads or writes data."""
+        self.active_transfers.append(transfer)
 
-    def calc_timeout(self):
-        timeout = self.multi.timeout()
-        if timeout < 0:
-            # libcurl documentation says this means to wait "not too long"
-            # Let's try 2 seconds
-            return 2.0
+    def _socket_callback(self, what, sock_fd, multi, socketp):
+        old_what = self.socket_events.get(sock_fd, pycurl.POLL_REMOVE)
+        if what == pycurl.POLL_REMOVE:
+            self.socket_events.pop(sock_fd, None)
+        else:
+            self.socket_events[sock_fd] = what
+        was_reading = old_what in (pycurl.POLL_IN, pycurl.POLL_INOUT)
+        was_writing = old_what in (pycurl.POLL_OUT, pycurl.POLL_INOUT)
+        reading = what in (pycurl.POLL_IN, pycurl.POLL_INOUT)
+        writing = what in (pycurl.POLL_OUT, pycurl.POLL_INOUT)
+        if reading and not was_reading:
+            self.poller.add_reader(sock_fd)
+        elif was_reading and not reading:
+            self.poller.remove_reader(sock_fd)
+        if writing and not was_writing:
+            self.poller.add_writer(sock_fd)
+        elif was_writing and not writing:
+            self.poller.remove_writer(sock_fd)
+
+    def _timer_callback(self, timeout_ms):
+        if timeout_ms < 0:
+            self.timer_deadline = None
         else:
-            return timeout / 1000.0
+            self.timer_deadline = clock() + timeout_ms / 1000.0
+
+    def calc_timeout(self):
+        if self.timer_deadline is None:
+            return None
+        return max(0, self.timer_deadline - clock())
+
+    def wait_for_events(self, timeout):
+        return self.poller.poll(timeout)
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
+        actions = {}
+        for fd in readfds:
+            actions[fd] = pycurl.CSELECT_IN
+        for fd in writefds:
+            actions[fd] = actions.get(fd, 0) | pycurl.CSELECT_OUT
+        for fd in excfds:
+            actions[fd] = actions.get(fd, 0) | pycurl.CSELECT_ERR
+        actions.pop(self.wake_receiver.fileno(), None)
+        for fd, ev_bitmask in actions.iteritems():
+            self._socket_action(fd, ev_bitmask)
+        if (self.timer_deadline is not None and
+                clock() >= self.timer_deadline):
+            self.timer_deadline = None
+            self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self.process_queues()
+        self.check_finished()
+
+    def _socket_action(self, fd, ev_bitmask):
         while True:
-            rv, num_handles = self.multi.perform()
+            rv, num_handles = self.multi.socket_action(fd, ev_bitmask)
             self.update_stats()
             for callback in self.after_perform_callbacks:
                 trap_call('after perform callback', callback)
             self.after_perform_callbacks = []
             if rv != pycurl.E_CALL_MULTI_PERFORM:
                 break
-        self.process_queues()
-        self.check_finished()
 
     def update_stats(self):
-        for transfer in self.transfer_map.values():
-            transfer.update_stats()
+        """Update stats for transfers that saw activity."""
+        active_transfers = self.active_transfers
+        self.active_transfers = []
+        for transfer in active_transfers:
+            transfer.saw_activity = False
+            if transfer.handle in self.transfer_map:
+                transfer.update_stats()
 
     def process_queues(self):
         while True:
@@ -940,38 +1186,116 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 transfer = self.transfers_to_add.get_nowait()
             except Queue.Empty:
                 break
-            try:
-                transfer.build_handle()
-            except NetworkError, e:
-                transfer.call_errback(e)
+            if transfer.check_cache():
                 continue
-            self.transfer_map[transfer.handle] = transfer
-            self.multi.add_handle(transfer.handle)
+            host = transfer.options.host
+            if self._host_has_free_slot(host):
+                self._start_transfer(transfer)
+            else:
+                self.waiting_transfers.setdefault(host,
+                        collections.deque()).append(transfer)
 
         while True:
             try:
                 transfer, remove_file = self.transfers_to_remove.get_nowait()
             except Queue.Empty:
                 break
+            waiting = self.waiting_transfers.get(transfer.options.host)
+            if waiting and transfer in waiting:
+                waiting.remove(transfer)
+                transfer.on_cancel(remove_file)
+                continue
             transfer.on_cancel(remove_file)
+            handle = transfer.handle
             try:
-                del self.transfer_map[transfer.handle]
+                del self.transfer_map[handle]
             except KeyError:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            self.multi.remove_handle(handle)
+            self._transfer_done(transfer, handle)
+
+    def _host_has_free_slot(self, host):
+        limit = app.config.get(prefs.HTTP_MAX_CONNECTIONS_PER_HOST)
+        return (limit <= 0 or
+                self.host_transfer_counts.get(host, 0) < limit)
+
+    def _start_transfer(self, transfer):
+        host = transfer.options.host
+        handle = None
+        try:
+            handle = self.handle_pool.get_handle(host)
+            transfer.build_handle(handle)
+        except NetworkError, e:
+            self.handle_pool.release_handle(host, handle)
+            transfer.call_errback(e)
+            return
+        except StandardError, e:
+            # Don't let one bad transfer take down the libcurl thread
+            logging.stacktrace("error starting transfer for %s" %
+                               transfer.options.url)
+            if handle is not None:
+                handle.close()
+            transfer.handle = None
+            transfer.call_errback(NetworkError(_("Unknown"), str(e)))
+            return
+        try:
+            self.multi.add_handle(handle)
+        except pycurl.error, e:
+            logging.stacktrace("error adding handle for %s" %
+                               transfer.options.url)
+            handle.close()
+            transfer.handle = None
+            transfer.call_errback(NetworkError(_("Unknown"), str(e)))
+            return
+        self.transfer_map[handle] = transfer
+        self.host_transfer_counts[host] = (
+                self.host_transfer_counts.get(host, 0) + 1)
+
+    def _transfer_done(self, transfer, handle):
+        """Call this once we're done using a transfer's handle.
+
+        We return the handle to our pool and start the next transfer waiting
+        for its host.
+        """
+        if transfer.handle is handle:
+            transfer.handle = None
+        host = transfer.options.host
+        self.handle_pool.release_handle(host, handle)
+        count = self.host_transfer_counts.get(host, 0) - 1
+        if count > 0:
+            self.host_transfer_counts[host] = count
+        else:
+            self.host_transfer_counts.pop(host, None)
+        waiting = self.waiting_transfers.get(host)
+        while waiting and self._host_has_free_slot(host):
+            self._start_transfer(waiting.popleft())
+        if not waiting:
+            self.waiting_transfers.pop(host, None)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
+            if handle not in self.transfer_map:
+                # we already removed the transfer (for example it was
+                # canceled)
+                continue
+            transfer = self.pop_transfer(handle)
             try:
-                self.pop_transfer(handle).on_finished()
+                # make sure the final stats are up-to-date
+                transfer.update_stats()
+                transfer.on_finished()
             except StandardError:
                 logging.stacktrace("Error calling on_finished()")
+            self._transfer_done(transfer, handle)
         for handle, code, message in errors:
+            if handle not in self.transfer_map:
+                continue
+            transfer = self.pop_transfer(handle)
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.stacktrace("Error calling on_error()")
+            self._transfer_done(transfer, handle)
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
@@ -1047,6 +1371,13 @@ def grab_url(url, callback, errback, header_callback=None,
             a permanent redirect or a temporary one.
         'filename': Name of the file that we should use to save the data
         'charset': Charset encoding of the data
+        'from-cache': True if the response came from the HTTP cache (only
+            present in that case)
+
+    If httpcache.init() has been called, GET requests without etag, modified,
+    write_file, extra headers or callbacks besides callback/errback use the
+    HTTP cache.  Fresh cached responses are used without making a request and
+    stale ones are revalidated with a conditional request.
 
     :returns HTTPClient object
     """
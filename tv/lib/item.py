@@ -70,6 +70,7 @@ from miro import signals
 from miro import search
 from miro import models
 from miro import metadata
+from miro import metadatacache
 
 _charset = locale.getpreferredencoding()
 
@@ -77,6 +78,19 @@ _charset = locale.getpreferredencoding()
 # DeviceItems so that older versions can read the device DB
 MDP_STATE_RAN = 1
 
+# Columns to load when iterating through a feed's items.  This leaves out
+# long text fields and metadata, which get loaded if they're accessed.
+FEED_VIEW_COLUMNS = (
+    'new', 'title', 'feed_id', 'downloader_id', 'parent_id',
+    'auto_downloaded', 'pending_manual_download', 'pending_reason', 'expired',
+    'keep', 'creation_time', 'link_number', 'icon_cache_id',
+    'downloaded_time', 'watched_time', 'last_watched', 'is_container_item',
+    'release_date', 'eligible_for_autodownload', 'duration', 'screenshot',
+    'resume_time', 'url', 'enclosure_size', 'enclosure_type',
+    'enclosure_format', 'was_downloaded', 'filename', 'deleted',
+    'short_filename', 'file_type', 'net_lookup_enabled',
+)
+
 def _check_for_image(path, element):
     """Given an element (which is really a dict), traverses
     the path in the element and if that turns out to be an image,
@@ -395,6 +409,10 @@ class ItemChangeTracker(object):
         self.dlstats_changed = False
 
     def after_event_finished(self, event_loop, success):
+        if app.db is not None and app.db.has_pending_commit():
+            # The frontend reads items from its own connection, so wait
+            # until the changes are committed before telling it about them.
+            return
         self.send_changes()
 
     def send_changes(self):
@@ -539,7 +557,10 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.expiring = None
         self.showMoreInfo = False
         self.playing = False
-        Item._path_count_tracker.add_item(self)
+        if not self.db_info.db.object_was_evicted(self):
+            # if we were evicted from memory, then we were already counted
+            # the first time we were restored.
+            Item._path_count_tracker.add_item(self)
 
     def after_setup_new(self):
         app.item_info_cache.item_created(self)
@@ -711,8 +732,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
                              joins={'feed': 'item.feed_id = feed.id'})
 
     @classmethod
-    def feed_view(cls, feed_id):
-        return cls.make_view('feed_id=?', (feed_id,))
+    def feed_view(cls, feed_id, columns=None):
+        return cls.make_view('feed_id=?', (feed_id,), columns=columns)
 
     @classmethod
     def visible_feed_view(cls, feed_id):
@@ -2829,7 +2850,8 @@ def setup_metadata_manager(cover_art_dir=None, screenshot_dir=None):
         icon_cache_dir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
         screenshot_dir = os.path.join(icon_cache_dir, 'extracted')
     app.local_metadata_manager = metadata.LibraryMetadataManager(
-        cover_art_dir, screenshot_dir)
+        cover_art_dir, screenshot_dir,
+        metadata_cache=metadatacache.metadata_cache)
     app.local_metadata_manager.connect('new-metadata', on_new_metadata)
 
 def setup_change_tracker():
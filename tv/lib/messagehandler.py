@@ -1990,6 +1990,16 @@ New ids: %s""", playlist_item_ids, message.item_ids)
     def handle_force_device_dbsave_error(self, message):
         app.device_manager.force_db_save_error(message.device_info)
 
+    def handle_query_event_loop_stats(self, message):
+        stats = eventloop.get_profile_stats()
+        messages.EventLoopStats(stats).send_to_frontend()
+
+    def handle_save_event_loop_stats(self, message):
+        try:
+            eventloop.dump_profile_stats(message.path)
+        except (ValueError, IOError, OSError), e:
+            logging.warn("error saving event loop stats: %s", e)
+
     def handle_set_net_lookup_enabled(self, message):
         paths = set()
         if message.item_ids is None:
@@ -2010,6 +2020,21 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         app.local_metadata_manager.set_net_lookup_enabled(paths,
                                                           message.enabled)
 
+    def handle_set_metadata_priority_items(self, message):
+        if app.local_metadata_manager is None:
+            return
+        paths = set()
+        for item_id in message.item_ids:
+            try:
+                i = item.Item.get_by_id(item_id)
+            except database.ObjectNotFoundError:
+                # the item was deleted since the frontend sent the message
+                continue
+            paths.add(i.get_filename())
+        # Remove any None values for items that aren't downloaded
+        paths.discard(None)
+        app.local_metadata_manager.set_priority_paths(paths)
+
     def handle_remove_echonest_data(self, message):
         paths = set()
         for item_id in message.item_ids:
@@ -925,6 +925,19 @@ class SetNetLookupEnabled(BackendMessage):
         self.item_ids = item_ids
         self.enabled = enabled
 
+class SetMetadataPriorityItems(BackendMessage):
+    """Tell the backend which items the user is looking at.
+
+    The backend extracts metadata for these items before other ones.
+    """
+    def __init__(self, item_ids):
+        """Create a new message
+
+        :param item_ids: list of item ids.  This replaces the item ids from
+                         previous SetMetadataPriorityItems messages.
+        """
+        self.item_ids = item_ids
+
 class ClogBackend(BackendMessage):
     """Dev message: intentionally clog the backend for a specified number of 
     seconds.
@@ -947,6 +960,15 @@ class ForceDeviceDBSaveError(BackendMessage):
     def __init__(self, device_info):
         self.device_info = device_info
 
+class QueryEventLoopStats(BackendMessage):
+    """Ask the backend to send an EventLoopStats message."""
+    pass
+
+class SaveEventLoopStats(BackendMessage):
+    """Dump the event loop profiling stats to a JSON file."""
+    def __init__(self, path):
+        self.path = path
+
 # Frontend Messages
 class DownloaderSyncCommandComplete(FrontendMessage):
     """Tell the frontend that the pause/resume all command are complete,
@@ -1920,6 +1942,15 @@ class SetNetLookupEnabledFinished(FrontendMessage):
     """The backend has processed the SetNetLookupEnabled message."""
     pass
 
+class EventLoopStats(FrontendMessage):
+    """Send the frontend timing info for the backend event loop.
+
+    stats is the dict returned by eventloop.get_profile_stats(), or None if
+    profiling isn't enabled.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
 class NetLookupCounts(FrontendMessage):
     """Update the frontend on how many items we're running net lookups for."""
     def __init__(self, net_lookup_count, total_count):
@@ -51,6 +51,7 @@ from miro import filetags
 from miro import filetypes
 from miro import fileutil
 from miro import messages
+from miro import metadatacache
 from miro import net
 from miro import prefs
 from miro import signals
@@ -88,6 +89,10 @@ class MetadataStatus(database.DDBObject):
 
     FINISHED_STATUS_VERSION = 1
 
+    # If we start the movie data program this many times for a file without
+    # it finishing (because it hung, crashed Miro, etc), we stop trying.
+    MAX_MOVIE_DATA_ATTEMPTS = 2
+
     _source_name_to_status_column = {
         u'mutagen': 'mutagen_status',
         u'movie-data': 'moviedata_status',
@@ -107,6 +112,11 @@ class MetadataStatus(database.DDBObject):
         self.mutagen_thinks_drm = False
         self.echonest_id = None
         self.max_entry_priority = -1
+        # moviedata_attempts counts how many times we've started the movie
+        # data program without it finishing.  moviedata_time is how long the
+        # last run took.
+        self.moviedata_attempts = 0
+        self.moviedata_time = None
         # current processor tracks what processor we should be running for
         # this status.  We don't save it to the database.
         self.current_processor = u'mutagen'
@@ -295,6 +305,33 @@ class MetadataStatus(database.DDBObject):
         self.signal_change()
         return new_status
 
+    def movie_data_started(self):
+        """Call this when a worker process starts movie data on our path."""
+        self.moviedata_attempts += 1
+        self.signal_change()
+
+    def movie_data_interrupted(self):
+        """Call this when we stop a movie data run ourselves.
+
+        This undoes the movie_data_started() call, since it's not the file's
+        fault that movie data didn't finish.
+        """
+        if self.moviedata_attempts > 0:
+            self.moviedata_attempts -= 1
+            self.signal_change()
+
+    def movie_data_finished(self, run_time):
+        """Record how long the movie data program took for our path.
+
+        This doesn't call signal_change(), it should be followed by a call to
+        update_after_success() or update_after_error().
+        """
+        self.moviedata_attempts = 0
+        self.moviedata_time = run_time
+
+    def should_skip_movie_data_run(self):
+        return self.moviedata_attempts >= self.MAX_MOVIE_DATA_ATTEMPTS
+
     def _set_current_processor(self, update_finished_status=True):
         """Calculate and set the current_processor attribute """
         # check what the next processor we should run is
@@ -334,6 +371,12 @@ class MetadataStatus(database.DDBObject):
                           values=(cls.FINISHED_STATUS_VERSION,),
                           db_info=db_info)
 
+    @classmethod
+    def was_running_view(cls, db_info=None):
+        return cls.make_view('finished_status < ?',
+                             values=(cls.FINISHED_STATUS_VERSION,),
+                             db_info=db_info)
+
 class MetadataEntry(database.DDBObject):
     """Stores metadata from a single source.
 
@@ -500,7 +543,9 @@ class _TaskProcessor(_MetadataProcessor):
                     del self._pending_tasks[path]
                 except KeyError:
                     pass
+        self._send_pending_tasks()
 
+    def _send_pending_tasks(self):
         while len(self._active_tasks) < self.limit and self._pending_tasks:
             path, task = self._pending_tasks.popitem()
             self._send_task(task)
@@ -532,6 +577,216 @@ class _TaskProcessor(_MetadataProcessor):
         self.emit('task-error', task.source_path, error)
         self.remove_task_for_path(task.source_path)
 
+class _BatchTaskProcessor(_TaskProcessor):
+    """Handle sending tasks to the worker process in batches.
+
+    Tasks are still sent right away if we're under our limit.  Tasks that get
+    queued up, either because we're at the limit or because they were added
+    with add_tasks(), get sent as batch tasks once there's room.  This cuts
+    down on the per-task overhead when we're adding lots of files.
+
+    Signals:
+
+    - batch-complete(results, errors) -- a batch task finished.  results is a
+      list of (path, result) tuples and errors is a list of (path, error)
+      tuples.
+    """
+
+    def __init__(self, source_name, limit, batch_size, make_batch_task):
+        """Create a _BatchTaskProcessor
+
+        :param source_name: name of our metadata source
+        :param limit: max number of paths to process at once
+        :param batch_size: max number of paths to put in a batch task
+        :param make_batch_task: function that takes a list of tasks and
+                                returns a batch task to process them.
+        """
+        _TaskProcessor.__init__(self, source_name, limit)
+        self.create_signal('batch-complete')
+        self.batch_size = batch_size
+        self.make_batch_task = make_batch_task
+
+    def add_tasks(self, tasks):
+        """Add a list of tasks to the queue.
+
+        This is more efficient than calling add_task() for each one, since
+        we will send the tasks in batches.
+        """
+        for task in tasks:
+            self._pending_tasks[task.source_path] = task
+        self._send_pending_tasks()
+
+    def _send_pending_tasks(self):
+        while len(self._active_tasks) < self.limit and self._pending_tasks:
+            count = min(self.limit - len(self._active_tasks),
+                        self.batch_size, len(self._pending_tasks))
+            tasks = [self._pending_tasks.popitem()[1]
+                     for i in xrange(count)]
+            if len(tasks) == 1:
+                self._send_task(tasks[0])
+            else:
+                self._send_batch(tasks)
+
+    def _send_batch(self, tasks):
+        for task in tasks:
+            self._active_tasks[task.source_path] = task
+        workerprocess.send(self.make_batch_task(tasks), self._batch_callback,
+                           self._batch_errback)
+
+    def _batch_callback(self, batch_task, results):
+        for path, result in results:
+            if isinstance(result, Exception):
+                logging.warn("Error running %s for %r: %s", self.source_name,
+                             path, result)
+        self._process_batch_results(results)
+
+    def _batch_errback(self, batch_task, error):
+        # the entire batch failed, use the error for each path
+        logging.warn("Error running %s: %s", batch_task, error)
+        self._process_batch_results([(path, error) for path in
+                                     batch_task.source_paths])
+
+    def _process_batch_results(self, results):
+        finished = []
+        errors = []
+        for path, result in results:
+            if path not in self._active_tasks:
+                logging.debug("%s done but already removed: %r",
+                              self.source_name, path)
+                continue
+            del self._active_tasks[path]
+            if isinstance(result, Exception):
+                errors.append((path, result))
+            else:
+                self._check_for_none_values(result)
+                finished.append((path, result))
+        if finished or errors:
+            self.emit('batch-complete', finished, errors)
+        self._send_pending_tasks()
+
+def _make_mutagen_batch_task(tasks):
+    return workerprocess.MutagenBatchTask(
+        [task.source_path for task in tasks], tasks[0].cover_art_directory)
+
+class _MovieDataProcessor(_TaskProcessor):
+    """Handle sending movie data tasks to the worker process.
+
+    On top of what _TaskProcessor does, we:
+    - send tasks for paths that the user is looking at before other tasks.
+      We also give them a higher priority, so that they jump ahead of the
+      tasks we've already sent.
+    - time each task from when a worker process starts it.
+
+    Signals:
+
+    - task-started(path) -- a worker process started running a task
+    """
+    def __init__(self, source_name, limit):
+        _TaskProcessor.__init__(self, source_name, limit)
+        self.create_signal('task-started')
+        # FIFO of paths for _pending_tasks.  This can contain paths that were
+        # already sent or removed, we skip those when we get to them.
+        self._pending_order = collections.deque()
+        self._priority_paths = set()
+        # maps paths to the time a worker started on them
+        self._start_times = {}
+        # maps paths to how long their task took
+        self.run_times = {}
+
+    def set_priority_paths(self, paths):
+        """Set the paths that should be processed first."""
+        self._priority_paths = set(paths)
+        self._boost_waiting_tasks()
+        self._send_pending_tasks()
+
+    def _boost_waiting_tasks(self):
+        """Resend priority tasks that are still waiting for a worker.
+
+        Those tasks were sent at the normal priority, so cancel them and
+        send new ones at the higher priority.
+        """
+        to_boost = []
+        for path in self._priority_paths.intersection(self._active_tasks):
+            task = self._active_tasks[path]
+            if (path not in self._start_times and
+                task.priority != task.high_priority):
+                to_boost.append(path)
+        if not to_boost:
+            return
+        workerprocess.cancel_tasks_for_files(to_boost)
+        for path in to_boost:
+            old_task = self._active_tasks[path]
+            self._send_task(workerprocess.MovieDataProgramTask(
+                path, old_task.screenshot_directory))
+
+    def running_paths(self):
+        """Get the paths that a worker process is currently running."""
+        return self._start_times.keys()
+
+    def add_task(self, task):
+        if len(self._active_tasks) < self.limit:
+            self._send_task(task)
+        else:
+            self._pending_tasks[task.source_path] = task
+            self._pending_order.append(task.source_path)
+
+    def _send_task(self, task):
+        if task.source_path in self._priority_paths:
+            task.priority = task.high_priority
+        self._active_tasks[task.source_path] = task
+        workerprocess.send(task, self._callback, self._errback,
+                           self._started_callback)
+
+    def _send_pending_tasks(self):
+        if not self._pending_tasks:
+            return
+        if len(self._active_tasks) < self.limit:
+            for path in self._priority_paths.intersection(
+                self._pending_tasks):
+                if len(self._active_tasks) >= self.limit:
+                    return
+                self._send_task(self._pending_tasks.pop(path))
+        while len(self._active_tasks) < self.limit and self._pending_tasks:
+            path = self._pending_order.popleft()
+            if path in self._pending_tasks:
+                self._send_task(self._pending_tasks.pop(path))
+        if not self._pending_tasks:
+            self._pending_order.clear()
+
+    def _started_callback(self, task):
+        if task.source_path in self._active_tasks:
+            self._start_times[task.source_path] = clock.clock()
+            self.emit('task-started', task.source_path)
+
+    def _get_start_time(self, task):
+        if task.source_path in self._active_tasks:
+            return self._start_times.get(task.source_path)
+        else:
+            return None
+
+    def _record_run_time(self, task, start_time):
+        # The base class removes the task from our system, which clears out
+        # the timing info for it.  So we need to record the run time after
+        # that.
+        if start_time is not None:
+            self.run_times[task.source_path] = clock.clock() - start_time
+
+    def _callback(self, task, result):
+        start_time = self._get_start_time(task)
+        _TaskProcessor._callback(self, task, result)
+        self._record_run_time(task, start_time)
+
+    def _errback(self, task, error):
+        start_time = self._get_start_time(task)
+        _TaskProcessor._errback(self, task, error)
+        self._record_run_time(task, start_time)
+
+    def remove_tasks_for_paths(self, paths):
+        for path in paths:
+            self._start_times.pop(path, None)
+            self.run_times.pop(path, None)
+        _TaskProcessor.remove_tasks_for_paths(self, paths)
+
 class _EchonestQueue(object):
     """Queue for echonest tasks.
 
@@ -1093,8 +1348,20 @@ class MetadataManagerBase(signals.SignalEmitter):
     RETRY_TEMPORARY_INTERVAL = 3600
     # how often to re-try net lookups that have failed
     NET_LOOKUP_RETRY_INTERVAL = 60 * 60 * 24 * 7 # 1 week
-
-    def __init__(self, cover_art_dir, screenshot_dir, db_info=None):
+    # max number of files to fingerprint in a single call_in_lane() call
+    CACHE_LOOKUP_BATCH_SIZE = 100
+
+    def __init__(self, cover_art_dir, screenshot_dir, db_info=None,
+                 metadata_cache=None):
+        """Create a MetadataManager
+
+        :param cover_art_dir: directory to store cover art in
+        :param screenshot_dir: directory to store screenshots in
+        :param db_info: DBInfo to use, defaults to app.db_info
+        :param metadata_cache: MetadataCache to check before running the
+                               metadata extractors, or None to always run
+                               them.
+        """
         signals.SignalEmitter.__init__(self)
         if db_info is None:
             self.db_info = app.db_info
@@ -1105,8 +1372,9 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.cover_art_dir = cover_art_dir
         self.screenshot_dir = screenshot_dir
         self.echonest_cover_art_dir = os.path.join(cover_art_dir, 'echonest')
-        self.mutagen_processor = _TaskProcessor(u'mutagen', 100)
-        self.moviedata_processor = _TaskProcessor(u'movie-data', 100)
+        self.mutagen_processor = _BatchTaskProcessor(u'mutagen', 100, 10,
+                                                     _make_mutagen_batch_task)
+        self.moviedata_processor = _MovieDataProcessor(u'movie-data', 100)
         self.echonest_processor = _EchonestProcessor(
             5, self.echonest_cover_art_dir)
         self.pending_mutagen_tasks = []
@@ -1119,6 +1387,10 @@ class MetadataManagerBase(signals.SignalEmitter):
         for processor in self.metadata_processors:
             processor.connect("task-complete", self._on_task_complete)
             processor.connect("task-error", self._on_task_error)
+        self.mutagen_processor.connect("batch-complete",
+                                       self._on_batch_complete)
+        self.moviedata_processor.connect("task-started",
+                                         self._on_movie_data_started)
         self.count_tracker = self.make_count_tracker()
         self._send_net_lookup_counts_caller = eventloop.DelayedFunctionCaller(
             self._send_net_lookup_counts)
@@ -1137,6 +1409,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         self._retry_net_lookup_caller = \
                 eventloop.DelayedFunctionCaller(self.retry_net_lookup)
         self._retry_net_lookup_entries = {}
+        self._setup_cache_state(metadata_cache)
         self._setup_path_placeholders()
         self._setup_net_lookup_count()
         # send initial NetLookupCounts message
@@ -1145,6 +1418,22 @@ class MetadataManagerBase(signals.SignalEmitter):
     def _reset_new_metadata(self):
         self.new_metadata = collections.defaultdict(dict)
 
+    def _setup_cache_state(self, metadata_cache):
+        self.metadata_cache = metadata_cache
+        # paths waiting for a cache lookup
+        self._cache_lookup_queue = set()
+        # paths that we're calculating fingerprints for
+        self._cache_lookups_running = set()
+        # maps paths to their fingerprint/cache record while we're processing
+        # them
+        self._cache_fingerprints = {}
+        self._cache_records = {}
+        # maps fingerprints to records that we need to write to the cache on
+        # the next run_updates() call
+        self._cache_updates = {}
+        self._cache_lookup_caller = eventloop.DelayedFunctionCaller(
+            self._start_cache_lookups)
+
     def check_image_directories(self, log_warnings=False):
         """Check that our echonest and screenshot directories exist
 
@@ -1223,8 +1512,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         return self.bulk_add_count != 0
 
     def _send_pending_mutagen_tasks(self):
-        for task in self.pending_mutagen_tasks:
-            self.mutagen_processor.add_task(task)
+        self.mutagen_processor.add_tasks(self.pending_mutagen_tasks)
         self.pending_mutagen_tasks = []
 
     def _translate_path(self, path):
@@ -1280,6 +1568,9 @@ class MetadataManagerBase(signals.SignalEmitter):
         return self.db_info.db.cache.key_exists('metadata', path)
 
     def _cancel_processing_paths(self, paths):
+        for path in paths:
+            self._cache_lookup_queue.discard(path)
+            self._cache_lookups_running.discard(path)
         paths = [self._translate_path(p) for p in paths]
         workerprocess.cancel_tasks_for_files(paths)
         for processor in self.metadata_processors:
@@ -1337,6 +1628,7 @@ class MetadataManagerBase(signals.SignalEmitter):
                                                            self.db_info):
                 entry.remove()
             status.remove()
+            self._forget_cache_record(path)
             if status.current_processor is not None:
                 self.count_tracker.file_finished(path)
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
@@ -1378,6 +1670,11 @@ class MetadataManagerBase(signals.SignalEmitter):
             return
 
         status.rename(new_path)
+        if old_path in self._cache_fingerprints:
+            self._cache_fingerprints[new_path] = \
+                    self._cache_fingerprints.pop(old_path)
+        if old_path in self._cache_records:
+            self._cache_records[new_path] = self._cache_records.pop(old_path)
         if status.mutagen_status == MetadataStatus.STATUS_NOT_RUN:
             self._run_mutagen(new_path)
         elif status.moviedata_status == MetadataStatus.STATUS_NOT_RUN:
@@ -1539,16 +1836,22 @@ class MetadataManagerBase(signals.SignalEmitter):
 
         This method queues calls to mutagen, movie data, etc.
         """
-        for id_ in self.restart_ids:
-            try:
-                status = MetadataStatus.get_by_id(id_, self.db_info)
-            except database.ObjectNotFoundError:
-                continue # just ignore deleted objects
-            self.run_next_processor(status)
-            # get_metadata() is sometimes more accurate than
-            # _get_metadata_from_filename() but slower.  Let's go for speed.
-            metadata = self._get_metadata_from_filename(status.path)
-            self.count_tracker.file_started(status.path, metadata)
+        # Load all the statuses with a single query, rather than fetching
+        # them one at a time.  Objects that were deleted since
+        # _find_incomplete() just won't be in the view.
+        restart_ids = set(self.restart_ids)
+        view = MetadataStatus.was_running_view(self.db_info)
+        # use bulk_add() so that we send the mutagen tasks in batches
+        with self.bulk_add():
+            for status in view:
+                if status.id not in restart_ids:
+                    continue
+                self.run_next_processor(status)
+                # get_metadata() is sometimes more accurate than
+                # _get_metadata_from_filename() but slower.  Let's go for
+                # speed.
+                metadata = self._get_metadata_from_filename(status.path)
+                self.count_tracker.file_started(status.path, metadata)
 
         del self.restart_ids
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
@@ -1611,7 +1914,18 @@ class MetadataManagerBase(signals.SignalEmitter):
             raise KeyError(path)
 
     def _run_mutagen(self, path):
-        """Run mutagen on a path."""
+        """Run mutagen on a path.
+
+        If we have a metadata cache, we check that first and only run mutagen
+        if we can't find the file in it.
+        """
+        if self.metadata_cache is not None:
+            self._cache_lookup_queue.add(path)
+            self._cache_lookup_caller.call_when_idle()
+        else:
+            self._send_mutagen_task(path)
+
+    def _send_mutagen_task(self, path):
         self.check_image_directories()
         path = self._translate_path(path)
         task = workerprocess.MutagenTask(path, self.cover_art_dir)
@@ -1620,10 +1934,155 @@ class MetadataManagerBase(signals.SignalEmitter):
         else:
             self.pending_mutagen_tasks.append(task)
 
+    def _start_cache_lookups(self):
+        """Calculate fingerprints for the paths in _cache_lookup_queue
+
+        The fingerprints are calculated in the IO lane, since we need to read
+        from each file.  We split things up in chunks so that the first
+        results come back quickly when lots of files get added.
+        """
+        if self.closed:
+            return
+        paths = list(self._cache_lookup_queue)
+        self._cache_lookup_queue = set()
+        self._cache_lookups_running.update(paths)
+        for start in xrange(0, len(paths), self.CACHE_LOOKUP_BATCH_SIZE):
+            chunk = paths[start:start+self.CACHE_LOOKUP_BATCH_SIZE]
+            self._calc_fingerprints(chunk)
+
+    def _calc_fingerprints(self, paths):
+        def callback(fingerprints):
+            self._on_fingerprints(paths, fingerprints)
+        def errback(error):
+            logging.warn("error calculating fingerprints: %s", error)
+            self._on_fingerprints(paths, [None] * len(paths))
+        eventloop.call_in_lane(eventloop.LANE_IO, callback, errback,
+                               metadatacache.calc_fingerprints,
+                               'Calculate metadata cache fingerprints',
+                               [self._translate_path(p) for p in paths])
+
+    def _on_fingerprints(self, paths, fingerprints):
+        if self.closed:
+            return
+        records = self.metadata_cache.lookup(fingerprints)
+        app.bulk_sql_manager.start()
+        try:
+            # use bulk_add() so that we send the mutagen tasks for cache
+            # misses in batches
+            with self.bulk_add():
+                for path, fingerprint in zip(paths, fingerprints):
+                    self._process_cache_lookup(path, fingerprint, records)
+        finally:
+            app.bulk_sql_manager.finish()
+        self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
+
+    def _process_cache_lookup(self, path, fingerprint, records):
+        if path not in self._cache_lookups_running:
+            # path was removed/moved while we were calculating the
+            # fingerprint
+            return
+        self._cache_lookups_running.discard(path)
+        try:
+            status = self._get_status_for_path(path)
+        except KeyError:
+            return
+        if not status.need_metadata_for_source(u'mutagen'):
+            return
+        if fingerprint is None:
+            self._send_mutagen_task(path)
+            return
+        self._cache_fingerprints[path] = fingerprint
+        record = records.get(fingerprint)
+        if record is None:
+            self._cache_records[path] = {}
+            self._send_mutagen_task(path)
+        else:
+            self._cache_records[path] = record.copy()
+            if not self._apply_cached_metadata(status, record):
+                self._send_mutagen_task(path)
+
+    def _apply_cached_metadata(self, status, record):
+        """Use the results in a cache record instead of running extractors.
+
+        We go through the extractors in order and use the cached results
+        until we find one that's not in the record, then we run the rest of
+        them like normal.
+
+        :returns: True if we were able to use the cached mutagen results
+        """
+        path = status.path
+        for processor in self.metadata_processors:
+            source_name = processor.source_name
+            if not status.need_metadata_for_source(source_name):
+                continue
+            if (source_name not in record or
+                not self._cached_files_exist(record[source_name])):
+                break
+            result = record[source_name]
+            if result is not None:
+                result = result.copy()
+                self._make_new_metadata_entry(status, processor, path, result)
+                self.count_tracker.file_updated(path, result)
+            else:
+                status.update_after_error(source_name, None)
+                if (processor is self.moviedata_processor and
+                    status.get_has_drm()):
+                    self.new_metadata[path].update({'has_drm': True})
+        if status.need_metadata_for_source(u'mutagen'):
+            return False
+        self.run_next_processor(status)
+        if status.current_processor == u'echonest':
+            self.count_tracker.file_finished_local_processing(path)
+        return True
+
+    def _cached_files_exist(self, result):
+        """Check that the images referenced by a cached result still exist.
+        """
+        if result is None:
+            return True
+        for key in ('cover_art', 'screenshot'):
+            if key in result and not fileutil.exists(result[key]):
+                return False
+        return True
+
+    def _add_to_cache_record(self, path, source_name, result):
+        """Add the result for a metadata source to our cache record
+
+        :param result: result dict, or None if the source failed
+        """
+        if path not in self._cache_fingerprints:
+            return
+        if result is not None:
+            result = result.copy()
+            result.pop('source_path', None)
+        record = self._cache_records.setdefault(path, {})
+        record[source_name] = result
+        self._cache_updates[self._cache_fingerprints[path]] = record
+
+    def _forget_cache_record(self, path):
+        self._cache_fingerprints.pop(path, None)
+        self._cache_records.pop(path, None)
+
+    def _flush_cache_updates(self):
+        if self._cache_updates:
+            self.metadata_cache.store(self._cache_updates)
+            self._cache_updates = {}
+
     def _run_movie_data(self, path):
         """Run the movie data program on a path."""
         self.check_image_directories()
-        path = self._translate_path(path)
+        translated_path = self._translate_path(path)
+        status = self._get_status_for_path(path)
+        if status.should_skip_movie_data_run():
+            # The last few times that we started movie data for this file,
+            # it never finished.  Give up on it, rather than risk hanging
+            # the worker process again.
+            logging.warn("skipping movie data for %r (%s attempts)", path,
+                         status.moviedata_attempts)
+            self._on_task_error(self.moviedata_processor, translated_path,
+                                workerprocess.SubprocessTimeoutError())
+            return
+        path = translated_path
         task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir)
         self.moviedata_processor.add_task(task)
 
@@ -1651,6 +2110,41 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.echonest_processor.add_path(self._translate_path(path),
                                          metadata_fetcher)
 
+    def _on_movie_data_started(self, processor, path):
+        try:
+            status = self._get_status_for_path(self._untranslate_path(path))
+        except KeyError:
+            return
+        status.movie_data_started()
+
+    def set_priority_paths(self, paths):
+        """Set the paths that we should process first.
+
+        This is used to extract movie data for the items that the user is
+        currently looking at before other items.
+        """
+        self.moviedata_processor.set_priority_paths(
+            [self._translate_path(p) for p in paths])
+
+    def shutdown(self):
+        """Flush pending updates before Miro quits.
+
+        Movie data runs that are in progress get interrupted, so we don't
+        count them as attempts for their file.
+        """
+        app.bulk_sql_manager.start()
+        try:
+            for path in self.moviedata_processor.running_paths():
+                try:
+                    status = self._get_status_for_path(
+                        self._untranslate_path(path))
+                except KeyError:
+                    continue
+                status.movie_data_interrupted()
+        finally:
+            app.bulk_sql_manager.finish()
+        self.run_updates()
+
     def _on_task_complete(self, processor, path, result):
         path = self._untranslate_path(path)
         self.metadata_finished.append((processor, path, result))
@@ -1661,6 +2155,18 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.metadata_errors.append((processor, path, error))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
 
+    def _on_batch_complete(self, processor, results, errors):
+        # We add the entire batch at once, so it will get handled by a single
+        # run_updates() call.  That means one bulk_sql_manager transaction and
+        # one _send_progress_updates() call for the batch.
+        for path, result in results:
+            self.metadata_finished.append(
+                (processor, self._untranslate_path(path), result))
+        for path, error in errors:
+            self.metadata_errors.append(
+                (processor, self._untranslate_path(path), error))
+        self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
+
     def _get_metadata_from_filename(self, path):
         """Get metadata that we know from a filename alone."""
         return {
@@ -1694,6 +2200,7 @@ class MetadataManagerBase(signals.SignalEmitter):
                 logging.warn("Error adding new metadata: %s. new_metadata\n%s",
                              e, new_metadata_debug_string)
                 raise
+        self._flush_cache_updates()
         self._send_progress_updates()
 
     def _process_metadata_finished(self):
@@ -1725,7 +2232,10 @@ class MetadataManagerBase(signals.SignalEmitter):
                          "metadata for %s (source: %s)", path,
                          processor.source_name)
             return
+        if processor is self.moviedata_processor:
+            self._record_movie_data_finished(status, path)
         self._make_new_metadata_entry(status, processor, path, result)
+        self._add_to_cache_record(path, processor.source_name, result)
         self.count_tracker.file_updated(path, result)
         self.run_next_processor(status)
         if status.current_processor == u'echonest':
@@ -1770,9 +2280,12 @@ class MetadataManagerBase(signals.SignalEmitter):
                 logging.warn("_process_metadata_finished -- path removed: %s",
                              path)
                 continue
+            if processor is self.moviedata_processor:
+                self._record_movie_data_finished(status, path)
             processor_status = status.update_after_error(
                 processor.source_name, error)
             if processor_status != status.STATUS_TEMPORARY_FAILURE:
+                self._add_to_cache_record(path, processor.source_name, None)
                 self.run_next_processor(status)
             if status.current_processor == u'echonest':
                 self.count_tracker.file_finished_local_processing(status.path)
@@ -1785,6 +2298,12 @@ class MetadataManagerBase(signals.SignalEmitter):
                     self.RETRY_TEMPORARY_INTERVAL)
         self.metadata_errors = []
 
+    def _record_movie_data_finished(self, status, path):
+        run_time = self.moviedata_processor.run_times.pop(
+            self._translate_path(path), None)
+        if run_time is not None:
+            status.movie_data_finished(run_time)
+
     def run_next_processor(self, status):
         """Called after both success and failure of a metadata processor
         """
@@ -1796,6 +2315,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         elif status.current_processor == u'echonest':
             self._run_echonest(status.path)
         else:
+            self._forget_cache_record(status.path)
             self.count_tracker.file_finished(status.path)
 
     def _send_progress_updates(self):
@@ -0,0 +1,273 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.metadatacache`` -- Cache extracted metadata by file contents.
+
+Running mutagen, the movie data program and echonest on a big media library
+takes a long time.  Most of the time, when we see a file that we've processed
+before (for example after a database reset or when a watched folder gets
+re-added) the file hasn't changed at all, so we can just reuse the old
+results.
+
+MetadataCache stores the results for each metadata source, keyed by a
+fingerprint of the file.  The fingerprint is made from the file size, the
+modification time and a hash of the start and end of the file.  That's cheap
+to calculate, even for huge video files, but still changes when the file is
+re-encoded or re-tagged.
+
+The cache is stored in its own sqlite database in the support directory, so
+it survives the main database being reset.  MetadataCache should only be
+used inside the eventloop thread.  calc_fingerprints() does blocking IO and
+should be called in a separate thread.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+from miro import app
+from miro import fileutil
+from miro import prefs
+from miro import util
+
+# number of bytes to hash from the start and the end of a file
+FINGERPRINT_CHUNK_SIZE = 16 * 1024
+
+def calc_fingerprint(path):
+    """Calculate the fingerprint for a file.
+
+    :raises EnvironmentError: we couldn't read the file
+    :returns: fingerprint string
+    """
+    stat_info = os.stat(path)
+    hasher = hashlib.sha1()
+    f = fileutil.open_file(path, 'rb')
+    try:
+        hasher.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        if stat_info.st_size > FINGERPRINT_CHUNK_SIZE * 2:
+            f.seek(-FINGERPRINT_CHUNK_SIZE, os.SEEK_END)
+        hasher.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    finally:
+        f.close()
+    return u'%d-%d-%s' % (stat_info.st_size, int(stat_info.st_mtime),
+                          hasher.hexdigest())
+
+def calc_fingerprints(paths):
+    """Calculate fingerprints for a list of files.
+
+    :returns: list of fingerprints, in the same order as paths.  The
+        fingerprint is None for files that we couldn't read.
+    """
+    fingerprints = []
+    for path in paths:
+        try:
+            fingerprints.append(calc_fingerprint(path))
+        except EnvironmentError, e:
+            logging.debug("error calculating fingerprint for %r: %s",
+                          path, e)
+            fingerprints.append(None)
+    return fingerprints
+
+class MetadataCache(object):
+    """sqlite-backed cache of metadata results.
+
+    Each record is a dict that maps metadata source names (mutagen,
+    movie-data, echonest) to the result dict for that source, or None if the
+    source failed for the file.
+
+    When there are more than max_entries records, we throw out the least
+    recently used ones.
+    """
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        # We open the connection lazily, since MetadataCache gets created
+        # before the eventloop thread starts and sqlite connections can only
+        # be used in the thread that created them.
+        self.connection = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _ensure_open(self):
+        if self.connection is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if not fileutil.exists(directory):
+            fileutil.makedirs(directory)
+        try:
+            self._open()
+        except sqlite3.DatabaseError, e:
+            logging.warn("error opening metadata cache (%s), starting over",
+                         e)
+            self._close_connection()
+            try:
+                fileutil.remove(self.path)
+            except OSError:
+                pass
+            self._open()
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata_cache("
+                                "fingerprint TEXT PRIMARY KEY, "
+                                "data BLOB NOT NULL, "
+                                "last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS "
+                                "metadata_cache_last_used "
+                                "ON metadata_cache (last_used)")
+        self.connection.commit()
+
+    def _close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def lookup(self, fingerprints):
+        """Find the records for a list of fingerprints.
+
+        :returns: dict mapping fingerprints to records.  Fingerprints that
+            aren't in the cache won't be in the dict.
+        """
+        fingerprints = [fp for fp in fingerprints if fp is not None]
+        if not fingerprints:
+            return {}
+        try:
+            self._ensure_open()
+            records = self._lookup(fingerprints)
+        except sqlite3.Error, e:
+            logging.warn("error reading metadata cache: %s", e)
+            return {}
+        self.hits += len(records)
+        self.misses += len(fingerprints) - len(records)
+        return records
+
+    def _lookup(self, fingerprints):
+        records = {}
+        bad_fingerprints = []
+        cursor = self.connection.cursor()
+        for chunk in util.split_values_for_sqlite(fingerprints):
+            placeholders = ', '.join('?' for i in xrange(len(chunk)))
+            cursor.execute("SELECT fingerprint, data FROM metadata_cache "
+                           "WHERE fingerprint IN (%s)" % placeholders,
+                           chunk)
+            for fingerprint, data in cursor.fetchall():
+                try:
+                    records[fingerprint] = cPickle.loads(str(data))
+                except (cPickle.UnpicklingError, EOFError, ValueError,
+                        TypeError, AttributeError, ImportError), e:
+                    logging.warn("error loading metadata cache entry: %s", e)
+                    bad_fingerprints.append(fingerprint)
+        if records or bad_fingerprints:
+            now = time.time()
+            cursor.executemany("UPDATE metadata_cache SET last_used=? "
+                               "WHERE fingerprint=?",
+                               [(now, fp) for fp in records])
+            cursor.executemany("DELETE FROM metadata_cache "
+                               "WHERE fingerprint=?",
+                               [(fp,) for fp in bad_fingerprints])
+            self.connection.commit()
+        return records
+
+    def store(self, records):
+        """Store records in the cache.
+
+        All the records are written in a single transaction.
+
+        :param records: dict mapping fingerprints to records
+        """
+        if not records:
+            return
+        now = time.time()
+        rows = []
+        for fingerprint, record in records.iteritems():
+            data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+            rows.append((fingerprint, buffer(data), now))
+        try:
+            self._ensure_open()
+            self.connection.executemany("INSERT OR REPLACE INTO "
+                                        "metadata_cache "
+                                        "(fingerprint, data, last_used) "
+                                        "VALUES (?, ?, ?)", rows)
+            self._evict()
+            self.connection.commit()
+        except sqlite3.Error, e:
+            logging.warn("error writing metadata cache: %s", e)
+            try:
+                self.connection.rollback()
+            except sqlite3.Error:
+                pass
+
+    def _evict(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM metadata_cache")
+        extra = cursor.fetchone()[0] - self.max_entries
+        if extra <= 0:
+            return
+        cursor.execute("DELETE FROM metadata_cache WHERE fingerprint IN "
+                       "(SELECT fingerprint FROM metadata_cache "
+                       "ORDER BY last_used LIMIT ?)", (extra,))
+        self.evicted += extra
+
+    def count(self):
+        self._ensure_open()
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM metadata_cache")
+        return cursor.fetchone()[0]
+
+    def clear(self):
+        self._ensure_open()
+        self.connection.execute("DELETE FROM metadata_cache")
+        self.connection.commit()
+
+    def close(self):
+        self._close_connection()
+
+    def stats(self):
+        return "%d hits, %d misses, %d evicted" % (self.hits, self.misses,
+                                                   self.evicted)
+
+metadata_cache = None
+
+def init():
+    """Create the MetadataCache that the library MetadataManager uses.
+
+    If this isn't called, we always run the metadata extractors.
+    """
+    global metadata_cache
+    max_entries = app.config.get(prefs.METADATA_CACHE_SIZE)
+    if max_entries <= 0:
+        metadata_cache = None
+        return
+    path = os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                        'metadata-cache.sqlite')
+    metadata_cache = MetadataCache(path, max_entries)
@@ -115,39 +115,75 @@ def trap_call(object, function, *args, **kwargs):
 
 class NetworkBuffer(object):
     """Responsible for storing incomming network data and doing some basic
-    parsing of it.  I think this is about as fast as we can do things in pure
-    python, someday we may want to make it C...
+    parsing of it.
+
+    Data is stored in a single bytearray.  Instead of slicing off the data
+    that gets read, we keep an offset to the start of the unread data and
+    only throw away the read data once it makes up most of the bytearray.
+    This makes read() and readline() cost about the same as the data they
+    return, no matter how much data is buffered.
     """
+
+    # don't bother compacting the bytearray until we've read this much
+    COMPACT_SIZE = 64 * 1024
+
     def __init__(self):
-        self.chunks = []
-        self.length = 0
+        self._data = bytearray()
+        # start of the unread data
+        self._pos = 0
+        # readline() has already searched up to here for a newline
+        self._line_scan_pos = 0
+
+    @property
+    def length(self):
+        return len(self._data) - self._pos
 
     def addData(self, data):
-        self.chunks.append(data)
-        self.length += len(data)
+        self._data += data
 
-    def _mergeChunks(self):
-        self.chunks = [''.join(self.chunks)]
+    def recv_into(self, sock, size):
+        """Read up to size bytes from sock, storing them directly into our
+        buffer.
+
+        :returns: number of bytes read, 0 means the socket was closed
+        """
+        start = len(self._data)
+        self._data += '\0' * size
+        count = 0
+        view = memoryview(self._data)
+        try:
+            count = sock.recv_into(view[start:], size)
+        finally:
+            # release the view before resizing the bytearray
+            del view
+            del self._data[start+count:]
+        return count
+
+    def _compact(self):
+        if (self._pos >= self.COMPACT_SIZE and
+                self._pos * 2 >= len(self._data)):
+            del self._data[:self._pos]
+            self._line_scan_pos = max(0, self._line_scan_pos - self._pos)
+            self._pos = 0
 
     def has_data(self):
         return self.length > 0
 
     def discard_data(self):
-        self.chunks = []
-        self.length = 0
+        self._data = bytearray()
+        self._pos = self._line_scan_pos = 0
 
     def read(self, size=None):
         """Read at most size bytes from the data that has been added to the
         buffer.  """
 
-        self._mergeChunks()
-        if size is not None:
-            rv = self.chunks[0][:size]
-            self.chunks[0] = self.chunks[0][len(rv):]
+        if size is None:
+            end = len(self._data)
         else:
-            rv = self.chunks[0]
-            self.chunks = []
-        self.length -= len(rv)
+            end = min(self._pos + size, len(self._data))
+        rv = str(self._data[self._pos:end])
+        self._pos = end
+        self._compact()
         return rv
 
     def readline(self):
@@ -157,28 +193,33 @@ class NetworkBuffer(object):
         * Both "\r\n" and "\n" act as a line ender
         """
 
-        self._mergeChunks()
-        split = self.chunks[0].split("\n", 1)
-        if len(split) == 2:
-            self.chunks[0] = split[1]
-            self.length = len(self.chunks[0])
-            if split[0].endswith("\r"):
-                return split[0][:-1]
-            else:
-                return split[0]
-        else:
+        index = self._data.find("\n", max(self._pos, self._line_scan_pos))
+        if index < 0:
+            # remember where we stopped, so the next call only scans new data
+            self._line_scan_pos = len(self._data)
             return None
+        end = index
+        if end > self._pos and self._data[end-1] == ord("\r"):
+            end -= 1
+        rv = str(self._data[self._pos:end])
+        self._pos = index + 1
+        self._compact()
+        return rv
 
     def unread(self, data):
         """Put back read data.  This make is like the data was never read at
         all.
         """
-        self.chunks.insert(0, data)
-        self.length += len(data)
+        if len(data) <= self._pos:
+            self._data[self._pos-len(data):self._pos] = data
+            self._pos -= len(data)
+        else:
+            self._data[:self._pos] = data
+            self._pos = 0
+        self._line_scan_pos = self._pos
 
     def getValue(self):
-        self._mergeChunks()
-        return self.chunks[0]
+        return str(self._data[self._pos:])
 
 class _Packet(object):
     """A packet of data for the AsyncSocket class
@@ -204,6 +245,9 @@ class AsyncSocket(object):
         self.readSize = 4096
         self.socket = None
         self.readCallback = None
+        # If set, a NetworkBuffer that we read data directly into.  In that
+        # case readCallback gets passed None instead of the data.
+        self.readBuffer = None
         self.closeCallback = closeCallback
         self.readTimeout = None
         self.timedOut = False
@@ -221,8 +265,8 @@ class AsyncSocket(object):
             return "Unknown %s" % (type(self).__name__,)
 
     # The complication in the timeout code is because creating and
-    # cancelling a timeout costs some memory (timeout is in memory
-    # until it goes off, even if cancelled.)
+    # cancelling a timeout for every read is wasteful.  Instead we keep one
+    # timeout around and check lastClock when it goes off.
     def startReadTimeout(self):
         if self.disable_read_timeout:
             return
@@ -328,10 +372,11 @@ class AsyncSocket(object):
             eventloop.remove_write_callback(self.socket)
             trap_call(self, errback, ConnectionTimeout(host))
             self.connectionErrback = None
-        eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
-                                 socket.getaddrinfo,
-                                 "getAddrInfo - %s:%s" % (host, port),
-                                 host, port)
+        eventloop.call_in_lane(eventloop.LANE_DNS, onAddressLookup,
+                               handleGetAddrInfoException,
+                               socket.getaddrinfo,
+                               "getAddrInfo - %s:%s" % (host, port),
+                               host, port)
 
     def accept_connection(self, family, host, port, callback, errback):
         def finishAccept():
@@ -391,6 +436,9 @@ class AsyncSocket(object):
         """Start reading from the socket.  When data becomes available it will
         be passed to readCallback.  If there is already a read callback, it
         will be replaced.
+
+        If readBuffer is set, the data gets stored there and readCallback is
+        passed None instead.
         """
 
         if not self.isOpen():
@@ -461,7 +509,15 @@ class AsyncSocket(object):
 
     def onReadReady(self):
         try:
-            data = self.socket.recv(self.readSize)
+            if self.readBuffer is not None:
+                # recv_into() saves us from creating a string for the data,
+                # then copying it into the buffer.
+                if self.readBuffer.recv_into(self.socket, self.readSize):
+                    data = None
+                else:
+                    data = ''
+            else:
+                data = self.socket.recv(self.readSize)
         except socket.error, (code, msg):
             self.handleSocketError(code, msg, "read")
         except MemoryError:
@@ -601,6 +657,7 @@ class ConnectionHandler(object):
         self.buffer = NetworkBuffer()
         self.states = {'initializing': None, 'closed': None}
         self.stream = self.stream_factory(closeCallback=self.closeCallback)
+        self.stream.readBuffer = self.buffer
         self.change_state('initializing')
         self.name = ""
 
@@ -642,7 +699,9 @@ class ConnectionHandler(object):
                 pass
 
     def handleData(self, data):
-        self.buffer.addData(data)
+        # data is None if our stream read directly into our buffer
+        if data is not None:
+            self.buffer.addData(data)
         lastState = self.state
         self.readHandler()
         # If we switch states, continue processing the buffer.  There may be
@@ -261,6 +261,21 @@ HTTP_PROXY_AUTHORIZATION_USERNAME = \
     Pref(key='HttpProxyAuthorizationUsername',   default=u"", platformSpecific=True)
 HTTP_PROXY_AUTHORIZATION_PASSWORD = \
     Pref(key='HttpProxyAuthorizationPassword',   default=u"", platformSpecific=True)
+# max number of transfers httpclient runs at once for a single host.  Extra
+# transfers wait until one finishes.  0 means no limit.
+HTTP_MAX_CONNECTIONS_PER_HOST = \
+    Pref(key='httpMaxConnectionsPerHost', default=6, platformSpecific=False)
+# max size of the HTTP response cache in bytes.  0 disables the cache.
+HTTP_CACHE_SIZE = \
+    Pref(key='httpCacheSize', default=50 * 1024 * 1024,
+         platformSpecific=False)
+# max number of files to keep in the metadata cache.  0 disables the cache.
+METADATA_CACHE_SIZE = \
+    Pref(key='metadataCacheSize', default=100000, platformSpecific=False)
+# number of worker processes to run movie data in.  0 picks a value based on
+# the number of CPUs.
+MOVIE_DATA_CONCURRENCY = \
+    Pref(key='movieDataConcurrency', default=0, platformSpecific=False)
 
 # These are normally read from resources/app.config.
 SHORT_APP_NAME = \
@@ -311,6 +326,25 @@ OPEN_CHANNEL_ON_STARTUP = \
     Pref(key='openChannelOnStartup',default=None, platformSpecific=False)
 DISABLE_IPV6 = \
     Pref(key='disableIPV6',default=True, platformSpecific=False)
+# max number of unused database objects to keep in memory.  None means keep
+# everything.
+DB_OBJECT_CACHE_SIZE = \
+    Pref(key='dbObjectCacheSize', default=20000, platformSpecific=False)
+BACKGROUND_WAL_CHECKPOINTS = \
+    Pref(key='backgroundWALCheckpoints', default=True,
+         platformSpecific=False)
+# in milliseconds.  0 means commit after every event
+DB_COMMIT_COALESCE_TIME = \
+    Pref(key='dbCommitCoalesceTime', default=0, platformSpecific=False)
+# record timing info for event loop callbacks.  This is shown in the
+# diagnostics dialog.
+EVENT_LOOP_PROFILING = \
+    Pref(key='eventLoopProfiling', default=False, platformSpecific=False)
+# item lists with more items than this only load the rows near the visible
+# range in the background.  0 means always load every row.
+ITEM_LIST_BACKGROUND_FETCH_LIMIT = \
+    Pref(key='itemListBackgroundFetchLimit', default=5000,
+         platformSpecific=False)
 
 def all_prefs():
     return [obj for obj in globals().values() if isinstance(obj, Pref)]
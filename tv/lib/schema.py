@@ -326,6 +326,9 @@ class ObjectSchema(object):
     * ``table_name`` -- SQL table name to store the class in
     * ``fields`` -- list of (name, SchemaItem) pairs.  One item for
       each attribute that should be stored to disk.
+    * ``eager_columns`` -- columns that are always loaded, even when a
+      view only asks for some columns.  This should include anything
+      used by get_ddb_class() or setup_restored().
     """
 
     @classmethod
@@ -338,6 +341,7 @@ class ObjectSchema(object):
 
     indexes = ()
     unique_indexes = ()
+    eager_columns = ()
 
 class MultiClassObjectSchema(ObjectSchema):
     """ObjectSchema where rows will be restored to different python
@@ -415,6 +419,10 @@ class ItemSchema(MultiClassObjectSchema):
         else:
             return Item
 
+    eager_columns = ('is_file_item', 'feed_id', 'downloader_id', 'parent_id',
+                     'is_container_item', 'filename', 'short_filename',
+                     'deleted')
+
     fields = DDBObjectSchema.fields + [
         ('is_file_item', SchemaBool()),
         ('new', SchemaBool()),
@@ -948,6 +956,8 @@ class MetadataStatusSchema(DDBObjectSchema):
         ('net_lookup_enabled', SchemaBool()),
         ('mutagen_thinks_drm', SchemaBool()),
         ('max_entry_priority', SchemaInt()),
+        ('moviedata_attempts', SchemaInt()),
+        ('moviedata_time', SchemaFloat(noneOk=True)),
     ]
 
     indexes = (
@@ -995,7 +1005,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 192
+VERSION = 195
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
@@ -63,6 +63,7 @@ from miro import eventloop
 from miro import fileutil
 from miro import guide
 from miro import httpauth
+from miro import httpcache
 from miro import httpclient
 from miro import iconcache
 from miro import item
@@ -72,6 +73,7 @@ from miro import feed
 from miro import folder
 from miro import messages
 from miro import messagehandler
+from miro import metadatacache
 from miro import models
 from miro import playlist
 from miro import prefs
@@ -254,10 +256,14 @@ def startup():
     logging.info("Reading HTTP Password list")
     httpauth.init()
     httpauth.restore_from_file()
+    httpcache.init()
+    metadatacache.init()
     logging.info("Starting libCURL thread")
     httpclient.init_libcurl()
     httpclient.start_thread()
     logging.info("Starting event loop thread")
+    if app.config.get(prefs.EVENT_LOOP_PROFILING):
+        eventloop.start_profiling()
     eventloop.startup()
     if DEBUG_DB_MEM_USAGE:
         mem_usage_test_event.wait()
@@ -278,7 +284,12 @@ def finish_startup(obj, thread):
     item.setup_deleted_checker()
     logging.info("Restoring database...")
     start = time.time()
-    app.db = storedatabase.LiveStorage()
+    app.db = storedatabase.LiveStorage(
+        object_cache_size=app.config.get(prefs.DB_OBJECT_CACHE_SIZE),
+        background_checkpoints=app.config.get(
+            prefs.BACKGROUND_WAL_CHECKPOINTS),
+        commit_coalesce_time=app.config.get(
+            prefs.DB_COMMIT_COALESCE_TIME) / 1000.0)
     try:
         app.db.upgrade_database()
     except databaseupgrade.DatabaseTooNewError:
@@ -450,8 +461,11 @@ def on_frontend_started():
     # Delay running high CPU/IO operations for a bit
     eventloop.add_timeout(5, app.download_state_manager.startup_downloader,
             "start downloader daemon")
+    movie_data_worker_count = (app.config.get(prefs.MOVIE_DATA_CONCURRENCY)
+                               or None)
     eventloop.add_timeout(10, workerprocess.startup,
-            "start worker process")
+            "start worker process",
+            kwargs={'movie_data_worker_count': movie_data_worker_count})
     eventloop.add_timeout(20, item.start_deleted_checker,
             "start checking deleted items")
     eventloop.add_timeout(30, feed.start_updates, "start feed updates")
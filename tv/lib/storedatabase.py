@@ -56,6 +56,8 @@ import traceback
 import time
 import os
 import sys
+import threading
+import weakref
 from cStringIO import StringIO
 
 try:
@@ -66,6 +68,7 @@ except ImportError:
 from miro import app
 from miro import crashreport
 from miro import convert20database
+from miro import database
 from miro import databaseupgrade
 from miro import dbupgradeprogress
 from miro import dialogs
@@ -77,6 +80,7 @@ from miro import schema
 from miro import signals
 from miro import prefs
 from miro import util
+from miro.data import connectionpool
 from miro.data import fulltextsearch
 from miro.data import item
 from miro.gtcache import gettext as _
@@ -111,15 +115,144 @@ _sqlite_type_map = {
 
 VERSION_KEY = "Democracy Version"
 
+class UpdateSQLCache(util.Cache):
+    """Caches UPDATE statements for LiveStorage.
+
+    Keys are (object schema, column names) tuples.  The values are SQL
+    strings that use a placeholder for the id, so that sqlite can reuse its
+    prepared statements.
+    """
+    def create_new_value(self, key, invalidator=None):
+        obj_schema, columns = key
+        return "UPDATE %s SET %s WHERE id=?" % (obj_schema.table_name,
+                ', '.join('%s=?' % name for name in columns))
+
+class ObjectIdentityMap(object):
+    """Maps (id, table_name) keys to the DDBObjects loaded in memory.
+
+    All objects are stored using weak references.  We also keep strong
+    references to the max_size most recently used objects, plus objects that
+    are pinned (see is_pinned()).  Once an object is evicted from that set,
+    it stays in the map until nothing else references it.  After that,
+    LiveStorage will restore it from the DB the next time it's needed.
+
+    If max_size is None, we keep strong references to all objects.
+
+    Attributes:
+
+    - hits -- number of lookups that found their object
+    - misses -- number of lookups for objects that weren't in memory
+    - evictions -- number of times we dropped a strong reference
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._objects = weakref.WeakValueDictionary()
+        # maps keys -> objects that we keep alive
+        self._strong_refs = {}
+        # maps keys -> last access time for objects in _strong_refs
+        self._access_times = {}
+        self._counter = itertools.count()
+        # only shrink once we grow past this size.  This avoids sorting
+        # our objects every time shrink() is called.
+        self._shrink_threshold = max_size
+        self.hits = self.misses = self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            obj = self._objects[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self._strong_refs[key] = obj
+        self._access_times[key] = self._counter.next()
+        return obj
+
+    def __setitem__(self, key, obj):
+        self._objects[key] = obj
+        self._strong_refs[key] = obj
+        self._access_times[key] = self._counter.next()
+
+    def __delitem__(self, key):
+        del self._objects[key]
+        self._strong_refs.pop(key, None)
+        self._access_times.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._objects
+
+    def __len__(self):
+        return len(self._objects)
+
+    def values(self):
+        return self._objects.values()
+
+    def is_pinned(self, obj):
+        """Check if we must keep a strong reference to an object.
+
+        We keep objects with unsaved changes and objects that have signal
+        handlers connected.
+        """
+        if obj.changed_attributes:
+            return True
+        for callbacks in obj.signal_callbacks.values():
+            if len(callbacks) > 0:
+                return True
+        return False
+
+    def shrink(self):
+        """Drop strong references to the least recently used objects until
+        we're at max_size.
+        """
+        if (self.max_size is None or
+                len(self._strong_refs) <= self._shrink_threshold):
+            return
+        to_sort = self._access_times.items()
+        to_sort.sort(key=lambda item: item[1])
+        to_remove = len(self._strong_refs) - self.max_size
+        for key, access_time in to_sort:
+            if to_remove <= 0:
+                break
+            if self.is_pinned(self._strong_refs[key]):
+                continue
+            del self._strong_refs[key]
+            del self._access_times[key]
+            self.evictions += 1
+            to_remove -= 1
+        # If we couldn't get down to max_size because of pinned objects,
+        # wait until we grow a bit more before trying again.
+        self._shrink_threshold = max(self.max_size,
+                len(self._strong_refs) + self.max_size // 4)
+
+    def resident_count(self):
+        """Get the number of objects that we keep alive."""
+        return len(self._strong_refs)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        return ('ObjectIdentityMap: %d objects, %d resident (max: %s), '
+                '%d evictions, hit rate: %0.1f%%' %
+                (len(self), self.resident_count(), self.max_size,
+                 self.evictions, self.hit_rate() * 100))
+
 class DatabaseObjectCache(object):
     """Handles caching objects for a database.
 
     This class implements a generic caching system for DDBObjects.  Other
     components can use it reduce the number of database queries they run.
+
+    If weak is True, we only store weak references to objects.  Once an object
+    is garbage collected, get() returns None for its key.
     """
-    def __init__(self):
+    def __init__(self, weak=False):
         # map (category, cache_key) to objects
         self._objects = {}
+        self.weak = weak
 
     def set(self, category, cache_key, obj):
         """Add an object to the cache
@@ -132,6 +265,8 @@ class DatabaseObjectCache(object):
         :param key: key to retrieve the object with
         :param obj: object to add
         """
+        if self.weak and obj is not None:
+            obj = weakref.ref(obj)
         self._objects[(category, cache_key)] = obj
 
     def get(self, category, cache_key):
@@ -142,7 +277,10 @@ class DatabaseObjectCache(object):
         :returns: object passed in with set
         :raises KeyError: object not in cache
         """
-        return self._objects[(category, cache_key)]
+        obj = self._objects[(category, cache_key)]
+        if self.weak and obj is not None:
+            obj = obj()
+        return obj
 
     def key_exists(self, category, cache_key):
         """Test if an object is in the cache
@@ -175,6 +313,122 @@ class DatabaseObjectCache(object):
         """Clear all objects in the cache"""
         self._objects = {}
 
+class WALCheckpointer(object):
+    """Runs WAL checkpoints from a background thread.
+
+    Normally SQLite runs a checkpoint inside the COMMIT that makes the WAL
+    grow past 1000 pages.  For us, that means the event loop stalls while
+    the checkpoint runs.  WALCheckpointer uses its own connection and runs
+    PASSIVE checkpoints once the database has been idle for a bit and
+    either the WAL is large or we haven't checkpointed in a while.
+
+    PASSIVE checkpoints never wait on readers or writers, so they can't
+    block the event loop thread.
+    """
+
+    # how long the DB needs to be idle before we checkpoint (seconds)
+    IDLE_TIME = 1.0
+    # checkpoint once the WAL grows this large (bytes)
+    MIN_WAL_SIZE = 4 * 1024 * 1024
+    # checkpoint at least this often, if the WAL has changed (seconds)
+    MAX_INTERVAL = 60.0
+
+    def __init__(self, path, time_callback):
+        """Create a WALCheckpointer
+
+        :param path: path to the database
+        :param time_callback: function to call with the SQL and time for each
+            checkpoint we run
+        """
+        self.path = path
+        self.wal_path = path + '-wal'
+        self.time_callback = time_callback
+        self.last_activity = time.time()
+        self.last_checkpoint = time.time()
+        self.checkpoint_count = 0
+        self._last_checkpointed_wal = None
+        self._condition = threading.Condition()
+        self._quit_flag = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(name="WAL Checkpointer",
+                                       target=self._thread_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self._condition.acquire()
+        try:
+            self._quit_flag = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        self.thread.join()
+        self.thread = None
+
+    def note_activity(self):
+        """Call this when the database gets written to."""
+        self.last_activity = time.time()
+
+    def _thread_loop(self):
+        # connections can only be used from the thread that created them, so
+        # make the pool here.
+        pool = connectionpool.ConnectionPool(self.path, min_connections=1,
+                                             max_connections=1)
+        connection = pool.get_connection()
+        try:
+            while True:
+                self._condition.acquire()
+                try:
+                    if not self._quit_flag:
+                        self._condition.wait(self.IDLE_TIME)
+                    if self._quit_flag:
+                        break
+                finally:
+                    self._condition.release()
+                if self._should_checkpoint():
+                    self._run_checkpoint(connection)
+        finally:
+            pool.release_connection(connection)
+            pool.destroy()
+
+    def _wal_info(self):
+        """Get the (size, mtime) of the WAL file, or None."""
+        try:
+            stat = os.stat(self.wal_path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def _should_checkpoint(self):
+        now = time.time()
+        if now - self.last_activity < self.IDLE_TIME:
+            return False
+        wal_info = self._wal_info()
+        if (wal_info is None or wal_info[0] == 0 or
+                wal_info == self._last_checkpointed_wal):
+            return False
+        return (wal_info[0] >= self.MIN_WAL_SIZE or
+                now - self.last_checkpoint >= self.MAX_INTERVAL)
+
+    def _run_checkpoint(self, connection):
+        sql = "PRAGMA wal_checkpoint(PASSIVE)"
+        wal_info = self._wal_info()
+        start = time.time()
+        try:
+            connection.execute(sql).fetchall()
+        except sqlite3.Error, e:
+            logging.warn("Error running WAL checkpoint: %s", e)
+            return
+        end = time.time()
+        self.last_checkpoint = end
+        self.checkpoint_count += 1
+        self._last_checkpointed_wal = wal_info
+        self.time_callback(sql, end - start)
+
 class LiveStorageErrorHandler(object):
     """Handle database errors for LiveStorage.
     """
@@ -387,10 +641,17 @@ class LiveStorage(signals.SignalEmitter):
 
     - transaction-finished(success) -- We committed or rolled back a
     transaction
+
+    If commit_coalesce_time is set, successful events don't commit right
+    away.  Instead we keep the transaction open and commit once
+    commit_coalesce_time seconds have passed since the first uncommitted
+    event.  Each event after the first runs inside a savepoint, so that a
+    failed event only rolls back its own changes.
     """
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
-                 start_in_temp_mode=False):
+                 start_in_temp_mode=False, object_cache_size=None,
+                 background_checkpoints=False, commit_coalesce_time=0):
         """Create a LiveStorage for a database
 
         :param path: path to the database (or ":memory:")
@@ -404,6 +665,13 @@ class LiveStorage(signals.SignalEmitter):
         :param start_in_temp_mode: True if this database should start in
                                    temporary mode (running in memory, but
                                    checking if it can write to the disk)
+        :param object_cache_size: max number of unused DDBObjects to keep in
+            memory.  Defaults to None, which means keep all of them.
+        :param background_checkpoints: Run WAL checkpoints from a background
+            thread rather than when we commit
+        :param commit_coalesce_time: Combine the transactions for events
+            that happen within this many seconds into one commit.  0 means
+            commit after each event.
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("transaction-finished")
@@ -431,20 +699,38 @@ class LiveStorage(signals.SignalEmitter):
         self.temp_mode = False
         self.preallocate = preallocate
         self.error_handler = error_handler
-        self.cache = DatabaseObjectCache()
+        self.cache = DatabaseObjectCache(weak=object_cache_size is not None)
         self.raise_load_errors = False # only gets set in unittests
         self.force_directory_creation = True # False for device databases
         self._query_times = {}
         self.path = path
         self._quitting_from_operational_error = False
+        self.background_checkpoints = background_checkpoints
+        self.checkpointer = None
+        self.commit_coalesce_time = commit_coalesce_time
+        # time that the first uncommitted event finished
+        self._coalesce_start = None
+        # are we inside a savepoint for the current event?
+        self._in_event_savepoint = False
+        self._statements_before_event = 0
         self._object_schemas = object_schemas
         self._schema_version = schema_version
         self._schema_map = {}
         self._schema_column_map = {}
         self._all_schemas = []
-        self._object_map = {} # maps object id -> DDBObjects in memory
+        self._object_cache_size = object_cache_size
+        # maps (id, table_name) -> DDBObjects in memory
+        self._object_map = ObjectIdentityMap(object_cache_size)
+        # (id, table_name) keys for objects that we've restored, including
+        # ones that have been evicted from _object_map since
         self._ids_loaded = set()
+        # keys for objects that are being restored after being evicted
+        self._reloaded_keys = set()
+        self._db_info = None
+        # maps schema -> {id: DDBObject} for objects with deferred columns
+        self._deferred_objects = {}
         self._statements_in_transaction = []
+        self._update_sql_cache = UpdateSQLCache(200)
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -514,6 +800,22 @@ class LiveStorage(signals.SignalEmitter):
         if actual_mode != u'wal' and not hasattr(app, 'in_unit_tests'):
             logging.warn("PRAGMA journal_mode=wal didn't change the "
                          "mode.  journal_mode=%s", actual_mode)
+        if actual_mode == u'wal' and self.background_checkpoints:
+            self._start_checkpointer()
+
+    def _start_checkpointer(self):
+        self._stop_checkpointer()
+        # Let the background thread handle checkpoints.  Keep a large
+        # automatic checkpoint limit in case we are never idle long enough
+        # for the background checkpoints to run.
+        self.cursor.execute("PRAGMA wal_autocheckpoint=10000")
+        self.checkpointer = WALCheckpointer(self.path, self._check_time)
+        self.checkpointer.start()
+
+    def _stop_checkpointer(self):
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
 
     def _ensure_database_directory_exists(self, path):
         if not self.force_directory_creation:
@@ -528,6 +830,7 @@ class LiveStorage(signals.SignalEmitter):
         disk every 5 minutes.  Temporary mode is used to handle errors when
         trying to open a database file.
         """
+        self._stop_checkpointer()
         self.connection = sqlite3.connect(':memory:',
                                           isolation_level=None,
                                           detect_types=sqlite3.PARSE_DECLTYPES)
@@ -620,6 +923,7 @@ class LiveStorage(signals.SignalEmitter):
     def close(self):
         logging.info("closing database")
         self.finish_transaction()
+        self._stop_checkpointer()
         self.connection.close()
 
     def get_backup_directory(self):
@@ -834,8 +1138,14 @@ class LiveStorage(signals.SignalEmitter):
 
     def remember_object(self, obj):
         key = (obj.id, obj.db_info.db.table_name(obj.__class__))
+        if key in self._ids_loaded and key not in self._object_map:
+            self._reloaded_keys.add(key)
         self._object_map[key] = obj
         self._ids_loaded.add(key)
+        self._db_info = obj.db_info
+        if obj._deferred_columns:
+            obj_schema = self._schema_map[obj.__class__]
+            self._deferred_objects.setdefault(obj_schema, {})[obj.id] = obj
 
     def forget_object(self, obj):
         key = (obj.id, obj.db_info.db.table_name(obj.__class__))
@@ -847,10 +1157,16 @@ class LiveStorage(signals.SignalEmitter):
                        (obj.id, obj))
             logging.error(details)
         self._ids_loaded.discard(key)
+        self._reloaded_keys.discard(key)
+        if obj._deferred_columns:
+            obj_schema = self._schema_map[obj.__class__]
+            self._deferred_objects.get(obj_schema, {}).pop(obj.id, None)
 
     def forget_all_objects(self):
-        self._object_map = {}
+        self._object_map = ObjectIdentityMap(self._object_cache_size)
         self._ids_loaded = set()
+        self._reloaded_keys = set()
+        self._deferred_objects = {}
 
     def _insert_sql_for_schema(self, obj_schema):
         return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
@@ -898,17 +1214,22 @@ class LiveStorage(signals.SignalEmitter):
         for obj in objects:
             obj.reset_changed_attributes()
 
-    def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+    def _update_values_for_obj(self, obj_schema, obj):
+        """Get the columns and values to UPDATE for an object.
 
-        obj_schema = self._schema_map[obj.__class__]
-        setters = []
+        :returns: (columns, values) tuple.  columns is a tuple of column
+            names, values is a list of values for those columns.
+        """
+        columns = []
         values = []
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
+            if name in obj._deferred_columns:
+                # not loaded yet, so it can't have changed
+                continue
+            columns.append(name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
@@ -918,19 +1239,49 @@ class LiveStorage(signals.SignalEmitter):
             values.append(self._converter.to_sql(obj_schema, name,
                 schema_item, value))
         obj.reset_changed_attributes()
+        return tuple(columns), values
+
+    def _check_update_rowcount(self, expected_count, obj_ids):
+        if (self.cursor.rowcount != expected_count and not
+                self._quitting_from_operational_error):
+            if self.cursor.rowcount < expected_count:
+                raise KeyError("Updating non-existent row (ids: %s)" %
+                        obj_ids)
+            else:
+                raise ValueError("Update changed multiple rows "
+                        "(ids: %s, count: %s)" %
+                        (obj_ids, self.cursor.rowcount))
+
+    def update_obj(self, obj):
+        """Update a DDBObject on disk."""
+
+        obj_schema = self._schema_map[obj.__class__]
+        columns, values = self._update_values_for_obj(obj_schema, obj)
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
+            sql = self._update_sql_cache.get((obj_schema, columns))
+            values.append(obj.id)
             self._execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
-                    self._quitting_from_operational_error):
-                if self.cursor.rowcount == 0:
-                    raise KeyError("Updating non-existent row (id: %s)" %
-                            obj.id)
-                else:
-                    raise ValueError("Update changed multiple rows "
-                            "(id: %s, count: %s)" %
-                            (obj.id, self.cursor.rowcount))
+            self._check_update_rowcount(1, obj.id)
+
+    def bulk_update(self, objects):
+        """Update a list of objects in one go.
+
+        Objects are grouped by the columns that changed, then each group is
+        sent to SQLite with a single executemany() call.
+        """
+        groups = {}
+        for obj in objects:
+            obj_schema = self._schema_map[obj.__class__]
+            columns, values = self._update_values_for_obj(obj_schema, obj)
+            if not values:
+                continue
+            values.append(obj.id)
+            groups.setdefault((obj_schema, columns), []).append(values)
+        for key, value_list in groups.items():
+            sql = self._update_sql_cache.get(key)
+            self._execute(sql, value_list, is_update=True, many=True)
+            self._check_update_rowcount(len(value_list),
+                                        [values[-1] for values in value_list])
 
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
@@ -982,13 +1333,41 @@ class LiveStorage(signals.SignalEmitter):
         """Get a particular DDBObject.
 
         This will throw a KeyError if id is not in the database, or if the
-        object for id has not been loaded yet.
+        object for id has not been loaded yet.  Objects that were evicted
+        from memory get restored again.
         """
-        return self._object_map[(id_, self.table_name(klass))]
+        key = (id_, self.table_name(klass))
+        try:
+            return self._object_map[key]
+        except KeyError:
+            if key not in self._ids_loaded:
+                raise
+        self._restore_objects(self._schema_map[klass], [id_], self._db_info)
+        return self._object_map[key]
 
     def id_alive(self, id_, klass):
-        """Check if an id exists and is loaded in the database."""
-        return (id_, self.table_name(klass)) in self._object_map
+        """Check if an id exists and is loaded in the database.
+
+        Objects that were evicted from memory count as loaded.
+        """
+        return (id_, self.table_name(klass)) in self._ids_loaded
+
+    def object_was_evicted(self, obj):
+        """Check if obj is being restored after being evicted from memory.
+
+        setup_restored() can use this to avoid redoing work that should only
+        happen the first time an object is loaded.
+        """
+        key = (obj.id, self.table_name(obj.__class__))
+        return key in self._reloaded_keys
+
+    def shrink_object_map(self):
+        """Evict the least recently used objects from memory."""
+        self._object_map.shrink()
+        self._reloaded_keys = set()
+
+    def object_map_stats(self):
+        return self._object_map.stats()
 
     def fetch_item_infos(self, item_ids):
         return item.fetch_item_infos(self.connection, item_ids)
@@ -999,6 +1378,16 @@ class LiveStorage(signals.SignalEmitter):
     def schema_fields(self, klass):
         return self._schema_map[klass].fields
 
+    def schema_fields_for_table(self, table_name):
+        """Get the schema fields for a table name.
+
+        :raises KeyError: if no schema uses table_name
+        """
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return oschema.fields
+        raise KeyError(table_name)
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
@@ -1016,20 +1405,22 @@ class LiveStorage(signals.SignalEmitter):
             sql.write(" LIMIT %s" % limit)
         return sql.getvalue()
 
-    def ensure_objects_loaded(self, klass, id_list, db_info):
+    def ensure_objects_loaded(self, klass, id_list, db_info, columns=None):
         """Ensure that a list of ids are loaded into memory.
 
+        :param columns: if given, only restore these columns (plus the
+            schema's eager_columns).  Other columns are loaded on first access.
         :returns: True iff we needed to load objects
         """
         table_name = self.table_name(klass)
         unrestored_ids = []
         for id_ in id_list:
-            if (id_, table_name) not in self._ids_loaded:
+            if (id_, table_name) not in self._object_map:
                 unrestored_ids.append(id_)
         if unrestored_ids:
             # restore any objects that we don't already have in memory.
             schema = self._schema_map[klass]
-            self._restore_objects(schema, unrestored_ids, db_info)
+            self._restore_objects(schema, unrestored_ids, db_info, columns)
             return True
         return False
 
@@ -1042,9 +1433,18 @@ class LiveStorage(signals.SignalEmitter):
         self.cursor.execute(sql.getvalue(), values)
         return (row[0] for row in self.cursor.fetchall())
 
-    def _restore_objects(self, schema, id_set, db_info):
-        column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
+    def _restore_objects(self, schema, id_set, db_info, columns=None):
+        if columns is None:
+            fields = schema.fields
+            deferred_columns = None
+        else:
+            wanted = set(columns)
+            wanted.add('id')
+            wanted.update(schema.eager_columns)
+            fields = [f for f in schema.fields if f[0] in wanted]
+            deferred_columns = frozenset(f[0] for f in schema.fields
+                                         if f[0] not in wanted)
+        column_names = ['%s.%s' % (schema.table_name, f[0]) for f in fields]
 
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
@@ -1057,14 +1457,27 @@ class LiveStorage(signals.SignalEmitter):
 
             self.cursor.execute(sql.getvalue(), id_list_chunk)
             for row in self.cursor.fetchall():
-                self._restore_object_from_row(schema, row, db_info)
+                self._restore_object_from_row(schema, row, db_info, fields,
+                                              deferred_columns)
+
+    def _restore_object_from_row(self, schema, db_row, db_info, fields=None,
+                                 deferred_columns=None):
+        if fields is None:
+            fields = schema.fields
+        restored_data = self._restored_data_from_row(schema, fields, db_row)
+        klass = schema.get_ddb_class(restored_data)
+        return klass(restored_data=restored_data, db_info=db_info,
+                     deferred_columns=deferred_columns)
+
+    def _restored_data_from_row(self, schema, fields, db_row):
+        """Convert a DB row to a dict of python values.
 
-    def _restore_object_from_row(self, schema, db_row, db_info):
+        fields must include the id column.
+        """
         restored_data = {}
         columns_to_update = []
         values_to_update = []
-        for (name, schema_item), value in \
-                itertools.izip(schema.fields, db_row):
+        for (name, schema_item), value in itertools.izip(fields, db_row):
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
@@ -1093,8 +1506,52 @@ class LiveStorage(signals.SignalEmitter):
             sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
                     ', '.join(setters), restored_data['id'])
             self._execute(sql, values_to_update)
-        klass = schema.get_ddb_class(restored_data)
-        return klass(restored_data=restored_data, db_info=db_info)
+        return restored_data
+
+    def load_deferred_columns(self, obj):
+        """Load the columns that we skipped when restoring an object.
+
+        Besides obj, we also load deferred columns for other objects from
+        the same table, up to one chunk of ids, so that iterating through a
+        projected view only needs one query per chunk.
+
+        :raises ObjectNotFoundError: obj's row is no longer in the DB
+        """
+        obj_schema = self._schema_map[obj.__class__]
+        pending = self._deferred_objects.get(obj_schema, {})
+        pending.pop(obj.id, None)
+        to_load = [obj]
+        for other in pending.values():
+            if len(to_load) >= util.SQLITE_CHUNK_SIZE:
+                break
+            to_load.append(other)
+        column_set = set()
+        for loading_obj in to_load:
+            column_set.update(loading_obj._deferred_columns)
+        column_set.add('id')
+        fields = [f for f in obj_schema.fields if f[0] in column_set]
+        objects_by_id = dict((o.id, o) for o in to_load)
+
+        sql = "SELECT %s FROM %s WHERE id IN (%s)" % (
+            ', '.join(f[0] for f in fields), obj_schema.table_name,
+            ', '.join('?' for i in xrange(len(to_load))))
+        loaded = []
+        for row in self._execute(sql, objects_by_id.keys()):
+            restored_data = self._restored_data_from_row(obj_schema, fields,
+                                                         row)
+            loading_obj = objects_by_id[restored_data['id']]
+            for name in loading_obj._deferred_columns:
+                loading_obj.__dict__[name] = restored_data[name]
+            loaded.append(loading_obj)
+        for loading_obj in loaded:
+            # remove the instance attribute, which falls back to the empty
+            # set on DDBObject
+            loading_obj.__dict__.pop('_deferred_columns', None)
+            pending.pop(loading_obj.id, None)
+        if obj.id not in set(o.id for o in loaded):
+            raise database.ObjectNotFoundError(
+                "row for %s (id: %s) deleted before loading deferred "
+                "columns" % (obj.__class__.__name__, obj.id))
 
     def persistent_object_count(self):
         return len(self._object_map)
@@ -1137,16 +1594,59 @@ class LiveStorage(signals.SignalEmitter):
         return rows
 
     def on_event_finished(self, eventloop, success):
-        self.finish_transaction(commit=success)
+        if self._coalesce_start is None:
+            if success and self._should_coalesce_commit():
+                # keep the transaction open and commit it later
+                self._coalesce_start = time.time()
+                eventloop.add_timeout(self.commit_coalesce_time,
+                                      self.finish_transaction,
+                                      "commit coalesced transaction")
+            else:
+                self.finish_transaction(commit=success)
+        else:
+            self._finish_event_savepoint(success)
+            if (time.time() - self._coalesce_start >=
+                    self.commit_coalesce_time):
+                self.finish_transaction()
+        self.shrink_object_map()
+
+    def _should_coalesce_commit(self):
+        return (self.commit_coalesce_time > 0 and
+                len(self._statements_in_transaction) > 0 and
+                not self._quitting_from_operational_error)
+
+    def has_pending_commit(self):
+        """Check if we have changes from earlier events waiting to be
+        committed.
+        """
+        return self._coalesce_start is not None
+
+    def _finish_event_savepoint(self, success):
+        if not self._in_event_savepoint:
+            return
+        if success:
+            self.cursor.execute("RELEASE SAVEPOINT miro_event")
+        else:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT miro_event")
+            self.cursor.execute("RELEASE SAVEPOINT miro_event")
+            del self._statements_in_transaction[
+                self._statements_before_event:]
+        self._in_event_savepoint = False
 
     def finish_transaction(self, commit=True):
+        # COMMIT/ROLLBACK also end any savepoint that's open
+        self._coalesce_start = None
+        self._in_event_savepoint = False
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
+            start = time.time()
             if commit:
-                self.cursor.execute("COMMIT TRANSACTION")
+                sql = "COMMIT TRANSACTION"
             else:
-                self.cursor.execute("ROLLBACK TRANSACTION")
+                sql = "ROLLBACK TRANSACTION"
+            self.cursor.execute(sql)
+            self._check_time(sql, time.time() - start)
         self._statements_in_transaction = []
         self.emit("transaction-finished", commit)
 
@@ -1157,6 +1657,16 @@ class LiveStorage(signals.SignalEmitter):
 
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
+        elif (is_update and self._coalesce_start is not None and
+                not self._in_event_savepoint):
+            # first change in an event whose transaction is being coalesced
+            # with earlier ones.
+            self.cursor.execute("SAVEPOINT miro_event")
+            self._in_event_savepoint = True
+            self._statements_before_event = len(
+                self._statements_in_transaction)
+        if is_update and self.checkpointer is not None:
+            self.checkpointer.note_activity()
 
         if values is None:
             values = ()
@@ -72,8 +72,15 @@ def _on_windows():
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Messages are sent in batches.  Each batch contains a
+# length (a unsigned long) followed by a pickled list of message objects.  We
+# use the binary pickle protocol, which is much more compact than the default
+# text protocol for our messages.
+#
+# In the main process, SubprocessManager queues up messages and writes them
+# out together in an idle callback.  In the subprocess, PipeMessageProxy
+# writes out messages right away if it can, but if another thread is
+# already writing, the messages get sent together in the next batch.
 #
 # The communication goes like this:
 #
@@ -282,15 +289,15 @@ def _read_bytes_from_pipe(pipe, length):
         data.append(d)
     return ''.join(data)
 
-def _load_obj(pipe):
-    """Load an object from one side of a pipe.
+def _load_objs(pipe):
+    """Load a batch of objects from one side of a pipe.
 
-    _load_obj blocks until the all the data has been sent.
+    _load_objs blocks until the all the data has been sent.
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
 
-    :returns: Python object send from the other side
+    :returns: list of Python objects sent from the other side
     """
     size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
     if len(size_data) < SIZEOF_LONG:
@@ -302,7 +309,7 @@ def _load_obj(pipe):
         raise LoadError("EOF reached while reading pickle data "
                 "(read %s bytes)" % len(pickle_data))
     try:
-        return pickle.loads(pickle_data)
+        objs = pickle.loads(pickle_data)
     except pickle.PickleError:
         raise LoadError("Pickle data corrupt")
     except ImportError:
@@ -311,15 +318,24 @@ def _load_obj(pipe):
         # log this exception for easier debugging.
         send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
+    if not isinstance(objs, list):
+        raise LoadError("Pickle data is not a list")
+    return objs
 
-def _dump_obj(obj, pipe):
-    """Dump an object to the other side of the pipe.
+# cPickle raises TypeError for some objects that can't be pickled, like locks
+_PICKLE_ERRORS = (pickle.PickleError, TypeError)
+
+def _dump_objs(objs, pipe):
+    """Dump a list of objects to the other side of the pipe.
+
+    All of the objects get sent with a single write.
 
     :raises IOError: low-level error while writing to the pipe
-    :raises pickle.PickleError: obj could not be pickled
+    :raises pickle.PickleError, TypeError: an object could not be pickled.  In
+    this case nothing is written.
     """
 
-    pickle_data = pickle.dumps(obj)
+    pickle_data = pickle.dumps(objs, pickle.HIGHEST_PROTOCOL)
     size_data = struct.pack("Q", len(pickle_data))
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
@@ -327,10 +343,43 @@ def _dump_obj(obj, pipe):
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    pipe.write(size_data + pickle_data)
     pipe.flush()
 
+def _dump_obj(obj, pipe):
+    """Dump a single object to the other side of the pipe.
+
+    :raises IOError: low-level error while writing to the pipe
+    :raises pickle.PickleError, TypeError: obj could not be pickled
+    """
+    _dump_objs([obj], pipe)
+
+def _dump_batch(objs, pipe):
+    """Dump a list of objects, skipping any that can't be pickled.
+
+    :raises IOError: low-level error while writing to the pipe
+    :returns: list of objects that could not be pickled
+    """
+    try:
+        _dump_objs(objs, pipe)
+        return []
+    except _PICKLE_ERRORS:
+        if len(objs) == 1:
+            return list(objs)
+    # figure out which objects are causing the problem and send the rest
+    good_objs = []
+    bad_objs = []
+    for obj in objs:
+        try:
+            pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except _PICKLE_ERRORS:
+            bad_objs.append(obj)
+        else:
+            good_objs.append(obj)
+    if good_objs:
+        _dump_objs(good_objs, pipe)
+    return bad_objs
+
 class SubprocessManager(object):
     """Manages a running subprocess
 
@@ -346,7 +395,9 @@ class SubprocessManager(object):
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, we don't
+        install a handler and messages must be sent with send_message().  This
+        is useful when several SubprocessManagers share a message class.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -358,7 +409,8 @@ class SubprocessManager(object):
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
@@ -368,6 +420,11 @@ class SubprocessManager(object):
         self.thread = None
         self.start_time = 0
         self.restart_delay = restart_delay
+        # DelayedCall for restarting a process that crashed too quickly
+        self.restart_timeout = None
+        # messages waiting to be written to the subprocess
+        self.write_queue = []
+        self.write_scheduled = False
 
     # Process management
 
@@ -421,8 +478,14 @@ class SubprocessManager(object):
         if not self.is_running:
             return
 
+        self._cancel_restart_timeout()
         # we're about to shut down, tell our responder
         trapcall.trap_call("subprocess shutdown", self.responder.on_shutdown)
+        if self.process.poll() is not None:
+            # Our process already quit and we were waiting to restart it.
+            # There's nothing to ask to quit or to kill.
+            self._cleanup_process()
+            return
         # Politely ask our process to shutdown
         self.send_quit()
         # If things go right, the process will quit, then our thread will
@@ -487,10 +550,20 @@ class SubprocessManager(object):
             else:
                 logging.warn("Subprocess died in %0.1f seconds, waiting "
                              "%0.1f to restart", time_since_start, delay_time)
-                eventloop.add_timeout(delay_time, self.restart,
-                                      'restart failed subprocess')
+                self.restart_timeout = eventloop.add_timeout(delay_time,
+                        self._delayed_restart, 'restart failed subprocess')
+
+    def _delayed_restart(self):
+        self.restart_timeout = None
+        self.restart()
+
+    def _cancel_restart_timeout(self):
+        if self.restart_timeout is not None:
+            self.restart_timeout.cancel()
+            self.restart_timeout = None
 
     def restart(self, clean=False):
+        self._cancel_restart_timeout()
         if clean:
             self.shutdown()
         else:
@@ -509,32 +582,58 @@ class SubprocessManager(object):
         self.thread = None
         self.process = None
         self.is_running = False
+        # any messages still waiting were meant for the old process
+        self.write_queue = []
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        Messages are queued up and sent together in an idle callback, so that
+        we don't need a separate write for each one.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
+        self.write_queue.append(msg)
+        if not self.write_scheduled:
+            self.write_scheduled = True
+            eventloop.add_idle(self.flush_write_queue,
+                               'write subprocess messages')
+
+    def flush_write_queue(self):
+        """Write out all the messages queued by send_message()."""
+        self.write_scheduled = False
+        if not self.write_queue or not self.is_running:
+            return
+        messages = self.write_queue
+        self.write_queue = []
         try:
-            _dump_obj(msg, self.process.stdin)
+            bad_messages = _dump_batch(messages, self.process.stdin)
         except IOError:
-            logging.warn("Broken pipe in send_message()")
+            logging.warn("Broken pipe in flush_write_queue()")
             # we could try to restart our subprocess here, but if the pipe is
             # really broken, then our thread will quit soon and this will
             # cause a restart.
-        except pickle.PickleError:
-            logging.warn("Error pickling message in send_message() (%s)", msg)
+        else:
+            for msg in bad_messages:
+                logging.warn("Error pickling message in send_message() (%s)",
+                             msg)
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        self.flush_write_queue()
         self.sent_quit = True
 
     def _send_startup_info(self):
         self.send_message(StartupInfo(self._get_config_dict(),
                                       hasattr(app, 'in_unit_tests')))
+        # StartupInfo must be unpickled by itself.  The subprocess needs to
+        # load the config before it unpickles anything else, so don't let
+        # it get batched together with the messages that follow.
+        self.flush_write_queue()
         self.send_message(HandlerInfo(self.handler_class, self.handler_args))
 
     def _get_config_dict(self):
@@ -562,16 +661,16 @@ def _read_from_pipe(pipe):
     This method is a generator that reads pickled objects from pipe.  It
     terminates when None is sent over the pipe.
 
-    raises the same exceptions that _load_obj does, namely:
+    raises the same exceptions that _load_objs does, namely:
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
     """
     while True:
-        msg = _load_obj(pipe)
-        if msg is None:
-            return # other side wants to quit
-        yield msg
+        for msg in _load_objs(pipe):
+            if msg is None:
+                return # other side wants to quit
+            yield msg
 
 class SubprocessResponderThread(threading.Thread):
     """Thread that implements our run loop to handle subprocess output.
@@ -635,9 +734,12 @@ def subprocess_main():
     stdin = sys.stdin
     stdout = sys.stdout
     sys.stdout = sys.stdin = None
+    # messages from stdin can come in batches, so we need to use the same
+    # generator for the startup messages and the rest of them.
+    messages = _read_from_pipe(stdin)
     # initialize things
     try:
-        handler = _subprocess_setup(stdin, stdout)
+        handler = _subprocess_setup(messages, stdout)
     except Exception, e:
         # error reading our initial messages.  Try to log a warning, then
         # quit.
@@ -648,8 +750,8 @@ def subprocess_main():
     logging.info("_subprocess_setup() finished")
     # startup thread to process stdin
     queue = Queue.Queue()
-    thread = threading.Thread(target=_subprocess_pipe_thread, args=(stdin,
-        queue))
+    thread = threading.Thread(target=_subprocess_pipe_thread,
+                              args=(messages, queue))
     thread.daemon = False
     thread.start()
     # run our message loop
@@ -680,12 +782,21 @@ def _finish_subprocess_message_stream(stdout):
     # Note we don't catch PickleError, but there should never be an issue
     # pickling None
 
-def _subprocess_setup(stdin, stdout):
+def _next_startup_message(messages):
+    try:
+        return messages.next()
+    except StopIteration:
+        raise LoadError("pipe closed while reading startup messages")
+
+def _subprocess_setup(messages, stdout):
     """Does initial setup for a subprocess.
 
     Returns a SubprocessHandler to use for the subprocess
 
-    raises the same exceptions that _load_obj does, namely:
+    :param messages: generator returned by _read_from_pipe() for stdin
+    :param stdout: stdout pipe
+
+    raises the same exceptions that _load_objs does, namely:
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
@@ -697,7 +808,7 @@ def _subprocess_setup(stdin, stdout):
     msg_handler = PipeMessageProxy(stdout)
     SubprocessResponse.install_handler(msg_handler)
     # load startup info
-    msg = _load_obj(stdin)
+    msg = _next_startup_message(messages)
     if not isinstance(msg, StartupInfo):
         raise LoadError("first message must a StartupInfo obj")
     # setup some basic modules like config and gtcache
@@ -711,7 +822,7 @@ def _subprocess_setup(stdin, stdout):
     logging_setup = True
     logging.info("Logging Started")
     # setup our handler
-    msg = _load_obj(stdin)
+    msg = _next_startup_message(messages)
     if not isinstance(msg, HandlerInfo):
         raise LoadError("second message must a HandlerInfo obj")
     try:
@@ -721,14 +832,16 @@ def _subprocess_setup(stdin, stdout):
         send_subprocess_error_for_exception()
         raise LoadError("Exception while constructing handler: %s" % e)
 
-def _subprocess_pipe_thread(stdin, queue):
+def _subprocess_pipe_thread(messages, queue):
     """Thread inside the subprocess that reads messages from stdin.
 
     We use a separate thread so that our pipe doesn't get backed up while we
     are process messages
+
+    :param messages: generator returned by _read_from_pipe() for stdin
     """
     try:
-        for msg in _read_from_pipe(stdin):
+        for msg in messages:
             queue.put(msg)
     except StandardError, e:
         # we could try to send a SubprocessError message, but it's highly
@@ -744,18 +857,38 @@ class PipeMessageProxy(object):
     This is used in the subprocess to send messages back to the main process
     over it's stdout pipe
 
-    It's safe for multiple threads in the subprocess to use this at once
+    It's safe for multiple threads in the subprocess to use this at once.  If
+    a thread tries to send a message while another one is writing, the
+    message is queued up and sent along with any others in the next batch.
     """
     def __init__(self, fileobj):
         self.fileobj = fileobj
-        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.queue_lock = threading.Lock()
+        self.queue = []
 
     def handle(self, msg):
-        try:
-            with self.lock:
-                _dump_obj(msg, self.fileobj)
-        except pickle.PickleError:
-            send_subprocess_error_for_exception()
+        with self.queue_lock:
+            self.queue.append(msg)
+        with self.write_lock:
+            with self.queue_lock:
+                messages = self.queue
+                self.queue = []
+            # messages will be empty if another thread sent our message
+            # while we were waiting for write_lock
+            if messages:
+                bad_messages = _dump_batch(messages, self.fileobj)
+            else:
+                bad_messages = []
         # NOTE: we don't handle IOError here because what can we do about
         # that?  Just let it propagate up to the top and which should cause us
         # to shutdown.
+        for msg in bad_messages:
+            self._send_pickle_error(msg)
+
+    def _send_pickle_error(self, msg):
+        # pickle msg again to get an exception to report
+        try:
+            pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        except _PICKLE_ERRORS:
+            send_subprocess_error_for_exception()
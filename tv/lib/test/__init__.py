@@ -57,6 +57,9 @@ from miro.test.opmltest import *
 from miro.test.schedulertest import *
 from miro.test.networktest import *
 from miro.test.httpclienttest import *
+from miro.test.httpcachetest import *
+from miro.test.metadatacachetest import *
+from miro.test.statusupdatestest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
@@ -159,6 +159,102 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+    def test_in_memory_check(self):
+        # simple WHERE clauses should be checked without running SQL
+        self.setup_view(item.Item.make_view('feed_id=? AND NOT keep',
+                                            (self.feed2.id,)))
+        self.assertNotEquals(self.tracker.predicate, None)
+        stats = app.db_info.view_tracker_manager.stats
+        stats.reset()
+        self.i1.feed_id = self.feed2.id
+        self.i1.signal_change()
+        self.assertEquals(self.add_callbacks, [self.i1])
+        self.i1.keep = True
+        self.i1.signal_change()
+        self.assertEquals(self.remove_callbacks, [self.i1])
+        self.assertEquals(stats.objects_checked, 2)
+        self.assertEquals(stats.memory_checks, 2)
+        self.assertEquals(stats.queries_run, 0)
+
+    def test_batched_check(self):
+        # trackers without a predicate should check all changed objects
+        # with a single query
+        self.setup_view(item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}))
+        self.assertEquals(self.tracker.predicate, None)
+        stats = app.db_info.view_tracker_manager.stats
+        stats.reset()
+        app.bulk_sql_manager.start()
+        for i in xrange(10):
+            item.Item(item.FeedParserValues({'title': u'item%d' % i}),
+                      feed_id=self.feed.id)
+        app.bulk_sql_manager.finish()
+        self.assertEquals(len(self.add_callbacks), 10)
+        self.assertEquals(stats.objects_checked, 10)
+        self.assertEquals(stats.queries_run, 1)
+        self.assertEquals(stats.queries_saved(), 9)
+
+class CompileWherePredicateTest(MiroTestCase):
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('count', schema.SchemaInt(noneOk=True)),
+        ('flag', schema.SchemaBool()),
+        ('name', schema.SchemaString(noneOk=True)),
+        ('data', schema.SchemaDict(schema.SchemaString(),
+                                   schema.SchemaString())),
+    ]
+
+    def compile(self, where, values=()):
+        return database.compile_where_predicate(where, values, 'test',
+                                                self.fields)
+
+    def make_obj(self, **kwargs):
+        class Obj(object):
+            pass
+        obj = Obj()
+        obj.count = obj.name = obj.data = None
+        obj.flag = False
+        obj.__dict__.update(kwargs)
+        return obj
+
+    def test_simple(self):
+        predicate = self.compile('count > ? AND test.name=?', (3, u'foo'))
+        self.assertTrue(predicate(self.make_obj(count=4, name=u'foo')))
+        self.assertFalse(predicate(self.make_obj(count=3, name=u'foo')))
+        self.assertFalse(predicate(self.make_obj(count=4, name=u'bar')))
+        # comparisons with NULL are always false
+        self.assertFalse(predicate(self.make_obj(name=u'foo')))
+
+    def test_literals(self):
+        predicate = self.compile("count=-1 AND name <> 'foo'")
+        self.assertTrue(predicate(self.make_obj(count=-1, name=u'bar')))
+        self.assertFalse(predicate(self.make_obj(count=-1, name=u'foo')))
+
+    def test_null_and_truth(self):
+        predicate = self.compile('name IS NOT NULL AND NOT flag AND '
+                                 'count IS NULL')
+        self.assertTrue(predicate(self.make_obj(name=u'foo')))
+        self.assertFalse(predicate(self.make_obj(name=u'foo', flag=True)))
+        self.assertFalse(predicate(self.make_obj(name=u'foo', count=1)))
+        self.assertFalse(predicate(self.make_obj()))
+
+    def test_no_where(self):
+        self.assertTrue(self.compile(None)(self.make_obj()))
+
+    def test_unsupported(self):
+        for where, values in [
+            ('name LIKE ?', (u'foo%',)),
+            ('count=1 OR flag', ()),
+            ('data=?', ({},)),
+            ('other.count=1', ()),
+            ('missing=1', ()),
+            ('name < ?', (u'foo',)),
+            ('count=?', (u'foo',)),
+            ('count=?', (1, 2)),
+            ("name='it''s'", ()),
+            ]:
+            self.assertEquals(self.compile(where, values), None)
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
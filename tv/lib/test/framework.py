@@ -552,8 +552,7 @@ class MiroTestCase(unittest.TestCase):
         data.init(self.db_path)
 
     def clear_ddb_object_cache(self):
-        app.db._ids_loaded = set()
-        app.db._object_map = {}
+        app.db.forget_all_objects()
         app.db.cache = storedatabase.DatabaseObjectCache()
 
     def setup_new_database(self, path, **kwargs):
@@ -688,12 +687,12 @@ class EventLoopTest(MiroTestCase):
         eventloop.add_idle(function, name, args=None, kwargs=None)
 
     def hasIdles(self):
-        return not (eventloop._eventloop.idle_queue.queue.empty() and
-                    eventloop._eventloop.urgent_queue.queue.empty())
+        return (eventloop._eventloop.idle_queue.has_pending_idle() or
+                eventloop._eventloop.urgent_queue.has_pending_idle())
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while eventloop._eventloop.threadpool.has_pending_tasks():
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
@@ -0,0 +1,127 @@
+import os
+
+from miro import httpcache
+from miro.test.framework import MiroTestCase
+
+# The timestamp is Fri, 13 Feb 2009 23:31:30 GMT
+NOW = 1234567890
+NOW_STRING = 'Fri, 13 Feb 2009 23:31:30 GMT'
+
+class CalcExpirationTest(MiroTestCase):
+    def check_expiration(self, headers, correct_value):
+        self.assertEquals(httpcache.calc_expiration(headers, NOW),
+                          correct_value)
+
+    def test_max_age(self):
+        self.check_expiration({'cache-control': 'public, max-age=60'},
+                              NOW + 60)
+        self.check_expiration({'cache-control': 'max-age="60"'}, NOW + 60)
+        self.check_expiration({'cache-control': 'max-age=abc'}, NOW)
+
+    def test_no_store(self):
+        self.check_expiration({'cache-control': 'no-store'}, None)
+
+    def test_no_cache(self):
+        self.check_expiration({'cache-control': 'no-cache, max-age=60'},
+                              NOW)
+
+    def test_expires(self):
+        # Expires should be relative to the Date header
+        self.check_expiration({
+            'date': 'Fri, 13 Feb 2009 23:00:00 GMT',
+            'expires': 'Fri, 13 Feb 2009 23:10:00 GMT',
+            }, NOW + 600)
+        self.check_expiration({'expires': '0'}, NOW)
+
+    def test_heuristic(self):
+        self.check_expiration({
+            'date': NOW_STRING,
+            'last-modified': 'Fri, 13 Feb 2009 22:31:30 GMT',
+            }, NOW + 360)
+        self.check_expiration({
+            'date': NOW_STRING,
+            'last-modified': 'Thu, 01 Jan 2009 00:00:00 GMT',
+            }, NOW + httpcache.MAX_HEURISTIC_FRESHNESS)
+
+    def test_nothing(self):
+        self.check_expiration({}, NOW)
+
+class HTTPCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.tempdir, 'http-cache')
+        self.cache = httpcache.HTTPCache(self.cache_dir, 100000)
+
+    def make_info(self, body='body', **headers):
+        info = {'status': 200, 'body': body}
+        info.update(headers)
+        return info
+
+    def test_store(self):
+        url = 'http://example.com/'
+        info = self.make_info(**{'cache-control': 'max-age=60'})
+        self.assert_(self.cache.store(url, info))
+        entry = self.cache.lookup(url)
+        self.assertEquals(entry.url, url)
+        self.assert_(entry.is_fresh())
+        self.assertEquals(entry.make_info()['body'], 'body')
+        self.assertEquals(entry.make_info()['from-cache'], True)
+        self.assertEquals(self.cache.lookup('http://example.com/other'),
+                          None)
+
+    def test_persists(self):
+        url = 'http://example.com/'
+        self.cache.store(url, self.make_info(etag='abc'))
+        cache2 = httpcache.HTTPCache(self.cache_dir, 100000)
+        entry = cache2.lookup(url)
+        self.assertEquals(entry.etag(), 'abc')
+        self.assert_(not entry.is_fresh())
+        self.assert_(entry.can_revalidate())
+
+    def test_not_stored(self):
+        # responses without freshness info or validators are useless
+        self.assert_(not self.cache.store('http://example.com/',
+                                          self.make_info()))
+        self.assert_(not self.cache.store('http://example.com/',
+            self.make_info(etag='abc', **{'cache-control': 'no-store'})))
+        self.assertEquals(self.cache.lookup('http://example.com/'), None)
+
+    def test_refresh(self):
+        url = 'http://example.com/'
+        self.cache.store(url, self.make_info(etag='abc'), now=NOW)
+        entry = self.cache.lookup(url)
+        self.cache.refresh(entry, {'cache-control': 'max-age=60',
+                                   'content-length': '0'})
+        entry = self.cache.lookup(url)
+        self.assert_(entry.is_fresh())
+        self.assertEquals(entry.etag(), 'abc')
+        self.assertEquals(entry.info['body'], 'body')
+        self.assert_('content-length' not in entry.info)
+
+    def test_lru(self):
+        self.cache.max_size = 20000
+        info = self.make_info(body='x' * 1000, etag='abc')
+        for i in xrange(20):
+            self.cache.store('http://example.com/%d' % i, info,
+                             now=NOW + i)
+            self.cache.entries[self.cache._key(
+                'http://example.com/%d' % i)][1] = NOW + i
+            if i == 5:
+                # using an entry should keep it around
+                self.cache.lookup('http://example.com/0')
+        self.assert_(self.cache.total_size <= self.cache.max_size)
+        self.assertNotEquals(self.cache.lookup('http://example.com/0'), None)
+        self.assertEquals(self.cache.lookup('http://example.com/1'), None)
+        self.assertNotEquals(self.cache.lookup('http://example.com/19'),
+                             None)
+        self.assertEquals(len(os.listdir(self.cache_dir)),
+                          len(self.cache.entries))
+
+    def test_corrupt_entry(self):
+        url = 'http://example.com/'
+        self.cache.store(url, self.make_info(etag='abc'))
+        path = self.cache._path(self.cache._key(url))
+        open(path, 'wb').write('garbage')
+        with self.allow_warnings():
+            self.assertEquals(self.cache.lookup(url), None)
+        self.assert_(not os.path.exists(path))
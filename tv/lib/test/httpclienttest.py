@@ -10,6 +10,7 @@ from miro import prefs
 from miro import dialogs
 from miro import eventloop
 from miro import httpauth
+from miro import httpcache
 from miro import httpclient
 from miro import signals
 from miro.plat import resources
@@ -23,9 +24,8 @@ TEST_PATH = 'test.txt'
 def uses_mock_httpclient(fun):
     def _uses_mock_httpclient(self):
         self.mocked_multi = httpclient.curl_manager.multi = mock.Mock()
-        self.mocked_multi.timeout.return_value = -1
-        self.mocked_multi.fdset.return_value = ([], [], [])
-        self.mocked_multi.perform.return_value = (None, None)
+        self.mocked_multi.socket_action.return_value = (None, None)
+        self.mocked_multi.info_read.return_value = ([], [], [])
         return fun(self)
     wrapped = functools.update_wrapper(_uses_mock_httpclient, fun)
     return uses_httpclient(wrapped)
@@ -990,6 +990,54 @@ class BadURLTest(HTTPClientTestBase):
         self.check_errback_called()
         self.assert_(isinstance(self.grab_url_error, httpclient.MalformedURL))
 
+class HTTPCacheClientTest(HTTPClientTestBase):
+    def setUp(self):
+        HTTPClientTestBase.setUp(self)
+        self.cache = httpcache.HTTPCache(self.make_temp_dir_path(), 100000)
+        httpcache.http_cache = self.cache
+
+    def tearDown(self):
+        httpcache.http_cache = None
+        HTTPClientTestBase.tearDown(self)
+
+    @uses_httpclient
+    def test_fresh(self):
+        self.httpserver.add_header("cache-control", "max-age=3600")
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url)
+        self.assert_('from-cache' not in self.grab_url_info)
+        self.grab_url(url)
+        self.assertEquals(self.grab_url_info['from-cache'], True)
+        self.assertEquals(self.grab_url_info['body'],
+                          self.test_response_data)
+        self.assertEquals(self.cache.hits, 1)
+
+    @uses_httpclient
+    def test_revalidate(self):
+        self.httpserver.add_header("etag", "abc")
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url)
+        self.check_header_not_present('if-none-match')
+        # the response isn't fresh, so we should send a conditional request
+        self.grab_url(url)
+        self.assertEquals(self.last_http_info('headers')['if-none-match'],
+                          'abc')
+        self.assertEquals(self.grab_url_info['body'],
+                          self.test_response_data)
+
+    @uses_httpclient
+    def test_caller_etag(self):
+        # if the caller sends its own etag, we shouldn't use the cache
+        self.httpserver.add_header("cache-control", "max-age=3600")
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, etag='abc')
+        self.grab_url(url, etag='abc')
+        self.assert_('from-cache' not in self.grab_url_info)
+        self.assertEquals(self.cache.entries, None)
+
+    def check_header_not_present(self, key):
+        self.assert_(key not in self.last_http_info('headers'))
+
 class NetworkErrorTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -1074,3 +1122,148 @@ class NetworkErrorTest(HTTPClientTestBase):
             httpclient.NetworkError))
         self.assert_(isinstance(self.grab_url_error.longDescription, unicode))
         self.assert_(isinstance(self.grab_url_error.friendlyDescription, unicode))
+
+class LibCURLManagerSocketTest(EventLoopTest):
+    """Test how LibCURLManager handles the libcurl socket API callbacks."""
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.manager = httpclient.LibCURLManager()
+        self.manager.poller = mock.Mock()
+
+    def tearDown(self):
+        self.manager.multi.close()
+        EventLoopTest.tearDown(self)
+
+    def check_poller_calls(self, *correct_calls):
+        calls = [(name, args) for name, args, kwargs in
+                 self.manager.poller.method_calls]
+        self.assertEquals(calls, list(correct_calls))
+        self.manager.poller.reset_mock()
+
+    def test_socket_callback(self):
+        self.manager._socket_callback(pycurl.POLL_IN, 5, None, None)
+        self.check_poller_calls(('add_reader', (5,)))
+        self.manager._socket_callback(pycurl.POLL_INOUT, 5, None, None)
+        self.check_poller_calls(('add_writer', (5,)))
+        self.manager._socket_callback(pycurl.POLL_OUT, 5, None, None)
+        self.check_poller_calls(('remove_reader', (5,)))
+        self.manager._socket_callback(pycurl.POLL_REMOVE, 5, None, None)
+        self.check_poller_calls(('remove_writer', (5,)))
+        self.assertEquals(self.manager.socket_events, {})
+
+    def test_timer_callback(self):
+        self.assertEquals(self.manager.calc_timeout(), None)
+        self.manager._timer_callback(500)
+        self.assertAlmostEquals(self.manager.calc_timeout(), 0.5, places=1)
+        self.manager._timer_callback(-1)
+        self.assertEquals(self.manager.calc_timeout(), None)
+
+    def test_update_stats(self):
+        # only transfers that saw activity should have their stats updated
+        active = mock.Mock()
+        idle = mock.Mock()
+        self.manager.transfer_map = {active.handle: active,
+                                     idle.handle: idle}
+        self.manager.note_transfer_activity(active)
+        self.manager.update_stats()
+        self.assertEquals(active.update_stats.call_count, 1)
+        self.assertEquals(idle.update_stats.call_count, 0)
+        self.assertEquals(active.saw_activity, False)
+        self.manager.update_stats()
+        self.assertEquals(active.update_stats.call_count, 1)
+
+class CurlHandlePoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.pool = httpclient.CurlHandlePool()
+
+    def tearDown(self):
+        self.pool.close()
+        EventLoopTest.tearDown(self)
+
+    def test_reuse(self):
+        handle = self.pool.get_handle('example.com')
+        self.pool.release_handle('example.com', handle)
+        # handles should only be reused for the same host
+        other_handle = self.pool.get_handle('example.org')
+        self.assert_(other_handle is not handle)
+        self.assert_(self.pool.get_handle('example.com') is handle)
+        self.assertEquals(self.pool.created_count, 2)
+        self.assertEquals(self.pool.reused_count, 1)
+        self.assertEquals(self.pool.idle_handles, {})
+
+    def test_idle_limit(self):
+        handles = [self.pool.get_handle('example.com')
+                   for i in xrange(self.pool.MAX_IDLE_PER_HOST + 2)]
+        for handle in handles:
+            self.pool.release_handle('example.com', handle)
+        self.assertEquals(len(self.pool.idle_handles['example.com']),
+                          self.pool.MAX_IDLE_PER_HOST)
+        self.assertEquals(self.pool.idle_count, self.pool.MAX_IDLE_PER_HOST)
+
+class LibCURLManagerHostLimitTest(EventLoopTest):
+    """Test the per-host transfer limit in LibCURLManager."""
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        app.config.set(prefs.HTTP_MAX_CONNECTIONS_PER_HOST, 2)
+        self.manager = httpclient.LibCURLManager()
+        self.manager.multi = mock.Mock()
+        self.manager.multi.info_read.return_value = ([], [], [])
+
+    def tearDown(self):
+        self.manager.handle_pool.close()
+        EventLoopTest.tearDown(self)
+
+    def make_transfer(self, host):
+        transfer = mock.Mock()
+        transfer.options.host = host
+        transfer.handle = None
+        transfer.check_cache.return_value = False
+        def build_handle(handle):
+            transfer.handle = handle
+        transfer.build_handle.side_effect = build_handle
+        return transfer
+
+    def add_transfers(self, host, count):
+        transfers = [self.make_transfer(host) for i in xrange(count)]
+        for transfer in transfers:
+            self.manager.transfers_to_add.put(transfer)
+        self.manager.process_queues()
+        return transfers
+
+    def check_running(self, *transfers):
+        self.assertEquals(set(self.manager.transfer_map.values()),
+                          set(transfers))
+
+    def finish_transfer(self, transfer):
+        self.manager.multi.info_read.return_value = (
+                [], [transfer.handle], [])
+        self.manager.check_finished()
+        self.manager.multi.info_read.return_value = ([], [], [])
+
+    def test_limit(self):
+        t1, t2, t3 = self.add_transfers('example.com', 3)
+        other = self.add_transfers('example.org', 1)[0]
+        self.check_running(t1, t2, other)
+        # when t1 finishes, t3 should start and reuse t1's handle
+        handle = t1.handle
+        self.finish_transfer(t1)
+        self.assertEquals(t1.on_finished.call_count, 1)
+        self.check_running(t2, t3, other)
+        self.assert_(t3.handle is handle)
+        self.assertEquals(self.manager.waiting_transfers, {})
+
+    def test_cancel_waiting(self):
+        t1, t2, t3 = self.add_transfers('example.com', 3)
+        self.manager.transfers_to_remove.put((t3, False))
+        self.manager.process_queues()
+        self.assertEquals(t3.on_cancel.call_count, 1)
+        self.assertEquals(t3.build_handle.call_count, 0)
+        self.finish_transfer(t1)
+        self.check_running(t2)
+        self.assertEquals(t3.build_handle.call_count, 0)
+
+    def test_no_limit(self):
+        app.config.set(prefs.HTTP_MAX_CONNECTIONS_PER_HOST, 0)
+        transfers = self.add_transfers('example.com', 10)
+        self.check_running(*transfers)
@@ -36,6 +36,7 @@ import string
 import weakref
 
 from miro import app
+from miro import messages
 from miro import models
 from miro import util
 from miro.frontends.widgets import itemlist
@@ -147,6 +148,28 @@ class ItemListTest(MiroTestCase):
         # test that a second unset is okay
         self.item_list.unset_attr(id1, 'key')
 
+    def get_sent_priority_item_ids(self):
+        handler = messages.BackendMessage.handler
+        return [args[0].item_ids for args, kwargs in
+                handler.handle.call_args_list
+                if isinstance(args[0], messages.SetMetadataPriorityItems)]
+
+    def test_metadata_priority_items(self):
+        # the item list should tell the backend which items are visible
+        messages.BackendMessage.handler.reset_mock()
+        self.item_list.set_visible_range(2, 4)
+        visible_ids = [self.item_list.get_row(i).id for i in xrange(2, 5)]
+        self.assertEquals(self.get_sent_priority_item_ids(), [visible_ids])
+        # if the visible items don't change, we shouldn't send another
+        # message
+        self.item_list.set_visible_range(2, 4)
+        self.assertEquals(len(self.get_sent_priority_item_ids()), 1)
+        # if the list changes, we should send the new visible items
+        models.Item.get_by_id(visible_ids[0]).remove()
+        self.refresh_item_list()
+        visible_ids = [self.item_list.get_row(i).id for i in xrange(2, 5)]
+        self.assertEquals(self.get_sent_priority_item_ids()[-1], visible_ids)
+
     def check_group_info(self, grouping_func):
         items = [self.item_list.get_row(i)
                  for i in xrange(len(self.item_list))]
@@ -215,10 +238,33 @@ class TestItemListPool(MiroTestCase):
         self.item_list.on_item_changes = mock.Mock()
         self.item_list2.on_item_changes = mock.Mock()
         fake_message = mock.Mock()
+        fake_message.changed = fake_message.removed = set()
         self.pool.on_item_changes(fake_message)
         self.item_list.on_item_changes.assert_called_once_with(fake_message)
         self.item_list2.on_item_changes.assert_called_once_with(fake_message)
 
+    def test_shared_item_info_cache(self):
+        # Test that lists in the pool share ItemInfo objects
+        item_ids = [i.id for i in self.items]
+        manual_list = self.pool.get(u'manual', item_ids)
+        info = self.item_list.get_item(item_ids[0])
+        self.assert_(manual_list.get_item(item_ids[0]) is info)
+        self.assert_(self.pool.item_info_cache.hits > 0)
+        # ItemChanges messages should invalidate the cached data
+        self.items[0].title = u'new title'
+        self.items[0].signal_change()
+        app.db.finish_transaction()
+        fake_message = mock.Mock()
+        fake_message.changed = set([item_ids[0]])
+        fake_message.removed = set()
+        fake_message.added = set()
+        fake_message.changed_columns = set(['title'])
+        fake_message.dlstats_changed = False
+        self.pool.on_item_changes(fake_message)
+        new_info = manual_list.get_item(item_ids[0])
+        self.assertEquals(new_info.title, u'new title')
+        self.assert_(self.item_list.get_item(item_ids[0]) is new_info)
+
     def test_release(self):
         # Test that we actually remove objects from the pool once there are no
         # more references to them.
@@ -195,6 +195,9 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         if should_have_fired in ('initial-list', 'items-changed'):
             # should be passed a list of ids
             self.assertEquals(len(args), 2)
+        elif should_have_fired == 'list-changed':
+            # should be passed an ItemTrackerListChanges or None
+            self.assertEquals(len(args), 2)
         else:
             # shouldn't be passed anything
             self.assertEquals(len(args), 1)
@@ -300,6 +303,53 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
             self.assertNotEquals(row, None)
         self.check_tracker_items()
 
+    def test_visible_range_fetch(self):
+        # test that the rows in the visible range get fetched first
+        self.tracker.VISIBLE_RANGE_LOOKAHEAD = 0
+        self.tracker.MAX_FETCH_ROW_CHUNK_SIZE = 2
+        self.tracker.fetch_chunk_size = 2
+        self.tracker.set_visible_range(6, 7)
+        self.run_tracker_idle()
+        self.assertSameSet(self.tracker.row_data.keys(),
+                           self.tracker.id_list[6:8])
+        # after that we should continue fetching the rest of the list
+        self.run_all_tracker_idles()
+        self.assertEquals(len(self.tracker.row_data), 10)
+        self.check_tracker_items()
+
+    def test_background_fetch_limit(self):
+        # test that we stop background fetching for large lists
+        self.tracker.background_fetch_limit = 5
+        self.tracker.VISIBLE_RANGE_LOOKAHEAD = 1
+        self.tracker.set_visible_range(2, 3)
+        self.run_all_tracker_idles()
+        self.assertSameSet(self.tracker.row_data.keys(),
+                           self.tracker.id_list[2:5])
+        # we should still be able to fetch rows on-demand
+        self.check_tracker_items()
+        correct_ids = [i.id for i in self.tracked_items if i.is_playable()]
+        self.assertSameSet(self.tracker.get_playable_ids(), correct_ids)
+        # scrolling down should schedule another fetch
+        self.tracker.row_data.clear()
+        self.tracker.set_visible_range(8, 9)
+        self.run_all_tracker_idles()
+        self.assertSameSet(self.tracker.row_data.keys(),
+                           self.tracker.id_list[8:10])
+
+    def test_fetch_chunk_size(self):
+        # test that we grow the chunk size when fetches are fast
+        self.tracker.IDLE_FETCH_TARGET_TIME = 1000
+        self.tracker.fetch_chunk_size = 2
+        self.run_tracker_idle()
+        self.assertEquals(len(self.tracker.row_data), 2)
+        self.assertEquals(self.tracker.fetch_chunk_size, 4)
+        # and shrink it when they're slow
+        self.tracker.IDLE_FETCH_TARGET_TIME = -1
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 1
+        self.run_tracker_idle()
+        self.assertEquals(len(self.tracker.row_data), 6)
+        self.assertEquals(self.tracker.fetch_chunk_size, 2)
+
     def check_items_changed_after_message(self, changed_items):
         self.process_items_changed_messages()
         signal_args = self.check_one_signal('items-changed')
@@ -310,6 +360,19 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.process_items_changed_messages()
         self.check_one_signal('list-changed')
 
+    def test_description_stripped(self):
+        item1 = self.tracked_items[0]
+        item1.description = u'<b>Bold</b> description'
+        item1.signal_change()
+        self.check_items_changed_after_message([item1])
+        info = self.tracker.get_item(item1.id)
+        self.assertEquals(info.description_stripped,
+                          item.ItemInfo.html_stripper.strip(
+                              u'<b>Bold</b> description'))
+        # the second call uses the cached value
+        self.assertEquals(info.description_stripped,
+                          info._description_stripped)
+
     def test_item_changes(self):
         # test that simple changes result in a items-changed signal
         item1 = self.tracked_items[0]
@@ -366,6 +429,71 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_no_signals()
         self.check_tracker_items()
 
+    def test_incremental_update(self):
+        # adding/removing items should update the list in place, without
+        # re-running the query for the entire list
+        self.tracker.query.select_ids = mock.Mock()
+        new_item = testobjects.make_item(self.tracked_feed, u'new-item')
+        new_item.release_date = self.tracked_items[3].release_date
+        new_item.signal_change()
+        self.process_items_changed_messages()
+        signal_args = self.check_one_signal('list-changed')
+        changes = signal_args[1]
+        self.assertEquals(changes.removed, [])
+        self.assertEquals(changes.inserted,
+                          [self.tracker.get_index(new_item.id)])
+        self.check_tracker_items()
+        # changing the sort column should move the item
+        old_index = self.tracker.get_index(self.tracked_items[0].id)
+        self.tracked_items[0].release_date += datetime.timedelta(days=400)
+        self.tracked_items[0].signal_change()
+        self.process_items_changed_messages()
+        changes = self.check_one_signal('list-changed')[1]
+        self.assertEquals(changes.removed, [old_index])
+        self.assertEquals(changes.inserted,
+                          [self.tracker.get_index(self.tracked_items[0].id)])
+        self.check_tracker_items()
+        # removing items
+        to_remove = self.tracked_items.pop(1)
+        old_index = self.tracker.get_index(to_remove.id)
+        to_remove.remove()
+        self.process_items_changed_messages()
+        changes = self.check_one_signal('list-changed')[1]
+        self.assertEquals(changes.removed, [old_index])
+        self.assertEquals(changes.inserted, [])
+        self.check_tracker_items()
+        self.assertEquals(self.tracker.query.select_ids.call_count, 0)
+
+    def test_incremental_update_missing_row(self):
+        # If a row in our list is gone from the snapshot we update against,
+        # we should fall back to refetching the list.
+        new_item = testobjects.make_item(self.tracked_feed, u'new-item')
+        real_select_sort_keys = self.tracker.query.select_sort_keys
+        def select_sort_keys(connection, ids):
+            keys = real_select_sort_keys(connection, ids)
+            return dict((id_, key) for id_, key in keys.items()
+                        if id_ == new_item.id)
+        self.tracker.query.select_sort_keys = select_sort_keys
+        self.process_items_changed_messages()
+        self.check_one_signal('list-changed')
+        self.check_tracker_items()
+
+    def test_incremental_update_other_feed(self):
+        # changes to items outside of our list shouldn't change it
+        testobjects.make_item(self.other_feed2, u'new-item2')
+        self.process_items_changed_messages()
+        self.check_no_signals()
+        self.check_tracker_items()
+
+    def test_incremental_update_limit(self):
+        # if there are too many changes, we should refetch the list
+        self.tracker.INCREMENTAL_UPDATE_LIMIT = 0
+        testobjects.make_item(self.tracked_feed, u'new-item')
+        self.process_items_changed_messages()
+        signal_args = self.check_one_signal('list-changed')
+        self.assertEquals(signal_args[1], None)
+        self.check_tracker_items()
+
     def test_extra_conditions(self):
         # test adding more conditions
         titles = [i.title for i in self.tracked_items]
@@ -727,6 +855,51 @@ class SharingItemTrackTestNOWalMode(SharingItemTrackTestWalMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
 
+class ItemInfoCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = itemtrack.ItemInfoCache(size=4)
+
+    def make_info(self, id_):
+        info = mock.Mock()
+        info.id = id_
+        return info
+
+    def test_lookup(self):
+        infos = [self.make_info(i) for i in xrange(3)]
+        self.cache.add(('main',), infos)
+        found, missing = self.cache.lookup(('main',), [0, 2, 5])
+        self.assertSameSet(found, [infos[0], infos[2]])
+        self.assertEquals(missing, [5])
+        # other sources shouldn't see the infos
+        found, missing = self.cache.lookup(('device', 1), [0])
+        self.assertEquals(found, [])
+        self.assertEquals(missing, [0])
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.misses, 2)
+
+    def test_add_keeps_existing(self):
+        info = self.make_info(0)
+        self.cache.add(('main',), [info])
+        self.cache.add(('main',), [self.make_info(0)])
+        found, missing = self.cache.lookup(('main',), [0])
+        self.assert_(found[0] is info)
+
+    def test_invalidate(self):
+        self.cache.add(('main',), [self.make_info(i) for i in xrange(3)])
+        self.cache.add(('device', 1), [self.make_info(0)])
+        self.cache.invalidate(('main',), [0, 1])
+        found, missing = self.cache.lookup(('main',), [0, 1, 2])
+        self.assertEquals(missing, [0, 1])
+        self.cache.invalidate_source(('device', 1))
+        found, missing = self.cache.lookup(('device', 1), [0])
+        self.assertEquals(missing, [0])
+
+    def test_size_limit(self):
+        self.cache.add(('main',), [self.make_info(i) for i in xrange(10)])
+        self.assert_(len(self.cache.dict) <= 4)
+        self.assert_(len(self.cache.invalidators) <= 4)
+
 class ItemSelectInfoTest(MiroTestCase):
     def get_attributes(self, klass):
         return ([col.attr_name for col in klass.select_columns] + 
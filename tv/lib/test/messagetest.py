@@ -699,3 +699,29 @@ class ItemInfoCacheErrorTest(MiroTestCase):
         self.setup_new_item_info_cache(set_version=False)
         app.db.cursor.execute("SELECT COUNT(*) FROM item_info_cache")
         self.assertEquals(app.db.cursor.fetchone()[0], 0)
+
+class MetadataPriorityTest(MiroTestCase):
+    # Test the SetMetadataPriorityItems message
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.file_items = [testobjects.make_file_item(self.feed)
+                           for i in xrange(2)]
+        self.item = testobjects.make_item(self.feed, u'not-downloaded')
+        # BackendMessageHandler needs the search feed to exist
+        Feed(u'dtv:search')
+        self.backend_message_handler = messagehandler.BackendMessageHandler(
+            None)
+
+    @mock.patch('miro.app.local_metadata_manager')
+    def test_set_priority_items(self, mock_metadata_manager):
+        item_ids = [i.id for i in self.file_items]
+        # items without files should be skipped, as should deleted items
+        item_ids.append(self.item.id)
+        deleted_item = testobjects.make_file_item(self.feed)
+        item_ids.append(deleted_item.id)
+        deleted_item.remove()
+        message = messages.SetMetadataPriorityItems(item_ids)
+        self.backend_message_handler.handle(message)
+        mock_metadata_manager.set_priority_paths.assert_called_once_with(
+            set(i.get_filename() for i in self.file_items))
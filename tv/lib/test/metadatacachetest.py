@@ -0,0 +1,121 @@
+import os
+
+from miro import metadatacache
+from miro.test import mock
+from miro.test.framework import MiroTestCase
+
+class FingerprintTest(MiroTestCase):
+    def make_file(self, name, data, mtime=1000000000):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_fingerprint(self):
+        path = self.make_file('a.mp3', 'abc')
+        fingerprint = metadatacache.calc_fingerprint(path)
+        self.assert_(fingerprint.startswith('3-1000000000-'))
+        # same contents and mtime should give the same fingerprint
+        path2 = self.make_file('b.mp3', 'abc')
+        self.assertEquals(metadatacache.calc_fingerprint(path2), fingerprint)
+
+    def test_fingerprint_changes(self):
+        fingerprint = metadatacache.calc_fingerprint(
+            self.make_file('a.mp3', 'abc'))
+        self.assertNotEquals(metadatacache.calc_fingerprint(
+            self.make_file('b.mp3', 'abd')), fingerprint)
+        self.assertNotEquals(metadatacache.calc_fingerprint(
+            self.make_file('c.mp3', 'abc', mtime=1000000001)), fingerprint)
+
+    def test_large_file(self):
+        # for large files we only hash the start and end, but changes there
+        # should still be noticed
+        chunk_size = metadatacache.FINGERPRINT_CHUNK_SIZE
+        data = 'a' * (chunk_size * 3)
+        fingerprint = metadatacache.calc_fingerprint(
+            self.make_file('a.mp4', data))
+        middle_changed = data[:chunk_size] + 'b' + data[chunk_size+1:]
+        self.assertEquals(metadatacache.calc_fingerprint(
+            self.make_file('b.mp4', middle_changed)), fingerprint)
+        end_changed = data[:-1] + 'b'
+        self.assertNotEquals(metadatacache.calc_fingerprint(
+            self.make_file('c.mp4', end_changed)), fingerprint)
+
+    def test_calc_fingerprints(self):
+        path = self.make_file('a.mp3', 'abc')
+        missing_path = os.path.join(self.tempdir, 'missing.mp3')
+        fingerprints = metadatacache.calc_fingerprints([missing_path, path])
+        self.assertEquals(fingerprints,
+                          [None, metadatacache.calc_fingerprint(path)])
+
+class MetadataCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_path = os.path.join(self.tempdir, 'metadata-cache',
+                                       'cache.sqlite')
+        self.cache = metadatacache.MetadataCache(self.cache_path, 3)
+
+    def tearDown(self):
+        self.cache.close()
+        MiroTestCase.tearDown(self)
+
+    def make_record(self, title):
+        return {
+            'mutagen': {'title': title, 'file_type': u'audio'},
+            'movie-data': None,
+        }
+
+    def test_store(self):
+        self.cache.store({'abc': self.make_record(u'Foo')})
+        self.assertEquals(self.cache.lookup(['abc', 'def', None]),
+                          {'abc': self.make_record(u'Foo')})
+        self.assertEquals(self.cache.lookup([]), {})
+        self.assertEquals(self.cache.hits, 1)
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_replace(self):
+        self.cache.store({'abc': self.make_record(u'Foo')})
+        self.cache.store({'abc': self.make_record(u'Bar')})
+        self.assertEquals(self.cache.lookup(['abc']),
+                          {'abc': self.make_record(u'Bar')})
+        self.assertEquals(self.cache.count(), 1)
+
+    def test_persists(self):
+        self.cache.store({'abc': self.make_record(u'Foo')})
+        self.cache.close()
+        cache2 = metadatacache.MetadataCache(self.cache_path, 3)
+        self.assertEquals(cache2.lookup(['abc']),
+                          {'abc': self.make_record(u'Foo')})
+        cache2.close()
+
+    @mock.patch('time.time')
+    def test_evict(self, mock_time):
+        mock_time.return_value = 1000.0
+        for fingerprint in ('a', 'b', 'c'):
+            self.cache.store({fingerprint: self.make_record(u'Foo')})
+            mock_time.return_value += 1
+        # use a, so that b is now the least recently used entry
+        self.cache.lookup(['a'])
+        mock_time.return_value += 1
+        self.cache.store({'d': self.make_record(u'Foo')})
+        self.assertEquals(self.cache.count(), 3)
+        self.assertEquals(self.cache.evicted, 1)
+        self.assertSameSet(self.cache.lookup(['a', 'b', 'c', 'd']).keys(),
+                           ['a', 'c', 'd'])
+
+    def test_clear(self):
+        self.cache.store({'abc': self.make_record(u'Foo')})
+        self.cache.clear()
+        self.assertEquals(self.cache.lookup(['abc']), {})
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        f = open(self.cache_path, 'wb')
+        f.write('this is not a sqlite database' * 100)
+        f.close()
+        with self.allow_warnings():
+            self.cache.store({'abc': self.make_record(u'Foo')})
+        self.assertEquals(self.cache.lookup(['abc']),
+                          {'abc': self.make_record(u'Foo')})
@@ -24,6 +24,7 @@ from miro import prefs
 from miro import schema
 from miro import filetypes
 from miro import metadata
+from miro import metadatacache
 from miro import workerprocess
 from miro.plat import resources
 from miro.plat.utils import (PlatformFilenameType,
@@ -47,6 +48,8 @@ class MockMetadataProcessor(object):
             'echonest': {},
         }
         self.canceled_files = set()
+        # maps source paths to started_callbacks for the tasks
+        self.started_callbacks = {}
         # store the codes we see in query_echonest calls
         self.query_echonest_codes = {}
         self.query_echonest_metadata = {}
@@ -69,7 +72,8 @@ class MockMetadataProcessor(object):
 
     def add_task_data(self, source_path, name, data):
         task_data_dict = self.task_data[name]
-        if source_path in task_data_dict:
+        if (source_path in task_data_dict and
+            source_path not in self.canceled_files):
             raise ValueError("Already processing %s (path: %s)" %
                              (name, source_path))
         task_data_dict[source_path] = data
@@ -82,11 +86,17 @@ class MockMetadataProcessor(object):
             raise ValueError("No %s run scheduled for %s" %
                              (name, source_path))
 
-    def send(self, task, callback, errback):
+    def send(self, task, callback, errback, started_callback=None):
         task_data = (task, callback, errback)
+        if started_callback is not None:
+            self.started_callbacks[task.source_path] = (task,
+                                                        started_callback)
 
         if isinstance(task, workerprocess.MutagenTask):
             self.add_task_data(task.source_path, 'mutagen', task_data)
+        elif isinstance(task, workerprocess.MutagenBatchTask):
+            for path in task.source_paths:
+                self.add_task_data(path, 'mutagen', task_data)
         elif isinstance(task, workerprocess.MovieDataProgramTask):
             self.add_task_data(task.source_path, 'movie-data', task_data)
         elif isinstance(task, workerprocess.CancelFileOperations):
@@ -110,11 +120,33 @@ class MockMetadataProcessor(object):
         task, callback, errback = self.pop_task_data(source_path, 'mutagen')
         callback_data = {'source_path': source_path}
         callback_data.update(metadata)
-        callback(task, callback_data)
+        if isinstance(task, workerprocess.MutagenBatchTask):
+            # send back the results for this path only.  The real worker
+            # process sends back results for the entire batch at once, but
+            # this is simpler for the tests.
+            callback(task, [(source_path, callback_data)])
+        else:
+            callback(task, callback_data)
 
     def run_mutagen_errback(self, source_path, error):
         task, callback, errback = self.pop_task_data(source_path, 'mutagen')
-        errback(task, error)
+        if isinstance(task, workerprocess.MutagenBatchTask):
+            callback(task, [(source_path, error)])
+        else:
+            errback(task, error)
+
+    def mutagen_batch_tasks(self):
+        """Get the MutagenBatchTasks currently in the system."""
+        tasks = set()
+        for (task, callback, errback) in self.task_data['mutagen'].values():
+            if isinstance(task, workerprocess.MutagenBatchTask):
+                tasks.add(task)
+        return tasks
+
+    def start_movie_data(self, source_path):
+        """Simulate a worker process starting a movie data task."""
+        task, started_callback = self.started_callbacks.pop(source_path)
+        started_callback(task)
 
     def run_movie_data_callback(self, source_path, metadata):
         task, callback, errback = self.pop_task_data(source_path, 'movie-data')
@@ -685,6 +717,142 @@ class MetadataManagerTest(MiroTestCase):
         self.check_run_movie_data('foo.avi', 'other', 100, True)
         self.check_echonest_not_scheduled('foo.avi')
 
+    def test_bulk_add_batches(self):
+        # Test that files added inside bulk_add() get sent to mutagen in
+        # batches
+        filenames = ['bulk-%d.mp3' % i for i in xrange(25)]
+        with self.metadata_manager.bulk_add():
+            for filename in filenames:
+                self.check_add_file(filename)
+        self.check_queued_mutagen_calls(filenames)
+        batch_tasks = self.processor.mutagen_batch_tasks()
+        self.assertEquals(sorted(len(t.source_paths) for t in batch_tasks),
+                          [5, 10, 10])
+        for filename in filenames:
+            self.check_run_mutagen(filename, 'audio', 200, 'Bar', 'Fights')
+
+    def test_batch_failure(self):
+        # Test an entire mutagen batch failing
+        filenames = ['bulk-%d.avi' % i for i in xrange(3)]
+        with self.metadata_manager.bulk_add():
+            for filename in filenames:
+                self.check_add_file(filename)
+        batch_task = list(self.processor.mutagen_batch_tasks())[0]
+        task, callback, errback = self.processor.task_data['mutagen'][
+            self.make_path(filenames[0])]
+        with self.allow_warnings():
+            errback(batch_task, workerprocess.SubprocessTimeoutError())
+        self.processor.reset()
+        self.metadata_manager.run_updates()
+        # We should run movie data for each file since mutagen failed
+        self.check_queued_moviedata_calls(filenames)
+        for filename in filenames:
+            self.check_metadata(filename)
+
+    def setup_metadata_cache(self):
+        """Replace our MetadataManager with one that uses a MetadataCache."""
+        self.metadata_cache = metadatacache.MetadataCache(
+            os.path.join(self.tempdir, 'metadata-cache.sqlite'), 100)
+        self.metadata_manager = metadata.LibraryMetadataManager(
+            self.tempdir, self.tempdir, metadata_cache=self.metadata_cache)
+        self.patch_function('miro.eventloop.call_in_lane',
+                            self.call_in_lane_now)
+        # use a screenshot path that we can actually create
+        self.get_screenshot_path = lambda filename: os.path.join(
+            self.tempdir, os.path.basename(filename) + '.png')
+
+    def call_in_lane_now(self, lane, callback, errback, function, name,
+                         *args, **kwargs):
+        callback(function(*args, **kwargs))
+
+    def make_media_file(self, filename, data):
+        path = os.path.join(self.tempdir, filename)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def run_cache_lookups(self):
+        self.metadata_manager._start_cache_lookups()
+
+    def process_video_with_cache(self, path):
+        self.check_add_file(path)
+        # we shouldn't run mutagen until we've checked the cache
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.run_cache_lookups()
+        self.assertEquals(self.processor.mutagen_paths(), [path])
+        self.check_run_mutagen(path, 'video', 100, 'Foo')
+        self.check_run_movie_data(path, 'video', 100, True)
+        open(self.get_screenshot_path(path), 'wb').write("FAKE FILE")
+        self.metadata_manager.run_updates()
+
+    def check_readd_file(self, path):
+        self.metadata_manager.remove_file(path)
+        self.metadata_manager.add_file(path)
+        self.run_cache_lookups()
+        self.metadata_manager.run_updates()
+
+    def test_metadata_cache(self):
+        self.setup_metadata_cache()
+        path = self.make_media_file('cached.mp4', 'video data')
+        self.process_video_with_cache(path)
+        self.assertEquals(self.metadata_cache.count(), 1)
+        # If we remove the file and add it back, we should use the cached
+        # results instead of running mutagen and movie data again
+        self.check_readd_file(path)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [])
+        self.check_metadata(path)
+        status = metadata.MetadataStatus.get_by_path(path)
+        self.assertEquals(status.mutagen_status, status.STATUS_COMPLETE)
+        self.assertEquals(status.moviedata_status, status.STATUS_COMPLETE)
+        self.assertEquals(status.current_processor, None)
+
+    def test_metadata_cache_file_changed(self):
+        self.setup_metadata_cache()
+        path = self.make_media_file('cached.mp4', 'video data')
+        self.process_video_with_cache(path)
+        # If the file changes, we need to run everything again
+        self.make_media_file('cached.mp4', 'other data')
+        self.check_readd_file(path)
+        self.assertEquals(self.processor.mutagen_paths(), [path])
+
+    def test_metadata_cache_missing_screenshot(self):
+        self.setup_metadata_cache()
+        path = self.make_media_file('cached.mp4', 'video data')
+        self.process_video_with_cache(path)
+        # If the screenshot is gone, we can use the mutagen data, but we
+        # should run movie data again
+        os.remove(self.get_screenshot_path(path))
+        self.check_readd_file(path)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [path])
+        self.check_run_movie_data(path, 'video', 100, True)
+
+    def test_metadata_cache_failures(self):
+        # We should also cache the fact that an extractor failed
+        self.setup_metadata_cache()
+        path = self.make_media_file('cached.avi', 'video data')
+        self.check_add_file(path)
+        self.run_cache_lookups()
+        self.check_mutagen_error(path)
+        self.check_movie_data_error(path)
+        self.metadata_manager.run_updates()
+        self.check_readd_file(path)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.processor.movie_data_paths(), [])
+        status = metadata.MetadataStatus.get_by_path(path)
+        self.assertEquals(status.mutagen_status, status.STATUS_FAILURE)
+        self.assertEquals(status.moviedata_status, status.STATUS_FAILURE)
+
+    def test_metadata_cache_remove_during_lookup(self):
+        self.setup_metadata_cache()
+        path = self.make_media_file('cached.mp4', 'video data')
+        self.check_add_file(path)
+        self.metadata_manager.remove_file(path)
+        self.run_cache_lookups()
+        self.assertEquals(self.processor.mutagen_paths(), [])
+
     def test_movie_data_failure(self):
         # Test video files where movie data fails
         self.check_add_file('foo.avi')
@@ -1298,6 +1466,93 @@ class MetadataManagerTest(MiroTestCase):
         correct_paths = paths[100:150] + new_paths
         self.assertSameSet(self.processor.mutagen_paths(), correct_paths)
 
+    def test_movie_data_attempts(self):
+        # test that we give up on files that never finish movie data
+        path = self.make_path('foo.avi')
+        self.check_add_file('foo.avi')
+        self.check_run_mutagen('foo.avi', 'video', 100, 'Foo')
+        max_attempts = metadata.MetadataStatus.MAX_MOVIE_DATA_ATTEMPTS
+        for i in xrange(max_attempts):
+            self.check_queued_moviedata_calls(['foo.avi'])
+            self.processor.start_movie_data(path)
+            status = metadata.MetadataStatus.get_by_path(path)
+            self.assertEquals(status.moviedata_attempts, i + 1)
+            # simulate Miro crashing while movie data is running
+            self.processor.reset()
+            self.metadata_manager = metadata.LibraryMetadataManager(
+                self.tempdir, self.tempdir)
+            with self.allow_warnings():
+                self.metadata_manager.restart_incomplete()
+        # we should have given up on movie data
+        self.check_movie_data_not_scheduled('foo.avi')
+        self.check_metadata('foo.avi')
+        status = metadata.MetadataStatus.get_by_path(path)
+        self.assertEquals(status.moviedata_status, status.STATUS_FAILURE)
+
+    def test_movie_data_interrupted(self):
+        # test that we don't count movie data runs that we interrupt
+        path = self.make_path('foo.avi')
+        self.check_add_file('foo.avi')
+        self.check_run_mutagen('foo.avi', 'video', 100, 'Foo')
+        self.processor.start_movie_data(path)
+        self.metadata_manager.shutdown()
+        status = metadata.MetadataStatus.get_by_path(path)
+        self.assertEquals(status.moviedata_attempts, 0)
+
+    @mock.patch('miro.clock.clock')
+    def test_movie_data_run_time(self, mock_clock):
+        path = self.make_path('foo.avi')
+        self.check_add_file('foo.avi')
+        self.check_run_mutagen('foo.avi', 'video', 100, 'Foo')
+        status = metadata.MetadataStatus.get_by_path(path)
+        self.assertEquals(status.moviedata_time, None)
+        mock_clock.return_value = 10.0
+        self.processor.start_movie_data(path)
+        mock_clock.return_value = 12.5
+        self.check_run_movie_data('foo.avi', 'video', 100, True)
+        status = metadata.MetadataStatus.get_by_path(path)
+        self.assertEquals(status.moviedata_time, 2.5)
+        self.assertEquals(status.moviedata_attempts, 0)
+        self.assertEquals(self.metadata_manager.moviedata_processor.run_times,
+                          {})
+
+    def test_movie_data_priority(self):
+        # test that movie data runs first for the files the user is looking
+        # at
+        self.metadata_manager.moviedata_processor.limit = 2
+        filenames = ['video-%d.avi' % i for i in xrange(6)]
+        for filename in filenames:
+            self.check_add_file(filename)
+            self.check_run_mutagen(filename, 'video', 100, 'Foo')
+        # without priority paths, we process the files in order
+        self.check_queued_moviedata_calls(filenames[:2])
+        self.check_run_movie_data(filenames[0], 'video', 100, True)
+        self.check_queued_moviedata_calls(filenames[1:3])
+        # video-5 is pending, so it should be sent next at the higher
+        # priority
+        self.metadata_manager.set_priority_paths(
+            [self.make_path(filenames[5])])
+        self.check_run_movie_data(filenames[1], 'video', 100, True)
+        self.check_queued_moviedata_calls([filenames[2], filenames[5]])
+        task_data = self.processor.task_data['movie-data']
+        high_priority = workerprocess.MovieDataProgramTask.high_priority
+        self.assertEquals(task_data[self.make_path(filenames[5])][0].priority,
+                          high_priority)
+        self.assertNotEquals(
+            task_data[self.make_path(filenames[2])][0].priority,
+            high_priority)
+        # video-2 was sent, but a worker hasn't started it.  It should get
+        # resent at the higher priority
+        self.metadata_manager.set_priority_paths(
+            [self.make_path(filenames[2])])
+        self.assertEquals(self.processor.canceled_files,
+                          set([self.make_path(filenames[2])]))
+        self.assertEquals(task_data[self.make_path(filenames[2])][0].priority,
+                          high_priority)
+        # after that, we go back to processing the files in order
+        self.check_run_movie_data(filenames[5], 'video', 100, True)
+        self.check_queued_moviedata_calls([filenames[2], filenames[3]])
+
 class EchonestNetErrorTest(EventLoopTest):
     # Test our pause/retry logic when we get HTTP errors from echonest
 
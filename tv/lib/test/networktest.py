@@ -2,6 +2,7 @@ import email.Utils
 import socket
 
 from miro import net
+from miro import util
 from miro.test.framework import EventLoopTest, MiroTestCase
 
 class TestingConnectionHandler(net.ConnectionHandler):
@@ -339,6 +340,41 @@ class NetworkBufferTest(MiroTestCase):
         # check to make sure the value doesn't change as a result
         self.assertEquals(self.buffer.getValue(), "ONETWOTHREE")
 
+    def test_unread(self):
+        self.buffer.addData("ONE\nTWO")
+        self.assertEquals(self.buffer.readline(), "ONE")
+        self.buffer.unread("ONE\n")
+        self.buffer.unread("ZERO\n")
+        self.assertEquals(self.buffer.readline(), "ZERO")
+        self.assertEquals(self.buffer.read(), "ONE\nTWO")
+
+    def test_compact(self):
+        # read/write lots of data in small chunks and make sure the buffer
+        # doesn't grow forever
+        data = ''.join(chr(i % 256) for i in xrange(
+            net.NetworkBuffer.COMPACT_SIZE * 4))
+        read_data = []
+        for i in xrange(0, len(data), 1000):
+            self.buffer.addData(data[i:i+1000])
+            read_data.append(self.buffer.read(700))
+        self.assert_(len(self.buffer._data) <
+                     net.NetworkBuffer.COMPACT_SIZE * 3)
+        read_data.append(self.buffer.read())
+        self.assertEquals(''.join(read_data), data)
+
+    def test_recv_into(self):
+        sender, receiver = util.make_dummy_socket_pair()
+        try:
+            sender.send("ONE\r\nTWO")
+            self.assertEquals(self.buffer.recv_into(receiver, 1024), 8)
+            self.assertEquals(self.buffer.readline(), "ONE")
+            self.assertEquals(self.buffer.length, 3)
+            sender.close()
+            self.assertEquals(self.buffer.recv_into(receiver, 1024), 0)
+            self.assertEquals(self.buffer.read(), "TWO")
+        finally:
+            receiver.close()
+
 
 class WeirdCloseConnectionTest(AsyncSocketTest):
     def test_close_during_open_connection(self):
@@ -1,14 +1,33 @@
 import shutil
 import os
 import pstats
+import cPickle
 import cProfile
+import select
+import sqlite3
+import struct
+import time
+
+import mutagen
 
 from miro import app
+from miro import database
+from miro import databaseupgrade
+from miro import eventloop
 from miro import messagehandler
 from miro import messages
 from miro import models
+from miro import net
+from miro import schema
+from miro import util
+from miro import workerprocess
+from miro.data import fulltextsearch
+from miro.dl_daemon import command
+from miro.dl_daemon import daemon
+from miro.dl_daemon import statusupdates
 from miro.fileobject import FilenameType
-from miro.test.framework import EventLoopTest
+from miro.plat import resources
+from miro.test.framework import EventLoopTest, MiroTestCase
 from miro.test import messagetest
 
 class PerformanceTest(EventLoopTest):
@@ -66,3 +85,483 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class FullTextSearchUpdatePerformanceTest(MiroTestCase):
+    """Measure UPDATE throughput on a large item table with item_fts."""
+
+    ITEM_COUNT = 100000
+    UPDATE_COUNT = 20000
+
+    FTS_COLUMNS = ['title', 'description', 'artist', 'album', 'genre',
+                   'filename', 'parent_title', ]
+
+    def make_connection(self):
+        path = self.make_temp_path(".db")
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("CREATE TABLE item(id integer PRIMARY KEY, "
+                           "title text, description text, artist text, "
+                           "album text, genre text, filename text, "
+                           "parent_title text, watched_time timestamp, "
+                           "resume_time integer)")
+        connection.execute("BEGIN TRANSACTION")
+        connection.executemany(
+            "INSERT INTO item(id, title, description, artist, album, genre, "
+            "filename, parent_title) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((i, u'title %s' % i, u'description for item %s' % i,
+              u'artist %s' % (i % 100), u'album %s' % (i % 1000), u'rock',
+              u'/media/item-%s.mp3' % i, u'feed %s' % (i % 50))
+             for i in xrange(self.ITEM_COUNT)))
+        connection.execute("COMMIT TRANSACTION")
+        return connection
+
+    def setup_unconditional_triggers(self, connection):
+        """Replace the update triggers with ones that re-index every row
+        change, the way older versions did.
+        """
+        column_list = ', '.join(self.FTS_COLUMNS)
+        column_list_for_new = ', '.join("new.%s" % c
+                                        for c in self.FTS_COLUMNS)
+        connection.execute("DROP TRIGGER item_bu")
+        connection.execute("DROP TRIGGER item_au")
+        connection.execute("CREATE TRIGGER item_bu "
+                           "BEFORE UPDATE ON item BEGIN "
+                           "DELETE FROM item_fts WHERE docid=old.id; "
+                           "END;")
+        connection.execute("CREATE TRIGGER item_au "
+                           "AFTER UPDATE ON item BEGIN "
+                           "INSERT INTO item_fts(docid, %s) "
+                           "VALUES(new.id, %s); "
+                           "END;" % (column_list, column_list_for_new))
+
+    def time_updates(self, connection, sql):
+        ids = range(self.UPDATE_COUNT)
+        start = time.time()
+        connection.execute("BEGIN TRANSACTION")
+        for id_ in ids:
+            connection.execute(sql, (id_, id_))
+        connection.execute("COMMIT TRANSACTION")
+        return time.time() - start
+
+    def run_updates(self, label, connection):
+        for sql_label, sql in (
+            ('resume_time', "UPDATE item SET resume_time=? WHERE id=?"),
+            ('title', "UPDATE item SET title='new title ' || ? WHERE id=?"),
+            ):
+            elapsed = self.time_updates(connection, sql)
+            print '%s: %s updates/sec (%s)' % (label,
+                                               int(self.UPDATE_COUNT / elapsed),
+                                               sql_label)
+
+    def test_update_throughput(self):
+        connection = self.make_connection()
+        fulltextsearch.setup_fulltext_search(connection)
+        self.setup_unconditional_triggers(connection)
+        self.run_updates('unconditional triggers', connection)
+        connection.close()
+
+        connection = self.make_connection()
+        fulltextsearch.setup_fulltext_search(connection)
+        self.run_updates('column-aware triggers', connection)
+        connection.close()
+
+class UpdatePerformanceTestObject(database.DDBObject):
+    def setup_new(self, index):
+        self.title = u'title %s' % index
+        self.count = index
+        self.resume_time = 0
+
+class UpdatePerformanceTestSchema(schema.ObjectSchema):
+    klass = UpdatePerformanceTestObject
+    table_name = 'update_performance_test'
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('title', schema.SchemaString()),
+        ('count', schema.SchemaInt()),
+        ('resume_time', schema.SchemaInt()),
+    ]
+
+class LiveStorageUpdatePerformanceTest(MiroTestCase):
+    """Measure how many DDBObject updates per second LiveStorage can do."""
+
+    OBJECT_COUNT = 10000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        save_path = FilenameType(self.make_temp_path(extension=".db"))
+        self.reload_database(save_path, schema_version=0,
+                             object_schemas=[UpdatePerformanceTestSchema])
+        app.bulk_sql_manager.start()
+        self.objects = [UpdatePerformanceTestObject(i)
+                        for i in xrange(self.OBJECT_COUNT)]
+        app.bulk_sql_manager.finish()
+
+    def change_objects(self, resume_time):
+        for obj in self.objects:
+            obj.resume_time = resume_time
+            obj.signal_change()
+
+    def print_rate(self, label, elapsed):
+        print '%s: %s updates/sec' % (label,
+                                      int(self.OBJECT_COUNT / elapsed))
+
+    def test_update_throughput(self):
+        start = time.time()
+        self.change_objects(1)
+        app.db.finish_transaction()
+        self.print_rate('update_obj()', time.time() - start)
+
+        start = time.time()
+        app.bulk_sql_manager.start()
+        self.change_objects(2)
+        app.bulk_sql_manager.finish()
+        self.print_rate('bulk_update()', time.time() - start)
+
+class RestorePerformanceTestObject(database.DDBObject):
+    def setup_new(self, index):
+        self.title = u'title %s' % index
+        self.count = index
+        self.description = u'description %s ' % index * 50
+        self.data = {u'index': index, u'tags': [u'tag-%s' % index] * 10}
+
+class RestorePerformanceTestSchema(schema.ObjectSchema):
+    klass = RestorePerformanceTestObject
+    table_name = 'restore_performance_test'
+    fields = [
+        ('id', schema.SchemaInt()),
+        ('title', schema.SchemaString()),
+        ('count', schema.SchemaInt()),
+        ('description', schema.SchemaString()),
+        ('data', schema.SchemaReprContainer()),
+    ]
+
+class ProjectedRestorePerformanceTest(MiroTestCase):
+    """Compare restoring all columns with restoring a projected view."""
+
+    OBJECT_COUNT = 200000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.save_path = FilenameType(self.make_temp_path(extension=".db"))
+        self.reload_test_database()
+        app.bulk_sql_manager.start()
+        for i in xrange(self.OBJECT_COUNT):
+            RestorePerformanceTestObject(i)
+        app.bulk_sql_manager.finish()
+
+    def reload_test_database(self):
+        self.reload_database(self.save_path, schema_version=0,
+                             object_schemas=[RestorePerformanceTestSchema])
+
+    def time_restore(self, label, columns):
+        self.reload_test_database()
+        start_mem = util.get_mem_usage()
+        start = time.time()
+        objects = list(RestorePerformanceTestObject.make_view(
+            columns=columns))
+        total = sum(obj.count for obj in objects)
+        elapsed = time.time() - start
+        print '%s: %0.2f seconds, %s KB' % (label, elapsed,
+                                          util.get_mem_usage() - start_mem)
+        return total
+
+    def test_restore(self):
+        full_total = self.time_restore('all columns', None)
+        projected_total = self.time_restore('projected', ['count'])
+        self.assertEquals(full_total, projected_total)
+
+class DatabaseUpgradePerformanceTest(MiroTestCase):
+    """Time the heavy upgrade steps on a generated old-version database."""
+
+    ITEM_COUNT = 100000
+    DOWNLOADER_COUNT = 50000
+
+    def make_connection(self):
+        path = self.make_temp_path(".db")
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("CREATE TABLE item(id integer PRIMARY KEY, "
+                           "title text, metadata pythonrepr)")
+        connection.execute("CREATE INDEX item_title ON item (title)")
+        connection.execute("CREATE TABLE remote_downloader("
+                           "id integer PRIMARY KEY, url text, "
+                           "status pythonrepr)")
+        connection.execute("BEGIN TRANSACTION")
+        connection.executemany(
+            "INSERT INTO item(id, title, metadata) VALUES (?, ?, ?)",
+            ((i, u'title %s' % i,
+              repr({'album': u'album %s' % (i % 1000),
+                    'artist': u'artist %s' % (i % 100),
+                    'title': u'title %s' % i, 'track': i % 20,
+                    'year': 2000 + (i % 10), 'genre': u'rock'}))
+             for i in xrange(self.ITEM_COUNT)))
+        connection.executemany(
+            "INSERT INTO remote_downloader(id, url, status) "
+            "VALUES (?, ?, ?)",
+            ((i, u'http://example.com/%s.mp3' % i,
+              repr({'totalSize': 1000 * i, 'currentSize': 10 * i,
+                    'startTime': 1300000000 + i, 'endTime': None,
+                    'shortFilename': 'item-%s.mp3' % i,
+                    'filename': '/media/item-%s.mp3' % i,
+                    'dlerType': 'HTTP', 'retryCount': -1}))
+             for i in xrange(self.DOWNLOADER_COUNT)))
+        connection.execute("COMMIT TRANSACTION")
+        return connection
+
+    def time_upgrade(self, connection, from_version, to_version):
+        start_mem = util.get_mem_usage()
+        start = time.time()
+        databaseupgrade.new_style_upgrade(connection.cursor(), from_version,
+                                          to_version, 'main', False)
+        elapsed = time.time() - start
+        print 'upgrade%s: %0.2f seconds, %s KB' % (
+            to_version, elapsed, util.get_mem_usage() - start_mem)
+
+    def test_upgrade(self):
+        connection = self.make_connection()
+        self.time_upgrade(connection, 133, 134)
+        self.time_upgrade(connection, 181, 182)
+        cursor = connection.execute("SELECT COUNT(*) FROM item "
+                                    "WHERE album IS NOT NULL")
+        self.assertEquals(cursor.fetchone()[0], self.ITEM_COUNT)
+        cursor = connection.execute("SELECT COUNT(*) FROM remote_downloader "
+                                    "WHERE type='HTTP'")
+        self.assertEquals(cursor.fetchone()[0], self.DOWNLOADER_COUNT)
+        connection.close()
+
+class EventLoopPollerPerformanceTest(MiroTestCase):
+    """Measure event loop latency with lots of idle sockets."""
+
+    # total number of idle sockets.  We create them in connected pairs.
+    IDLE_SOCKET_COUNT = 1000
+    ITERATIONS = 2000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.sockets = []
+        for i in xrange(self.IDLE_SOCKET_COUNT // 2):
+            self.sockets.extend(util.make_dummy_socket_pair())
+        self.sender, self.receiver = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        for sock in self.sockets + [self.sender, self.receiver]:
+            sock.close()
+        MiroTestCase.tearDown(self)
+
+    def time_loop(self, label, poller):
+        loop = eventloop.EventLoop()
+        loop.set_poller(poller)
+        for sock in self.sockets:
+            loop.add_read_callback(sock, lambda: None)
+        loop.add_read_callback(self.receiver,
+                               lambda: self.receiver.recv(1024))
+        start = time.time()
+        for i in xrange(self.ITERATIONS):
+            self.sender.send("a")
+            loop.process_events(*loop.wait_for_events(None))
+        elapsed = time.time() - start
+        loop.poller.close()
+        loop.wake_sender.close()
+        loop.wake_receiver.close()
+        print '%s: %0.1f usecs per loop' % (
+            label, elapsed * 1000000 / self.ITERATIONS)
+
+    def test_loop_latency(self):
+        self.time_loop('select', eventloop.SelectPoller())
+        if hasattr(select, 'poll'):
+            self.time_loop('poll', eventloop.PollPoller())
+        if hasattr(select, 'epoll'):
+            self.time_loop('epoll', eventloop.EPollPoller())
+
+class _JoiningNetworkBuffer(object):
+    """The old NetworkBuffer implementation, which joins all the buffered
+    chunks on every read.  Used as a baseline by
+    DaemonProtocolPerformanceTest.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+
+    def addData(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+
+    def read(self, size):
+        self.chunks = [''.join(self.chunks)]
+        rv = self.chunks[0][:size]
+        self.chunks[0] = self.chunks[0][len(rv):]
+        self.length -= len(rv)
+        return rv
+
+class DaemonProtocolPerformanceTest(MiroTestCase):
+    """Measure how fast the daemon protocol handles large commands."""
+
+    STATUS_COUNT = 1000
+    COMMAND_COUNT = 10
+    # size of the chunks that we feed to the daemon (the default
+    # AsyncSocket.readSize)
+    CHUNK_SIZE = 4096
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        statuses = []
+        for i in xrange(self.STATUS_COUNT):
+            statuses.append({
+                'dlid': 'dlid%08d' % i,
+                'url': u'http://example.com/videos/%d.mp4' % i,
+                'state': u'downloading',
+                'currentSize': i * 1024,
+                'totalSize': 100 * 1024 * 1024,
+                'rate': 50000,
+                'eta': 600,
+                'filename': u'/home/user/Videos/Incomplete/%d.mp4' % i,
+                'shortFilename': u'%d.mp4' % i,
+                'retryTime': None,
+                'retryCount': -1,
+            })
+        comm = command.BatchUpdateDownloadStatus(None, statuses, False)
+        raw = cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
+        self.data = (struct.pack("Q", len(raw)) + raw) * self.COMMAND_COUNT
+
+    def time_daemon(self, label, buffer_class):
+        d = daemon.Daemon()
+        d.buffer = buffer_class()
+        # we feed data in ourselves, so don't try to read from the stream
+        d.updateReadCallback = lambda: None
+        commands = []
+        d.process_command = commands.append
+        d.change_state('ready')
+        start = time.time()
+        for i in xrange(0, len(self.data), self.CHUNK_SIZE):
+            d.handleData(self.data[i:i+self.CHUNK_SIZE])
+        elapsed = time.time() - start
+        self.assertEquals(len(commands), self.COMMAND_COUNT)
+        print '%s: %0.1f commands/sec (%d KB each)' % (label,
+                self.COMMAND_COUNT / elapsed,
+                len(self.data) / self.COMMAND_COUNT // 1024)
+
+    def test_command_throughput(self):
+        self.time_daemon('joined chunks', _JoiningNetworkBuffer)
+        self.time_daemon('NetworkBuffer', net.NetworkBuffer)
+
+class DownloadStatusEncodingPerformanceTest(MiroTestCase):
+    """Compare sending full status dicts from the downloader with sending
+    deltas using statusupdates.
+    """
+
+    DOWNLOAD_COUNT = 300
+    UPDATE_COUNT = 20
+
+    def make_statuses(self, round_):
+        statuses = []
+        for i in xrange(self.DOWNLOAD_COUNT):
+            statuses.append({
+                'dlid': 'dlid%08d' % i,
+                'url': 'http://example.com/torrents/%d.torrent' % i,
+                'state': 'downloading',
+                'total_size': 700 * 1024 * 1024,
+                'current_size': round_ * 50000 + i,
+                'eta': 3600.0 - round_,
+                'rate': 50000.0 + round_,
+                'upload_size': round_ * 1000,
+                'upload_rate': 1000.0 + round_,
+                'filename': '/home/user/Videos/Incomplete/%d.avi' % i,
+                'start_time': 1234567890.0,
+                'end_time': None,
+                'short_filename': '%d.avi' % i,
+                'reason_failed': '',
+                'short_reason_failed': '',
+                'type': 'BitTorrent',
+                'retry_time': None,
+                'retry_count': -1,
+                'activity': 'downloading',
+                'seeders': 10 + round_ % 3,
+                'leechers': 20,
+                'connections': 30,
+                'info_hash': '%040d' % i,
+            })
+        return statuses
+
+    def send_full(self, statuses):
+        data = cPickle.dumps(statuses, cPickle.HIGHEST_PROTOCOL)
+        for status in cPickle.loads(data):
+            for key in status:
+                if key not in statusupdates.NON_UNICODE_FIELDS:
+                    status[key] = util.unicodify(status[key])
+        return len(data)
+
+    def send_delta(self, statuses):
+        data = cPickle.dumps(self.encoder.encode(statuses),
+                             cPickle.HIGHEST_PROTOCOL)
+        self.decoder.decode(cPickle.loads(data))
+        return len(data)
+
+    def time_updates(self, label, send_func):
+        rounds = [self.make_statuses(i) for i in xrange(self.UPDATE_COUNT)]
+        total_bytes = 0
+        start = time.time()
+        for statuses in rounds:
+            total_bytes += send_func(statuses)
+        elapsed = time.time() - start
+        print '%s: %0.1f ms per update, %d KB per update' % (label,
+                elapsed * 1000 / self.UPDATE_COUNT,
+                total_bytes / self.UPDATE_COUNT // 1024)
+
+    def test_status_updates(self):
+        self.encoder = statusupdates.StatusEncoder()
+        self.decoder = statusupdates.StatusDecoder()
+        self.time_updates('full dicts', self.send_full)
+        self.time_updates('deltas', self.send_delta)
+
+class WorkerPoolImportPerformanceTest(EventLoopTest):
+    """Measure how fast we can run mutagen on a generated library of tagged
+    audio files with different numbers of worker processes.
+    """
+
+    CORPUS_SIZE = 2000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        template = resources.path("testdata/metadata/mp3-0.mp3")
+        self.cover_art_dir = os.path.join(self.tempdir, 'cover-art')
+        os.mkdir(self.cover_art_dir)
+        self.paths = []
+        for i in xrange(self.CORPUS_SIZE):
+            path = os.path.join(self.tempdir, 'track-%05d.mp3' % i)
+            shutil.copyfile(template, path)
+            audio = mutagen.File(path, easy=True)
+            if audio.tags is None:
+                audio.add_tags()
+            audio['title'] = u'Track %d' % i
+            audio['artist'] = u'Artist %d' % (i // 100)
+            audio['album'] = u'Album %d' % (i // 10)
+            audio['tracknumber'] = u'%d' % (i % 10 + 1)
+            audio.save()
+            self.paths.append(path)
+
+    def callback(self, msg, result):
+        self.finished_count += 1
+        if self.finished_count == len(self.paths):
+            self.stopEventLoop(abnormal=False)
+
+    def errback(self, msg, error):
+        self.error_count += 1
+        self.callback(msg, None)
+
+    def time_import(self, worker_count):
+        self.finished_count = self.error_count = 0
+        workerprocess.startup(worker_count=worker_count)
+        start = time.time()
+        for path in self.paths:
+            msg = workerprocess.MutagenTask(path, self.cover_art_dir)
+            workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(300)
+        elapsed = time.time() - start
+        workerprocess.shutdown()
+        self.assertEquals(self.finished_count, len(self.paths))
+        self.assertEquals(self.error_count, 0)
+        print '%d worker(s): %0.1f secs (%0.1f files/sec)' % (worker_count,
+                elapsed, len(self.paths) / elapsed)
+
+    def test_import(self):
+        worker_counts = set([1, 2, workerprocess.default_worker_count()])
+        for worker_count in sorted(worker_counts):
+            self.time_import(worker_count)
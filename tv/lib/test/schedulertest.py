@@ -1,8 +1,11 @@
 from time import time, sleep
+import json
+import select
 import threading
 
 from miro import eventloop
-from miro.test.framework import EventLoopTest
+from miro import util
+from miro.test.framework import EventLoopTest, MiroTestCase
 
 class SchedulerTest(EventLoopTest):
     def setUp(self):
@@ -57,3 +60,382 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class PollerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.sock1, self.sock2 = util.make_dummy_socket_pair()
+        self.fd = self.sock2.fileno()
+
+    def tearDown(self):
+        self.sock1.close()
+        self.sock2.close()
+        MiroTestCase.tearDown(self)
+
+    def poller_classes(self):
+        classes = [eventloop.SelectPoller]
+        if hasattr(select, 'poll'):
+            classes.append(eventloop.PollPoller)
+        if hasattr(select, 'epoll'):
+            classes.append(eventloop.EPollPoller)
+        return classes
+
+    def check_poller(self, poller):
+        # sockets should be writable right away
+        poller.add_writer(self.fd)
+        self.assertEquals(poller.poll(0.5), ([], [self.fd], []))
+        poller.remove_writer(self.fd)
+        # sockets should be readable once there's data
+        poller.add_reader(self.fd)
+        self.assertEquals(poller.poll(0), ([], [], []))
+        self.sock1.send("a")
+        self.assertEquals(poller.poll(0.5), ([self.fd], [], []))
+        # registrations should persist between calls
+        self.assertEquals(poller.poll(0.5), ([self.fd], [], []))
+        poller.add_writer(self.fd)
+        read_ready, write_ready, exc_ready = poller.poll(0.5)
+        self.assertEquals(read_ready, [self.fd])
+        self.assertEquals(write_ready, [self.fd])
+        # test removing
+        poller.remove_reader(self.fd)
+        poller.remove_writer(self.fd)
+        self.assertEquals(poller.poll(0), ([], [], []))
+        self.sock2.recv(1024)
+        poller.close()
+
+    def test_pollers(self):
+        for poller_class in self.poller_classes():
+            self.check_poller(poller_class())
+
+    def test_timeout(self):
+        for poller_class in self.poller_classes():
+            poller = poller_class()
+            poller.add_reader(self.fd)
+            start = time()
+            self.assertEquals(poller.poll(0.1), ([], [], []))
+            self.assert_(time() - start >= 0.09)
+            poller.close()
+
+    def test_make_poller(self):
+        poller = eventloop.make_poller()
+        self.check_poller(poller)
+
+class SchedulerCompactionTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.scheduler = eventloop.Scheduler()
+        self.scheduler.MIN_CANCELED_TO_COMPACT = 10
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def add_timeouts(self, count, delay=100):
+        return [self.scheduler.add_timeout(delay, self.callback, "foo",
+                                           args=(i,))
+                for i in xrange(count)]
+
+    def test_compact(self):
+        timeouts = self.add_timeouts(30)
+        # canceling less than half of the timeouts shouldn't compact
+        for dc in timeouts[:15]:
+            dc.cancel()
+        self.assertEquals(len(self.scheduler.heap), 30)
+        self.assertEquals(self.scheduler.canceled_count, 15)
+        # canceling more than half should
+        timeouts[15].cancel()
+        self.assertEquals(len(self.scheduler.heap), 14)
+        self.assertEquals(self.scheduler.canceled_count, 0)
+        self.assertEquals(self.scheduler.total_canceled, 16)
+        self.assertEquals(self.scheduler.compactions, 1)
+        # canceling twice shouldn't count twice
+        timeouts[15].cancel()
+        self.assertEquals(self.scheduler.total_canceled, 16)
+
+    def test_min_canceled(self):
+        timeouts = self.add_timeouts(5)
+        for dc in timeouts:
+            dc.cancel()
+        self.assertEquals(len(self.scheduler.heap), 5)
+        self.assertEquals(self.scheduler.compactions, 0)
+        # next_timeout() should skip over the canceled timeouts
+        self.assertEquals(self.scheduler.next_timeout(), None)
+        self.assertEquals(len(self.scheduler.heap), 0)
+        self.assertEquals(self.scheduler.canceled_count, 0)
+
+    def test_process_after_compact(self):
+        timeouts = self.add_timeouts(20, delay=0)
+        for dc in timeouts[::2]:
+            dc.cancel()
+        timeouts[1].cancel()
+        self.assertEquals(self.scheduler.compactions, 1)
+        while self.scheduler.has_pending_timeout():
+            self.scheduler.process_next_timeout()
+        self.assertEquals(self.calls, range(3, 20, 2))
+        # canceling a timeout after it ran shouldn't affect the counts
+        timeouts[3].cancel()
+        self.assertEquals(self.scheduler.canceled_count, 0)
+
+class EventLoopProfilerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.profiler = eventloop.EventLoopProfiler()
+
+    def find_callback(self, stats, kind, name):
+        for info in stats['callbacks']:
+            if info['kind'] == kind and info['name'] == name:
+                return info
+        raise AssertionError("%s %s not found" % (kind, name))
+
+    def test_record_call(self):
+        self.profiler.record_call('idle', 'foo', 0.002, 0.02)
+        self.profiler.record_call('idle', 'foo', 0.0, 2.0)
+        self.profiler.record_call('timeout', 'foo', 0.5, 0.0005)
+        stats = self.profiler.get_stats()
+        # callbacks should be sorted by total run time
+        self.assertEquals([(info['kind'], info['name'])
+                           for info in stats['callbacks']],
+                          [('idle', 'foo'), ('timeout', 'foo')])
+        info = self.find_callback(stats, 'idle', 'foo')
+        self.assertEquals(info['count'], 2)
+        self.assertAlmostEquals(info['total_run_time'], 2.02)
+        self.assertAlmostEquals(info['max_run_time'], 2.0)
+        self.assertAlmostEquals(info['max_wait_time'], 0.002)
+        # bounds are 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0
+        self.assertEquals(info['run_histogram'], [0, 0, 0, 1, 0, 0, 0, 1, 0])
+        self.assertEquals(info['wait_histogram'], [1, 1, 0, 0, 0, 0, 0, 0, 0])
+
+    def test_max_names(self):
+        self.profiler.MAX_NAMES = 2
+        for name in ('a', 'b', 'c', 'd', 'a'):
+            self.profiler.record_call('idle', name, 0, 0)
+        stats = self.profiler.get_stats()
+        self.assertEquals(self.find_callback(stats, 'idle', 'a')['count'], 2)
+        self.assertEquals(self.find_callback(stats, 'idle', '<other>')['count'],
+                          2)
+
+    def test_queue_depths(self):
+        self.profiler.sample_queue_depths(5, 0, 1)
+        self.profiler.sample_queue_depths(10, 1, 1)
+        self.profiler.sample_queue_depths(2, 0, 1)
+        stats = self.profiler.get_stats()
+        self.assertEquals(len(stats['queue_depths']), 1)
+        sample = stats['queue_depths'][0]
+        self.assertEquals(sample['idle'], 10)
+        self.assertEquals(sample['urgent'], 1)
+        self.assertEquals(sample['timeouts'], 1)
+
+    def test_dump_json(self):
+        self.profiler.record_call('urgent', 'foo', 0, 0.1)
+        path = self.make_temp_path('.json')
+        self.profiler.dump_json(path)
+        stats = json.load(open(path))
+        self.assertEquals(stats['callbacks'][0]['name'], 'foo')
+
+class EventLoopProfilingTest(EventLoopTest):
+    def tearDown(self):
+        eventloop.stop_profiling()
+        EventLoopTest.tearDown(self)
+
+    def test_profiling(self):
+        self.assertEquals(eventloop.get_profile_stats(), None)
+        eventloop.start_profiling()
+        # Schedule the shutdown from the idle callback.  Timeouts run before
+        # idles in a loop iteration, so a shutdown timeout added up front
+        # could fire first on a slow machine.
+        def idle_callback():
+            eventloop.add_timeout(0, eventloop.shutdown, "shutdown")
+        eventloop.add_idle(idle_callback, "idle callback")
+        eventloop.add_urgent_call(lambda: None, "urgent callback")
+        self.runEventLoop()
+        stats = eventloop.get_profile_stats()
+        counts = dict(((info['kind'], info['name']), info['count'])
+                      for info in stats['callbacks'])
+        self.assertEquals(counts[('idle', 'idle (idle callback)')], 1)
+        self.assertEquals(counts[('urgent', 'idle (urgent callback)')], 1)
+        self.assertEquals(counts[('timeout', 'timeout (shutdown)')], 1)
+
+class CallQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = eventloop.CallQueue()
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def add_idle(self, value, **kwargs):
+        return self.queue.add_idle(self.callback, "foo", args=(value,),
+                                   **kwargs)
+
+    def test_fifo(self):
+        for i in range(5):
+            self.add_idle(i)
+        self.queue.process_idles()
+        self.assertEquals(self.calls, range(5))
+
+    def test_priority(self):
+        self.add_idle('low', priority=eventloop.PRIORITY_LOW)
+        self.add_idle('default1')
+        self.add_idle('high', priority=eventloop.PRIORITY_HIGH)
+        self.add_idle('default2')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, ['high', 'default1', 'default2', 'low'])
+
+    def test_coalesce(self):
+        dc = self.add_idle(1, coalesce_key='key')
+        self.add_idle(2)
+        # the call for key should be updated to use the new args, but keep
+        # its position
+        self.assert_(self.add_idle(3, coalesce_key='key') is dc)
+        self.assertEquals(self.queue.qsize(), 2)
+        self.assertEquals(self.queue.coalesced_count, 1)
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [3, 2])
+        # after the call runs, new calls should be added again
+        self.add_idle(4, coalesce_key='key')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [3, 2, 4])
+
+    def test_coalesce_canceled(self):
+        self.add_idle(1, coalesce_key='key').cancel()
+        self.add_idle(2, coalesce_key='key')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [2])
+
+    def test_coalesce_higher_priority(self):
+        self.add_idle(1)
+        self.add_idle(2, coalesce_key='key')
+        self.add_idle(3, coalesce_key='key', priority=eventloop.PRIORITY_HIGH)
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [3, 1])
+
+class IdleTimeBudgetTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.loop = eventloop.EventLoop()
+        self.loop.IDLE_TIME_BUDGET = 0.05
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.poller.close()
+        self.loop.wake_sender.close()
+        self.loop.wake_receiver.close()
+        MiroTestCase.tearDown(self)
+
+    def slow_callback(self):
+        self.calls += 1
+        sleep(0.03)
+
+    def test_time_budget(self):
+        for i in range(5):
+            self.loop.idle_queue.add_idle(self.slow_callback, "slow")
+        for event in self.loop.generate_events([], []):
+            event()
+        # we should stop after 2 callbacks, since that passes our budget
+        self.assertEquals(self.calls, 2)
+        # since we have idles left, we shouldn't block next loop
+        self.assertEquals(self.loop.calc_timeout(), 0)
+
+class FakeEventLoop(object):
+    def __init__(self):
+        self.quit_flag = False
+        self.idle_queue = eventloop.CallQueue()
+
+    def wakeup(self):
+        pass
+
+class ThreadPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.event_loop = FakeEventLoop()
+        self.pool = eventloop.ThreadPool(self.event_loop)
+        self.pool.IDLE_THREAD_TIMEOUT = 0.1
+        self.pool.init_threads()
+        self.release_event = threading.Event()
+        self.results = []
+
+    def tearDown(self):
+        self.release_event.set()
+        self.pool.close_threads()
+        MiroTestCase.tearDown(self)
+
+    def blocking_task(self, value):
+        self.release_event.wait(5)
+        return value
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def errback(self, error):
+        self.results.append(error)
+
+    def wait_for(self, condition, timeout=2.0):
+        end = time() + timeout
+        while not condition():
+            if time() > end:
+                raise AssertionError("timed out waiting")
+            sleep(0.01)
+
+    def run_callbacks(self):
+        self.event_loop.idle_queue.process_idles()
+
+    def test_lanes(self):
+        # a blocked lane shouldn't stop other lanes
+        self.pool.set_lane_size(eventloop.LANE_DEFAULT, 1, 1)
+        self.pool.queue_call(self.callback, self.errback,
+                             self.blocking_task, 'blocking', 'default')
+        self.pool.queue_call_in_lane(eventloop.LANE_DNS, self.callback,
+                                     self.errback, lambda: 'dns', 'dns')
+        self.wait_for(self.event_loop.idle_queue.has_pending_idle)
+        self.run_callbacks()
+        self.assertEquals(self.results, ['dns'])
+        self.release_event.set()
+        self.wait_for(self.event_loop.idle_queue.has_pending_idle)
+        self.run_callbacks()
+        self.assertEquals(self.results, ['dns', 'default'])
+
+    def test_grow_and_shrink(self):
+        self.pool.set_lane_size(eventloop.LANE_IO, 0, 3)
+        lane = self.pool.lanes[eventloop.LANE_IO]
+        for i in range(5):
+            self.pool.queue_call_in_lane(eventloop.LANE_IO, self.callback,
+                                         self.errback, self.blocking_task,
+                                         'blocking', i)
+        self.wait_for(lambda: lane.running_count == 3)
+        self.assertEquals(len(lane.threads), 3)
+        self.release_event.set()
+        self.wait_for(lambda: lane.completed_count == 5)
+        # after our idle timeout, the threads should exit
+        self.wait_for(lambda: len(lane.threads) == 0)
+        self.run_callbacks()
+        self.assertSameSet(self.results, range(5))
+
+    def test_cancel(self):
+        self.pool.set_lane_size(eventloop.LANE_DEFAULT, 1, 1)
+        running_task = self.pool.queue_call(self.callback, self.errback,
+                                            self.blocking_task, 'blocking',
+                                            'running')
+        waiting_task = self.pool.queue_call(self.callback, self.errback,
+                                            self.blocking_task, 'blocking',
+                                            'waiting')
+        lane = self.pool.lanes[eventloop.LANE_DEFAULT]
+        self.wait_for(lambda: lane.running_count == 1)
+        self.assertEquals(waiting_task.cancel(), True)
+        # we can't stop a running task, but its callback shouldn't run
+        self.assertEquals(running_task.cancel(), False)
+        self.release_event.set()
+        self.wait_for(lambda: lane.completed_count == 1)
+        sleep(0.05)
+        self.run_callbacks()
+        self.assertEquals(self.results, [])
+        self.assertEquals(lane.canceled_count, 2)
+
+    def test_errback(self):
+        def fail():
+            raise ValueError()
+        self.pool.queue_call(self.callback, self.errback, fail, 'fail')
+        self.wait_for(self.event_loop.idle_queue.has_pending_idle)
+        self.run_callbacks()
+        self.assertEquals(len(self.results), 1)
+        self.assert_(isinstance(self.results[0], ValueError))
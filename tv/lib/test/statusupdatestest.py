@@ -0,0 +1,111 @@
+import cPickle
+
+from miro.dl_daemon import statusupdates
+from miro.test.framework import MiroTestCase
+
+class StatusUpdatesTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.encoder = statusupdates.StatusEncoder()
+        self.decoder = statusupdates.StatusDecoder()
+
+    def make_status(self, dlid='dlid1', **kwargs):
+        status = {
+            'dlid': dlid,
+            'url': 'http://example.com/video.mp4',
+            'state': u'downloading',
+            'total_size': 1000,
+            'current_size': 100,
+            'eta': 9.5,
+            'rate': 100.0,
+            'filename': '/tmp/video.mp4',
+            'reason_failed': None,
+            'retry_count': -1,
+            'start_time': 1234567890.5,
+            'end_time': None,
+        }
+        status.update(kwargs)
+        return status
+
+    def send(self, statuses):
+        # pickle the data like Daemon.send() does
+        data = cPickle.dumps(self.encoder.encode(statuses),
+                             cPickle.HIGHEST_PROTOCOL)
+        return self.decoder.decode(cPickle.loads(data))
+
+    def check_decoded(self, decoded, status):
+        correct = status.copy()
+        for key, value in correct.items():
+            if key not in statusupdates.NON_UNICODE_FIELDS:
+                if isinstance(value, str):
+                    correct[key] = value.decode('ascii')
+        self.assertEquals(decoded, correct)
+        for key, value in correct.items():
+            self.assertEquals(type(decoded[key]), type(value))
+
+    def test_full(self):
+        status = self.make_status()
+        self.check_decoded(self.send([status])[0], status)
+
+    def test_delta(self):
+        self.send([self.make_status()])
+        status = self.make_status(current_size=200, eta=None,
+                                  state=u'paused')
+        full_resync, forgotten, records, numbers = self.encoder.encode(
+            [status])
+        self.assertEquals(full_resync, False)
+        self.assertEquals(forgotten, None)
+        self.assertEquals(len(records), 1)
+        dlid, numeric_mask, int_mask, changed, removed = records[0]
+        # only the changed fields should be sent
+        self.assertEquals(changed, {'state': u'paused'})
+        self.assertEquals(removed, None)
+        self.assertEquals(len(numbers), 2 * 8)
+        self.check_decoded(self.decoder.decode(
+            (full_resync, forgotten, records, numbers))[0], status)
+
+    def test_removed_fields(self):
+        self.send([self.make_status(metainfo='abc')])
+        status = self.make_status()
+        self.check_decoded(self.send([status])[0], status)
+
+    def test_multiple_downloads(self):
+        statuses = [self.make_status('dlid%d' % i, current_size=i)
+                    for i in xrange(10)]
+        self.send(statuses)
+        statuses[3]['rate'] = 5000.0
+        statuses[7]['total_size'] = 2 ** 40
+        statuses[7]['url'] = 'http://example.com/other.mp4'
+        for decoded, status in zip(self.send(statuses), statuses):
+            self.check_decoded(decoded, status)
+
+    def test_resync(self):
+        # a new encoder (for example after a reconnect) should send a full
+        # resync
+        self.send([self.make_status('dlid1'), self.make_status('dlid2')])
+        self.encoder = statusupdates.StatusEncoder()
+        status = self.make_status('dlid1')
+        self.check_decoded(self.send([status])[0], status)
+        self.assertEquals(self.decoder.statuses.keys(), ['dlid1'])
+
+    def test_forget(self):
+        # forgotten downloads should be dropped on both ends
+        self.send([self.make_status('dlid1'), self.make_status('dlid2')])
+        self.encoder.forget('dlid1')
+        self.assertEquals(self.encoder.last_sent.keys(), ['dlid2'])
+        self.send([])
+        self.assertEquals(self.decoder.statuses.keys(), ['dlid2'])
+        # if the download comes back, we should send its full status
+        status = self.make_status('dlid1', state=u'paused')
+        self.check_decoded(self.send([status])[0], status)
+        self.assertSameSet(self.decoder.statuses.keys(), ['dlid1', 'dlid2'])
+
+    def test_forget_then_update(self):
+        # forgetting a download and sending an update for it in the same
+        # message should leave both ends in sync
+        self.send([self.make_status('dlid1')])
+        self.encoder.forget('dlid1')
+        status = self.make_status('dlid1', current_size=500)
+        self.check_decoded(self.send([status])[0], status)
+        status = self.make_status('dlid1', current_size=600)
+        self.check_decoded(self.send([status])[0], status)
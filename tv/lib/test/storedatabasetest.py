@@ -1,4 +1,5 @@
 from datetime import datetime
+import gc
 import os
 import unittest
 import string
@@ -22,6 +23,7 @@ from miro import schema
 from miro import signals
 from miro import tabs
 from miro import theme
+from miro.data import fulltextsearch
 from miro.fileobject import FilenameType
 import shutil
 from miro import storedatabase
@@ -278,6 +280,85 @@ class DeviceDBUpgradeTest(DBUpgradeTest):
                         os.path.join(device_mount, '.miro', 'sqlite'))
         self.db = devices.load_sqlite_database(device_mount, 1024)
 
+class UpgradeHelpersTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.connection = sqlite3.connect(':memory:', isolation_level=None)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("CREATE TABLE foo(id integer PRIMARY KEY, "
+                            "name text, size integer)")
+        self.cursor.execute("CREATE INDEX foo_name ON foo(name)")
+        self.cursor.executemany("INSERT INTO foo(id, name, size) "
+                                "VALUES (?, ?, ?)",
+                                [(i, u'name-%s' % i, i * 10)
+                                 for i in xrange(-5, 20)])
+
+    def tearDown(self):
+        self.connection.close()
+        MiroTestCase.tearDown(self)
+
+    def test_iter_row_pages(self):
+        pages = list(databaseupgrade.iter_row_pages(
+            self.cursor, 'foo', ['name'], page_size=10))
+        self.assertEquals([len(page) for page in pages], [10, 10, 5])
+        ids = [row[0] for page in pages for row in page]
+        self.assertEquals(ids, range(-5, 20))
+        self.assertEquals(pages[0][0], (-5, u'name--5'))
+
+    def test_iter_row_pages_where(self):
+        pages = list(databaseupgrade.iter_row_pages(
+            self.cursor, 'foo', ['size'], where='size >= ?', values=(100,),
+            page_size=4))
+        ids = [row[0] for page in pages for row in page]
+        self.assertEquals(ids, range(10, 20))
+
+    def test_rewrite_rows(self):
+        def rewrite(id_, name, size):
+            if id_ % 2 == 0:
+                return (name.upper(), size + 1)
+        updated = databaseupgrade.rewrite_rows(
+            self.cursor, 'foo', ['name', 'size'], ['name', 'size'], rewrite,
+            page_size=7)
+        self.assertEquals(updated, 12)
+        self.cursor.execute("SELECT id, name, size FROM foo")
+        for id_, name, size in self.cursor.fetchall():
+            if id_ % 2 == 0:
+                self.assertEquals(name, u'NAME-%s' % id_)
+                self.assertEquals(size, id_ * 10 + 1)
+            else:
+                self.assertEquals(name, u'name-%s' % id_)
+                self.assertEquals(size, id_ * 10)
+
+    def test_rewrite_rows_progress(self):
+        progress = self.patch_for_test(
+            'miro.dbupgradeprogress.new_style_progress')
+        databaseupgrade._current_progress = \
+                databaseupgrade._UpgradeProgress(0, 1, 1)
+        try:
+            databaseupgrade.rewrite_rows(
+                self.cursor, 'foo', ['name'], ['name'],
+                lambda id_, name: None, page_size=5)
+        finally:
+            databaseupgrade._current_progress = None
+        self.assertEquals(progress.call_count, 5)
+        self.assertEquals(progress.call_args[0], (0, 1.0, 1))
+
+    def test_rebuild_table(self):
+        databaseupgrade.rebuild_table(self.cursor, 'foo', [
+            ('id', 'integer', 'id'),
+            ('name', 'text', 'name'),
+            ('big', 'integer', 'size > 100'),
+        ], where='id >= ?', values=(0,))
+        self.cursor.execute("SELECT id, name, big FROM foo ORDER BY id")
+        rows = self.cursor.fetchall()
+        self.assertEquals(len(rows), 20)
+        self.assertEquals(rows[0], (0, u'name-0', 0))
+        self.assertEquals(rows[-1], (19, u'name-19', 1))
+        # indexes should be re-created
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                            "WHERE type='index' AND tbl_name='foo'")
+        self.assertEquals(self.cursor.fetchall(), [(u'foo_name',)])
+
 class FakeSchemaTest(StoreDatabaseTest):
     OBJECT_SCHEMAS = test_object_schemas
 
@@ -548,6 +629,48 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+    def test_bulk_update(self):
+        app.bulk_sql_manager.start()
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        self.lee.age = 26
+        self.lee.signal_change()
+        self.joe.name = u'joe2'
+        self.joe.signal_change()
+        # nothing should be updated yet
+        app.db.cursor.execute("SELECT name, age FROM human WHERE id=?",
+                              (self.lee.id,))
+        self.assertEquals(app.db.cursor.fetchall(), [(u'lee', 25)])
+        app.bulk_sql_manager.finish()
+        self.reload_test_database()
+        self.check_database()
+
+    def test_bulk_update_then_remove(self):
+        app.bulk_sql_manager.start()
+        self.joe.name = u'joe2'
+        self.joe.signal_change()
+        self.joe.remove()
+        app.bulk_sql_manager.finish()
+        self.db.remove(self.joe)
+        self.reload_test_database()
+        self.check_database()
+
+    def test_update_sql_cache(self):
+        sql_cache = app.db._update_sql_cache
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        self.joe.name = u'joe2'
+        self.joe.signal_change()
+        # lee and joe use different tables, so we should have 2 statements,
+        # both using a placeholder for the id.
+        statements = sorted(sql_cache.dict.values())
+        self.assertEquals(len(statements), 2)
+        for sql in statements:
+            self.assert_(sql.endswith('WHERE id=?'))
+        self.lee.name = u'lee3'
+        self.lee.signal_change()
+        self.assertEquals(sorted(sql_cache.dict.values()), statements)
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -564,6 +687,225 @@ class ObjectMemoryTest(FakeSchemaTest):
         lee.remove()
         self.assertEquals(0, len(app.db._object_map))
 
+class ObjectEvictionTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        for x in range(10):
+            Human(u'clone-%s' % x, x, 1.4, [], {u'virtual bowling': x})
+        self.human_ids = [h.id for h in Human.make_view()]
+        # drop our references to the objects created in setUp
+        self.lee = self.joe = self.ben = self.db = None
+        self.reload_database(self.save_path, schema_version=0,
+                             object_schemas=self.OBJECT_SCHEMAS,
+                             object_cache_size=5)
+
+    def load_and_shrink(self):
+        humans = list(Human.make_view())
+        self.assertEquals(len(humans), 11)
+        del humans
+        app.db.shrink_object_map()
+        gc.collect()
+
+    def test_evict(self):
+        self.load_and_shrink()
+        self.assertEquals(len(app.db._object_map), 5)
+        self.assertEquals(app.db._object_map.resident_count(), 5)
+        self.assertEquals(app.db._object_map.evictions, 6)
+
+    def test_restore_after_evict(self):
+        self.load_and_shrink()
+        for id_ in self.human_ids:
+            self.assert_(app.db.id_alive(id_, Human))
+            human = app.db.get_obj_by_id(id_, Human)
+            self.assertEquals(human.id, id_)
+        # all objects should still be accessible through views
+        self.assertEquals(len(list(Human.make_view())), 11)
+        self.assert_(app.db._object_map.misses > 0)
+
+    def test_referenced_objects_stay(self):
+        lee = Human.make_view('name=?', (u'lee',)).get_singleton()
+        self.load_and_shrink()
+        # we still have a reference to lee, so we should get the same
+        # object back
+        self.assert_(app.db.get_obj_by_id(lee.id, Human) is lee)
+
+    def test_pinned_objects(self):
+        humans = list(Human.make_view(order_by='id'))
+        # an unsaved change should pin an object
+        humans[0].age = 100
+        # as should a signal connection
+        humans[1].connect('removed', lambda obj: None)
+        pinned_ids = [humans[0].id, humans[1].id]
+        del humans
+        app.db.shrink_object_map()
+        gc.collect()
+        for id_ in pinned_ids:
+            self.assert_((id_, 'human') in app.db._object_map)
+        self.assertEquals(app.db.get_obj_by_id(pinned_ids[0], Human).age,
+                          100)
+
+class FakeEventLoop(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, delay, function, name, args=None, kwargs=None):
+        self.timeouts.append((delay, function))
+
+class CommitCoalesceTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db.commit_coalesce_time = 10
+        self.eventloop = FakeEventLoop()
+
+    def saved_names(self):
+        app.db.cursor.execute("SELECT name FROM human")
+        return set(row[0] for row in app.db.cursor.fetchall())
+
+    def test_commit_deferred(self):
+        Human(u'bob', 50, 1.8, [])
+        app.db.on_event_finished(self.eventloop, True)
+        self.assert_(app.db.has_pending_commit())
+        self.assertNotEquals(app.db._statements_in_transaction, [])
+        self.assertEquals(len(self.eventloop.timeouts), 1)
+        Human(u'sam', 42, 1.6, [])
+        app.db.on_event_finished(self.eventloop, True)
+        # the timeout should commit everything
+        delay, function = self.eventloop.timeouts[0]
+        self.assertEquals(delay, 10)
+        function()
+        self.assert_(not app.db.has_pending_commit())
+        self.assertEquals(app.db._statements_in_transaction, [])
+        self.assert_(set([u'bob', u'sam']).issubset(self.saved_names()))
+
+    def test_failed_event_rollback(self):
+        Human(u'bob', 50, 1.8, [])
+        app.db.on_event_finished(self.eventloop, True)
+        Human(u'sam', 42, 1.6, [])
+        app.db.on_event_finished(self.eventloop, False)
+        # only the changes from the failed event should be rolled back
+        names = self.saved_names()
+        self.assert_(u'bob' in names)
+        self.assert_(u'sam' not in names)
+        self.assert_(app.db.has_pending_commit())
+        app.db.finish_transaction()
+        self.assert_(u'bob' in self.saved_names())
+
+    def test_no_coalesce_on_failure(self):
+        Human(u'bob', 50, 1.8, [])
+        app.db.on_event_finished(self.eventloop, False)
+        self.assert_(not app.db.has_pending_commit())
+        self.assertEquals(self.eventloop.timeouts, [])
+        self.assert_(u'bob' not in self.saved_names())
+
+class WALCheckpointerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'checkpoint-test.db')
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=wal")
+        self.connection.execute("PRAGMA wal_autocheckpoint=0")
+        self.connection.execute("CREATE TABLE foo(bar TEXT)")
+        self.connection.commit()
+        self.times = []
+        self.checkpointer = storedatabase.WALCheckpointer(
+            self.path, lambda sql, t: self.times.append(sql))
+
+    def tearDown(self):
+        self.connection.close()
+        MiroTestCase.tearDown(self)
+
+    def test_waits_for_idle(self):
+        self.checkpointer.note_activity()
+        self.assert_(not self.checkpointer._should_checkpoint())
+
+    def test_checkpoint(self):
+        self.checkpointer.last_activity = 0
+        self.checkpointer.last_checkpoint = 0
+        self.assert_(self.checkpointer._should_checkpoint())
+        connection = sqlite3.connect(self.path)
+        try:
+            self.checkpointer._run_checkpoint(connection)
+        finally:
+            connection.close()
+        self.assertEquals(self.times, ["PRAGMA wal_checkpoint(PASSIVE)"])
+        self.assertEquals(self.checkpointer.checkpoint_count, 1)
+        # nothing changed, so we shouldn't checkpoint again
+        self.assert_(not self.checkpointer._should_checkpoint())
+
+class ProjectedViewTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        for x in range(10):
+            Human(u'clone-%s' % x, x, 1.4, [], {u'virtual bowling': x})
+        self.reload_test_database()
+
+    def make_projected_view(self):
+        return Human.make_view(order_by='id', columns=['name'])
+
+    def test_projected_restore(self):
+        humans = list(self.make_projected_view())
+        self.assertEquals(len(humans), 11)
+        for human in humans:
+            self.assert_('name' in human.__dict__)
+            self.assert_('high_scores' not in human.__dict__)
+            self.assert_('high_scores' in human._deferred_columns)
+
+    def test_load_on_access(self):
+        humans = list(self.make_projected_view())
+        self.assertEquals(humans[0].high_scores, {u'virtual bowling': 212})
+        self.assertEquals(humans[1].age, 0)
+        # accessing one deferred column should have loaded all deferred
+        # columns for all of the objects
+        for human in humans:
+            self.assertEquals(human._deferred_columns, frozenset())
+            self.assert_('high_scores' in human.__dict__)
+        self.assertEquals(app.db._deferred_objects[HumanSchema], {})
+
+    def test_update_with_deferred_columns(self):
+        lee = list(self.make_projected_view())[0]
+        lee.name = u'lee2'
+        lee.signal_change()
+        lee.age = 30
+        lee.signal_change()
+        self.assertEquals(lee._deferred_columns,
+                          frozenset(['meters_tall', 'friend_names',
+                                     'high_scores', 'stuff', 'id_code',
+                                     'favorite_colors']))
+        self.reload_test_database()
+        lee = Human.make_view('id=?', (lee.id,)).get_singleton()
+        self.assertEquals(lee.name, u'lee2')
+        self.assertEquals(lee.age, 30)
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+
+    def test_bulk_update_deferred_columns(self):
+        # values set with _bulk_update_db_values() should be saved and
+        # shouldn't get overwritten by loading the deferred columns
+        lee = list(self.make_projected_view())[0]
+        lee._bulk_update_db_values({'age': 31, 'meters_tall': 2.0})
+        lee.signal_change()
+        self.assertEquals(lee.high_scores, {u'virtual bowling': 212})
+        self.assertEquals(lee.age, 31)
+        self.assertEquals(lee.meters_tall, 2.0)
+        self.reload_test_database()
+        lee = Human.make_view('id=?', (lee.id,)).get_singleton()
+        self.assertEquals(lee.age, 31)
+        self.assertEquals(lee.meters_tall, 2.0)
+
+    def test_load_deferred_columns_deleted_row(self):
+        lee = list(self.make_projected_view())[0]
+        app.db.cursor.execute("DELETE FROM human WHERE id=?", (lee.id,))
+        self.assertRaises(database.ObjectNotFoundError, getattr, lee,
+                          'high_scores')
+
+    def test_full_view_after_projected(self):
+        # once an object is loaded, later views should return it and its
+        # deferred columns should still load correctly.
+        lee = list(self.make_projected_view())[0]
+        lee2 = Human.make_view('id=?', (lee.id,)).get_singleton()
+        self.assert_(lee is lee2)
+        self.assertEquals(lee2.meters_tall, 1.4)
+
 class ValidationTest(FakeSchemaTest):
     def assert_object_valid(self, obj):
         obj.signal_change()
@@ -899,5 +1241,60 @@ class TemporaryModeTest(MiroTestCase):
             self.last_connect_path = path
             return self.real_sqlite3_connect(path, *args, **kwargs)
 
+class FullTextSearchTriggerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.connection = sqlite3.connect(':memory:', isolation_level=None)
+        self.connection.execute("CREATE TABLE item(id integer PRIMARY KEY, "
+                                "title text, description text, artist text, "
+                                "album text, genre text, filename text, "
+                                "parent_title text, watched_time timestamp, "
+                                "resume_time integer)")
+        fulltextsearch.setup_fulltext_search(self.connection)
+        self.connection.execute("INSERT INTO item(id, title) "
+                                "VALUES(1, 'miro')")
+
+    def tearDown(self):
+        self.connection.close()
+        MiroTestCase.tearDown(self)
+
+    def changes_for_update(self, sql):
+        """Run an UPDATE and return how many rows it changed, including rows
+        changed by triggers.
+        """
+        start = self.connection.execute("SELECT total_changes()").fetchone()
+        self.connection.execute(sql)
+        end = self.connection.execute("SELECT total_changes()").fetchone()
+        return end[0] - start[0]
+
+    def check_search(self, term, correct_ids):
+        cursor = self.connection.execute("SELECT docid FROM item_fts "
+                                         "WHERE item_fts MATCH ?", (term,))
+        self.assertSameSet([r[0] for r in cursor], correct_ids)
+
+    def test_unindexed_column_update(self):
+        # updating columns that aren't indexed shouldn't touch item_fts
+        self.assertEquals(self.changes_for_update(
+            "UPDATE item SET watched_time=1, resume_time=10 WHERE id=1"), 1)
+        self.check_search('miro', [1])
+
+    def test_unchanged_indexed_column_update(self):
+        # setting an indexed column to its current value shouldn't touch
+        # item_fts either
+        self.assertEquals(self.changes_for_update(
+            "UPDATE item SET title='miro', resume_time=10 WHERE id=1"), 1)
+        self.check_search('miro', [1])
+
+    def test_indexed_column_update(self):
+        # FTS4 updates its shadow tables, so we can't know the exact count
+        self.assert_(self.changes_for_update(
+            "UPDATE item SET title='foo' WHERE id=1") > 1)
+        self.check_search('miro', [])
+        self.check_search('foo', [1])
+        self.changes_for_update("UPDATE item SET title=NULL, artist='bar' "
+                                "WHERE id=1")
+        self.check_search('foo', [])
+        self.check_search('bar', [1])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
 import os
+import struct
 import time
+import threading
 import Queue
 
 from miro import app
@@ -8,7 +10,8 @@ from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -143,6 +146,22 @@ class SubprocessManagerTest(EventLoopTest):
         # check that we got a pong for each ping
         self.assertEquals(self.responder.pong_count, 3)
 
+    def test_throughput(self):
+        # send a lot of messages at once.  They should get written to the
+        # subprocess in a single batch and all come back quickly.
+        dump_objs = self.patch_for_test('miro.subprocessmanager._dump_objs',
+                mock.Mock(wraps=subprocessmanager._dump_objs))
+        ping_count = 5000
+        start = time.time()
+        for i in xrange(ping_count):
+            Ping().send_to_process()
+        while self.responder.pong_count < ping_count:
+            self.runEventLoop(0.1, timeoutNormal=True)
+            if time.time() - start > 5.0:
+                raise AssertionError("only got %s pongs in 5 secs" %
+                                     self.responder.pong_count)
+        self.assertEquals(dump_objs.call_count, 1)
+
     def test_event_callbacks(self):
         # test that we get event callbacks
 
@@ -226,6 +245,50 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class PipeProtocolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        read_fd, write_fd = os.pipe()
+        self.read_pipe = os.fdopen(read_fd, 'rb')
+        self.write_pipe = os.fdopen(write_fd, 'wb')
+
+    def tearDown(self):
+        self.read_pipe.close()
+        self.write_pipe.close()
+        MiroTestCase.tearDown(self)
+
+    def test_batches(self):
+        subprocessmanager._dump_objs([1, u'two'], self.write_pipe)
+        subprocessmanager._dump_obj({'three': 3}, self.write_pipe)
+        subprocessmanager._dump_objs([4, None, 5], self.write_pipe)
+        self.assertEquals(
+            list(subprocessmanager._read_from_pipe(self.read_pipe)),
+            [1, u'two', {'three': 3}, 4])
+
+    def test_dump_batch_skips_bad_objects(self):
+        bad_obj = lambda: None
+        bad_objs = subprocessmanager._dump_batch([1, bad_obj, 2, None],
+                                                 self.write_pipe)
+        self.assertEquals(bad_objs, [bad_obj])
+        self.assertEquals(
+            list(subprocessmanager._read_from_pipe(self.read_pipe)), [1, 2])
+
+    def test_dump_batch_skips_unpicklable_locks(self):
+        # cPickle raises TypeError rather than PickleError for locks
+        bad_obj = threading.Lock()
+        bad_objs = subprocessmanager._dump_batch([1, bad_obj, 2, None],
+                                                 self.write_pipe)
+        self.assertEquals(bad_objs, [bad_obj])
+        self.assertEquals(
+            list(subprocessmanager._read_from_pipe(self.read_pipe)), [1, 2])
+
+    def test_corrupt_data(self):
+        data = 'not a pickle'
+        self.write_pipe.write(struct.pack("Q", len(data)) + data)
+        self.write_pipe.flush()
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._load_objs, self.read_pipe)
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -246,6 +309,9 @@ class WorkerProcessTest(EventLoopTest):
         workerprocess._subprocess_manager.handler_class = (
                 UnittestWorkerProcessHandler)
         workerprocess._subprocess_manager.restart_delay = 0
+        workerprocess._movie_data_manager.handler_class = (
+                UnittestWorkerProcessHandler)
+        workerprocess._movie_data_manager.restart_delay = 0
         self.reset_results()
 
     def tearDown(self):
@@ -299,16 +365,32 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(worker_count=1)
+        worker = workerprocess._subprocess_manager.workers[0]
+        original_pid = worker.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        worker.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, worker.process.pid)
+        self.check_successful_result()
+
+    def test_crash_with_multiple_workers(self):
+        # force a crash of the worker that gets our task.  The other worker
+        # should handle it while the crashed one waits to restart.
+        workerprocess._subprocess_manager.restart_delay = 60
+        workerprocess.startup(worker_count=2)
+        self.send_feedparser_task()
+        pool = workerprocess._subprocess_manager
+        crashed = [w for w in pool.workers if pool.assigned_tasks[w]][0]
+        other = [w for w in pool.workers if w is not crashed][0]
+        other_pid = other.process.pid
+        crashed.process.terminate()
+        with self.allow_warnings():
+            self.runEventLoop(4.0)
         self.check_successful_result()
+        self.assertEquals(other.process.pid, other_pid)
 
     def test_queue_before_start(self):
         # test sending tasks before we start the worker process
@@ -422,7 +504,134 @@ class MutagenTest(WorkerProcessTest):
         self.check_mutagen_call('drm.m4v', 'video', 2668832, 'Thinkers',
                                 True)
 
+    def test_mutagen_batch(self):
+        workerprocess.startup()
+        source_paths = [resources.path("testdata/metadata/" + filename)
+                        for filename in ('mp3-0.mp3', 'mp3-1.mp3')]
+        msg = workerprocess.MutagenBatchTask(source_paths, self.tempdir)
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        if self.error is not None:
+            raise self.error
+        self.assertEquals([path for (path, result) in self.result],
+                          source_paths)
+        titles = [result['title'] for (path, result) in self.result]
+        self.assertEquals(titles, ['Invisible Walls', 'Race Lieu'])
+
 
-# TODO:
-#   Test task priority system in worker process
-#   Test that the CancelFileOperations message is handled properly
+class WorkerPoolTest(WorkerProcessTest):
+    def setUp(self):
+        WorkerProcessTest.setUp(self)
+        self.results = []
+
+    def callback(self, msg, result):
+        self.results.append(msg)
+        if len(self.results) == self.task_count:
+            self.stopEventLoop(abnormal=False)
+
+    def test_multiple_workers(self):
+        workerprocess.startup(worker_count=3)
+        pool = workerprocess._subprocess_manager
+        self.assertEquals(len(pool.workers), 3)
+        self.assertEquals(len(set(w.process.pid for w in pool.workers)), 3)
+        self.task_count = 10
+        for i in xrange(self.task_count):
+            workerprocess.send(SlowRunningTask(), self.callback,
+                               self.errback)
+        self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(self.results), self.task_count)
+        for worker in pool.workers:
+            self.assertEquals(pool.assigned_tasks[worker], {})
+
+    def test_cancel(self):
+        # queue up tasks before we start, then cancel some of them
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        other_path = resources.path("testdata/metadata/mp3-1.mp3")
+        self.task_count = 2
+        for path in (source_path, other_path, source_path):
+            msg = workerprocess.MutagenTask(path, self.tempdir)
+            workerprocess.send(msg, self.callback, self.errback)
+        workerprocess.cancel_tasks_for_files([source_path])
+        workerprocess.startup(worker_count=2)
+        # we only expect 1 result, so wait for the timeout to make sure that
+        # the canceled tasks don't run.
+        self.runEventLoop(4.0, timeoutNormal=True)
+        self.assertEquals([msg.source_path for msg in self.results],
+                          [other_path])
+        self.assertEquals(workerprocess._miro_task_queue.tasks_in_progress,
+                          {})
+
+    def test_movie_data_pool(self):
+        # movie data tasks should run in their own pool of workers
+        workerprocess.startup(worker_count=1, movie_data_worker_count=2)
+        pool = workerprocess._movie_data_manager
+        self.assertEquals(len(pool.workers), 2)
+        started = []
+        def started_callback(msg):
+            started.append(msg)
+        paths = [resources.path("testdata/metadata/mp3-%d.mp3" % i)
+                 for i in xrange(2)]
+        self.task_count = len(paths)
+        for path in paths:
+            msg = workerprocess.MovieDataProgramTask(path, self.tempdir)
+            workerprocess.send(msg, self.callback, self.errback,
+                               started_callback)
+        self.runEventLoop(10.0)
+        self.assertEquals(self.error, None)
+        self.assertSameSet([msg.source_path for msg in started], paths)
+        self.assertSameSet([msg.source_path for msg in self.results], paths)
+        for worker in workerprocess._subprocess_manager.workers:
+            self.assertEquals(
+                workerprocess._subprocess_manager.assigned_tasks[worker], {})
+
+class WorkerTaskQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = workerprocess.WorkerTaskQueue()
+
+    def test_priority(self):
+        mutagen_task = workerprocess.MutagenTask('/foo.mp3', self.tempdir)
+        feedparser_task = workerprocess.FeedparserTask('<html></html>')
+        slow_task = SlowRunningTask()
+        self.queue.add_task(None, slow_task)
+        self.queue.add_task(None, mutagen_task)
+        self.queue.add_task(None, feedparser_task)
+        self.assertEquals(self.queue.get_next_task(block=False),
+                          (None, feedparser_task))
+        self.assertEquals(self.queue.get_next_task(block=False),
+                          (None, mutagen_task))
+        self.assertEquals(self.queue.get_next_task(block=False),
+                          (None, slow_task))
+        self.assertEquals(self.queue.get_next_task(block=False), None)
+
+    def test_late_task_class(self):
+        # test adding a task class that was defined after we created the
+        # queue.
+        class LateTask(workerprocess.TaskMessage):
+            priority = 5
+        task = LateTask()
+        self.queue.add_task(None, task)
+        self.assertEquals(self.queue.get_next_task(block=False),
+                          (None, task))
+
+    def test_cancel_file_operations(self):
+        tasks = [workerprocess.MutagenTask('/%d.mp3' % i, self.tempdir)
+                 for i in xrange(3)]
+        for task in tasks:
+            self.queue.add_task(None, task)
+        canceled = self.queue.cancel_file_operations(set(['/1.mp3']))
+        self.assertEquals(canceled, [tasks[1]])
+        self.assertEquals(self.queue.get_next_task(block=False),
+                          (None, tasks[0]))
+        self.assertEquals(self.queue.get_next_task(block=False),
+                          (None, tasks[2]))
+
+    def test_cancel_boosted_movie_data(self):
+        # test canceling a movie data task that had its priority raised
+        task = workerprocess.MovieDataProgramTask('/foo.avi', self.tempdir)
+        task.priority = task.high_priority
+        self.queue.add_task(None, task)
+        canceled = self.queue.cancel_file_operations(set(['/foo.avi']))
+        self.assertEquals(canceled, [task])
+        self.assertEquals(self.queue.get_next_task(block=False), None)
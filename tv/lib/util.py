@@ -450,6 +450,8 @@ def clamp_text(text, max_length=20):
         return text
 
 def db_mem_usage_test():
+    from miro import app
+    from miro import eventloop
     from miro import models
     from miro.database import DDBObject
     last_usage = get_mem_usage()
@@ -479,6 +481,9 @@ def db_mem_usage_test():
     logging.debug("total memory usage: %s", last_usage)
     logging.debug("feed count: %s", models.Feed.make_view().count())
     logging.debug("item count: %s", models.Item.make_view().count())
+    logging.debug(app.db.object_map_stats())
+    logging.debug(eventloop.scheduler_stats())
+    logging.debug(eventloop.thread_pool_stats())
 
 def get_mem_usage():
     return int(call_command('ps', '-o', 'rss', 'hp', str(os.getpid())))
@@ -1168,6 +1173,7 @@ class Cache(object):
             new_access_times[key] = time
         self.dict = new_dict
         self.access_times = new_access_times
+        self.invalidators = new_invalidators
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
@@ -1207,6 +1213,10 @@ def make_file_url(path):
     # there are no unicode to infect us for a unicode type upgrade.
     return 'file:///' + path_part
 
+# The cursor.execute() method can only handle 999 values at once.  Use 990
+# just to be on the safe side.
+SQLITE_CHUNK_SIZE = 990
+
 def split_values_for_sqlite(value_list):
     """Split a list of values into chunks that SQL can handle.
 
@@ -1214,9 +1224,8 @@ def split_values_for_sqlite(value_list):
     method splits long lists into chunks where each chunk has is safe to feed
     to sqlite.
     """
-    CHUNK_SIZE = 990 # use 990 just to be on the safe side.
-    for start in xrange(0, len(value_list), CHUNK_SIZE):
-        yield value_list[start:start+CHUNK_SIZE]
+    for start in xrange(0, len(value_list), SQLITE_CHUNK_SIZE):
+        yield value_list[start:start+SQLITE_CHUNK_SIZE]
 
 
 class SupportDirBackup(object):
@@ -1372,9 +1381,12 @@ def alarm(timeout, set_signal=True):
     if set_signal:
         signal.signal(signal.SIGALRM, alarm_handler)
         signal.alarm(timeout)
-    yield set_signal
-    if set_signal:
-        signal.alarm(0)
+    try:
+        yield set_signal
+    finally:
+        # make sure an exception doesn't leave the alarm set
+        if set_signal:
+            signal.alarm(0)
 
 def supports_alarm():
     return hasattr(signal, 'SIGALRM')
@@ -30,8 +30,17 @@
 """```workerprocess.py``` -- Miro worker subprocess
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to this process.  See #17328 for more details.  Right now this
+includes feedparser, mutagen and the movie data program.
+
+Mutagen and feedparser are pure python, so a single worker process can only
+use one core for them.  To use more than that, WorkerSubprocessManager runs a
+pool of worker processes and hands out tasks to them in priority order.
+
+The movie data program gets a separate pool.  Each movie data run can take a
+long time, so we don't want it to hold up mutagen and feedparser tasks, and
+it's limited by different things (mostly video decoding), so the number of
+processes to run is configured separately.
 """
 
 from collections import deque, namedtuple
@@ -78,6 +87,8 @@ class FeedparserTask(TaskMessage):
 
 class MovieDataProgramTask(TaskMessage):
     priority = 10
+    # priority for files that the user is looking at
+    high_priority = 15
     def __init__(self, source_path, screenshot_directory):
         TaskMessage.__init__(self)
         self.source_path = source_path
@@ -96,6 +107,22 @@ class MutagenTask(TaskMessage):
     def __str__(self):
         return 'MutagenTask (path: %s)' % self.source_path
 
+class MutagenBatchTask(TaskMessage):
+    """Run mutagen on a list of files.
+
+    The result is a list of (source_path, result) tuples, where result is
+    either the metadata dict for the file or the exception we got while
+    processing it.
+    """
+    priority = 10
+    def __init__(self, source_paths, cover_art_directory):
+        TaskMessage.__init__(self)
+        self.source_paths = source_paths
+        self.cover_art_directory = cover_art_directory
+
+    def __str__(self):
+        return 'MutagenBatchTask (%d paths)' % len(self.source_paths)
+
 class CancelFileOperations(TaskMessage):
     """Cancel mutagen/movie data tasks for a set of path."""
     priority = 0
@@ -141,7 +168,7 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # one.  Put it in main_thread_tasks and handle once
                 # there's no more tasks waiting in to be processed
                 self.main_thread_tasks.append((method, msg))
-            elif isinstance(msg, MutagenTask):
+            elif isinstance(msg, (MutagenTask, MutagenBatchTask)):
                 # If we're using the alarm, then MutagenTasks need to run in
                 # the main thread as well.  Signals aren't support outside of
                 # the main thread.
@@ -164,6 +191,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # if we're here, it means we want to use the signals
                 handle_task(self.handle_mutagen_task_with_alarm, msg)
                 continue
+            elif isinstance(msg, MutagenBatchTask):
+                handle_task(self.handle_mutagen_batch_task_with_alarm, msg)
+                continue
             handle_task(method, msg)
 
         # block waiting for the next message.  We know that one of the
@@ -192,8 +222,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque((method, task) for (method, task)
+                               in self.main_thread_tasks
+                               if _remove_canceled_paths(task, path_set))
         self.main_thread_tasks = filtered_tasks
         return None
 
@@ -222,6 +253,40 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         with util.alarm(2):
             return self.handle_mutagen_task(msg)
 
+    def handle_mutagen_batch_task(self, msg):
+        return self._process_mutagen_batch(msg, use_alarm=False)
+
+    def handle_mutagen_batch_task_with_alarm(self, msg):
+        return self._process_mutagen_batch(msg, use_alarm=True)
+
+    def _process_mutagen_batch(self, msg, use_alarm):
+        results = []
+        for path in msg.source_paths:
+            # errors for one file shouldn't affect the rest of the batch, so
+            # we catch them here instead of letting handle_task() do it.
+            try:
+                with util.alarm(2, set_signal=use_alarm):
+                    result = filetags.process_file(path,
+                                                   msg.cover_art_directory)
+            except StandardError, e:
+                logging.info("mutagen error: %s (%s)", path, e)
+                result = e
+            results.append((path, result))
+        return results
+
+def _remove_canceled_paths(msg, path_set):
+    """Remove canceled paths from a mutagen/movie data task.
+
+    For MutagenBatchTasks, we remove the canceled paths from source_paths.
+
+    :returns: True if the task still has work to do
+    """
+    if isinstance(msg, MutagenBatchTask):
+        msg.source_paths = [p for p in msg.source_paths if p not in path_set]
+        return len(msg.source_paths) > 0
+    else:
+        return msg.source_path not in path_set
+
 class _SinglePriorityQueue(object):
     """Manages tasks at a single priority for WorkerTaskQueue
 
@@ -238,12 +303,23 @@ class _SinglePriorityQueue(object):
         for cls in util.all_subclasses(TaskMessage):
             if cls.priority == priority:
                 self.fifo_map[cls] = deque()
+        self._reset_fifo_cycler()
+
+    def _reset_fifo_cycler(self):
         # fifo_cycler is used to cycle through each fifo
         self.fifo_cycler = itertools.cycle(self.fifo_map.values())
         self.fifo_count = len(self.fifo_map)
 
     def add_task(self, handler_method, msg):
-        self.fifo_map[msg.__class__].append((handler_method, msg))
+        try:
+            fifo = self.fifo_map[msg.__class__]
+        except KeyError:
+            # The message class was defined after we were created.  This
+            # happens in the main process, where our WorkerTaskQueue gets
+            # created at import time.
+            fifo = self.fifo_map[msg.__class__] = deque()
+            self._reset_fifo_cycler()
+        fifo.append((handler_method, msg))
 
     def get_next_task(self):
         for i, fifo in enumerate(self.fifo_cycler):
@@ -258,12 +334,19 @@ class _SinglePriorityQueue(object):
 
         :param filterfunc: function to determine if messages should stay
         :param message_class: type of messages to filter
+        :returns: list of messages that were removed
         """
         fifo = self.fifo_map[message_class]
-        new_items = tuple((method, msg) for (method, msg) in fifo
-                         if filterfunc(msg))
+        new_items = []
+        removed = []
+        for (method, msg) in fifo:
+            if filterfunc(msg):
+                new_items.append((method, msg))
+            else:
+                removed.append(msg)
         fifo.clear()
         fifo.extend(new_items)
+        return removed
 
 class WorkerTaskQueue(object):
     """Store the pending tasks for the worker process.
@@ -273,6 +356,9 @@ class WorkerTaskQueue(object):
 
     It's shared between the main subprocess thread, and all worker threads, so
     all methods need to be thread-safe.
+
+    WorkerSubprocessManager also uses one in the main process to decide which
+    task to hand out to the worker processes next.
     """
     def __init__(self):
         self.should_quit = False
@@ -288,20 +374,30 @@ class WorkerTaskQueue(object):
         all_prorities = set(cls.priority for
                             cls in util.all_subclasses(TaskMessage))
         for priority in sorted(all_prorities, reverse=True):
-            queue = _SinglePriorityQueue(priority)
-            self.queues_by_priority.append(queue)
-            self.queue_map[queue.priority] = queue
+            self._add_queue(priority)
+
+    def _add_queue(self, priority):
+        queue = _SinglePriorityQueue(priority)
+        self.queues_by_priority.append(queue)
+        self.queues_by_priority.sort(key=lambda q: q.priority, reverse=True)
+        self.queue_map[queue.priority] = queue
+        return queue
 
     def add_task(self, handler_method, msg):
         """Add a new task to the queue.  """
         with self.condition:
-            self.queue_map[msg.priority].add_task(handler_method, msg)
+            try:
+                queue = self.queue_map[msg.priority]
+            except KeyError:
+                queue = self._add_queue(msg.priority)
+            queue.add_task(handler_method, msg)
             self.condition.notify()
 
-    def get_next_task(self):
+    def get_next_task(self, block=True):
         """Get the next task to be processed from the queue.
 
-        This method will block if there are no tasks ready in the queue.
+        This method will block if there are no tasks ready in the queue,
+        unless block is False.  In that case we return None right away.
 
         It will return the tuple (handler_method, message) once there is
         something ready.  The worker thread should call
@@ -314,7 +410,7 @@ class WorkerTaskQueue(object):
             if self.should_quit:
                 return None
             next_task_info = self._get_next_task()
-            if next_task_info is not None:
+            if next_task_info is not None or not block:
                 return next_task_info
             # no tasks yet, need to wait for more
             self.condition.wait()
@@ -331,15 +427,25 @@ class WorkerTaskQueue(object):
         return None
 
     def cancel_file_operations(self, path_set):
-        """Cancels all mutagen/movie data tasks for a list of paths."""
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        :returns: list of the task messages that were removed
+        """
         # Acquire our lock as soon as possible.  We want to prevent other
         # tasks from getting tasks, since they may be about to deleted.
         with self.condition:
             def filter_func(msg):
-                return msg.source_path not in path_set
-            for cls in (MutagenTask, MovieDataProgramTask):
-                queue = self.queue_map[cls.priority]
-                queue.filter_messages(filter_func, cls)
+                return _remove_canceled_paths(msg, path_set)
+            removed = []
+            # tasks can have their priority changed (see
+            # MovieDataProgramTask.high_priority), so check every queue.
+            for queue in self.queues_by_priority:
+                for cls in (MutagenTask, MovieDataProgramTask,
+                            MutagenBatchTask):
+                    if cls in queue.fifo_map:
+                        removed.extend(queue.filter_messages(filter_func,
+                                                             cls))
+            return removed
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -385,26 +491,27 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, worker):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.worker = worker
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.worker.send_message(self.worker.pool.startup_message)
+        self.worker.pool.worker_started(self.worker)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
         self.process_handler_queue()
         self.worker_ready = False
+        self.worker.pool.worker_stopped(self.worker)
 
     def on_restart(self):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        self.worker.pool.process_result(self.worker, msg)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -426,36 +533,58 @@ class MiroTaskQueue(object):
     def __init__(self):
         # maps task_ids to (msg, callback, errback) tuples
         self.tasks_in_progress = {}
+        # maps task_ids to started callbacks
+        self.started_callbacks = {}
 
     def reset(self):
         self.tasks_in_progress = {}
+        self.started_callbacks = {}
 
-    def add_task(self, msg, callback, errback):
+    def add_task(self, msg, callback, errback, started_callback=None):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        if started_callback is not None:
+            self.started_callbacks[msg.task_id] = started_callback
+        # WorkerSubprocessManager holds on to the task until a worker is
+        # ready for it
+        msg.send_to_process()
+
+    def remove_tasks(self, msgs):
+        """Forget about a list of tasks without calling their callbacks."""
+        for msg in msgs:
+            self.tasks_in_progress.pop(msg.task_id, None)
+            self.started_callbacks.pop(msg.task_id, None)
+
+    def task_started(self, msg):
+        """Call the started callback for a task that we sent to a worker."""
+        started_callback = self.started_callbacks.get(msg.task_id)
+        if started_callback is not None:
+            started_callback(msg)
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        self.started_callbacks.pop(reply.task_id, None)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # task was canceled, or was already handled by another worker
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
-
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
-class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+# Manage subprocesses
+class WorkerProcess(subprocessmanager.SubprocessManager):
+    """Manages a single worker process for WorkerSubprocessManager."""
+
+    def __init__(self, pool):
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(self), pool.handler_class,
+                restart_delay=pool.restart_delay)
+        self.pool = pool
         self.check_hung_timeout = None
 
     def _start(self):
@@ -469,8 +598,20 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
     def restart(self, clean=False):
         self.cancel_check_subprocess_hung()
         self.responder.movie_data_task_status = None
+        if not clean:
+            # for clean restarts, our responder's on_shutdown() does this
+            self.pool.worker_stopped(self)
         subprocessmanager.SubprocessManager.restart(self, clean)
 
+    def _on_thread_quit(self, thread):
+        if thread is self.thread and self.is_running:
+            # Our process quit.  Let the other workers handle our tasks while
+            # we wait to be restarted.
+            self.cancel_check_subprocess_hung()
+            self.responder.movie_data_task_status = None
+            self.pool.worker_stopped(self)
+        subprocessmanager.SubprocessManager._on_thread_quit(self, thread)
+
     def schedule_check_subprocess_hung(self):
         self.check_hung_timeout = eventloop.add_timeout(90,
                 self.check_subprocess_hung, 'check workerprocess hung')
@@ -493,34 +634,201 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         else:
             self.schedule_check_subprocess_hung()
 
+class WorkerSubprocessManager(object):
+    """Manages a pool of worker processes.
+
+    Tasks are queued up in the main process and handed out to the workers in
+    priority order, using a WorkerTaskQueue.  We only send a few tasks to each
+    worker at once, so that high priority tasks don't get stuck behind a
+    bunch of low priority ones that were already sent to a busy worker.
+
+    Each worker is restarted on its own if it crashes or hangs.  The tasks it
+    was working on get handed out to the other workers in the meantime.
+
+    :attribute workers: list of WorkerProcess objects
+    :attribute tasks_per_worker: max tasks to send to a worker at once
+    """
+    def __init__(self, message_class=WorkerMessage):
+        """Create a WorkerSubprocessManager
+
+        :param message_class: we install ourselves as the handler for this
+                              message class.
+        """
+        message_class.install_handler(self)
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.startup_message = None
+        self.tasks_per_worker = 1
+        self.is_running = False
+        self.workers = []
+        self.task_queue = WorkerTaskQueue()
+        # maps running workers to dicts that map task_ids to the tasks we've
+        # sent them
+        self.assigned_tasks = {}
+
+    def start(self, worker_count):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.workers = [WorkerProcess(self) for i in xrange(worker_count)]
+        for worker in self.workers:
+            worker.start()
+
+    def shutdown(self):
+        if not self.is_running:
+            return
+        # unset is_running first, so that we don't hand out tasks to workers
+        # that are about to quit.
+        self.is_running = False
+        for worker in self.workers:
+            worker.shutdown()
+
+    def restart(self, clean=False):
+        for worker in self.workers:
+            worker.restart(clean)
+
+    def worker_started(self, worker):
+        self.assigned_tasks[worker] = {}
+        self._dispatch_tasks()
+
+    def worker_stopped(self, worker):
+        """Requeue the tasks for a worker that quit or is about to."""
+        tasks = self.assigned_tasks.pop(worker, None)
+        if tasks:
+            for msg in tasks.values():
+                self.task_queue.add_task(None, msg)
+            self._dispatch_tasks()
+
+    def process_result(self, worker, reply):
+        tasks = self.assigned_tasks.get(worker)
+        if tasks is not None:
+            tasks.pop(reply.task_id, None)
+        _miro_task_queue.process_result(reply)
+        self._dispatch_tasks()
+
+    def cancel_file_operations(self, msg):
+        path_set = set(msg.paths)
+        canceled = self.task_queue.cancel_file_operations(path_set)
+        for tasks in self.assigned_tasks.values():
+            for task_id, task in tasks.items():
+                if (isinstance(task, (MutagenTask, MovieDataProgramTask)) and
+                        task.source_path in path_set):
+                    del tasks[task_id]
+                    canceled.append(task)
+        # we'll get a TaskResult from each worker for msg, so don't bother
+        # keeping track of it.
+        canceled.append(msg)
+        _miro_task_queue.remove_tasks(canceled)
+        # tasks that we've already sent still need to be canceled inside the
+        # workers
+        for worker in self.assigned_tasks:
+            worker.send_message(msg)
+        self._dispatch_tasks()
+
+    def _dispatch_tasks(self):
+        """Send queued tasks to workers with free slots."""
+        if not self.is_running:
+            return
+        while True:
+            worker, tasks = self._least_busy_worker()
+            if worker is None:
+                return
+            next_task = self.task_queue.get_next_task(block=False)
+            if next_task is None:
+                return
+            msg = next_task[1]
+            tasks[msg.task_id] = msg
+            worker.send_message(msg)
+            _miro_task_queue.task_started(msg)
+
+    def _least_busy_worker(self):
+        best = (None, None)
+        for worker, tasks in self.assigned_tasks.iteritems():
+            if (len(tasks) < self.tasks_per_worker and
+                    (best[1] is None or len(tasks) < len(best[1]))):
+                best = (worker, tasks)
+        return best
+
+    # implement the MessageHandler interface
+
+    def handle(self, msg):
+        if isinstance(msg, CancelFileOperations):
+            self.cancel_file_operations(msg)
+        else:
+            self.task_queue.add_task(None, msg)
+            self._dispatch_tasks()
+
 _subprocess_manager = WorkerSubprocessManager()
+# MovieDataProgramTask messages go to a separate pool
+_movie_data_manager = WorkerSubprocessManager(MovieDataProgramTask)
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+def default_worker_count():
+    """Get the number of worker processes to run by default.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    We run one process for each core.
+    """
+    return max(1, utils.get_logical_cpu_count())
+
+def default_movie_data_worker_count():
+    """Get the number of movie data processes to run by default.
+
+    The movie data program decodes video, which often uses more than one
+    core, so we run one process for every 2 cores.
+    """
+    return max(1, utils.get_logical_cpu_count() // 2)
+
+def startup(thread_count=3, worker_count=None, movie_data_worker_count=None):
+    """Startup the worker processes.
+
+    :param thread_count: number of task threads in each worker process
+    :param worker_count: number of worker processes to run.  If None, we use
+                         default_worker_count()
+    :param movie_data_worker_count: number of worker processes to run movie
+                                    data tasks in.  If None, we use
+                                    default_movie_data_worker_count()
+    """
+    if worker_count is None:
+        worker_count = default_worker_count()
+    if movie_data_worker_count is None:
+        movie_data_worker_count = default_movie_data_worker_count()
+    _subprocess_manager.startup_message = WorkerStartupInfo(thread_count)
+    # Send enough tasks to keep all the threads in a worker busy, plus one for
+    # the tasks that run in its main thread.
+    _subprocess_manager.tasks_per_worker = thread_count + 1
+    _subprocess_manager.start(worker_count)
+    # Movie data tasks run in the main thread of the worker, so there's no
+    # need for extra threads.  Only send them one task at a time, so that
+    # tasks for files the user is looking at can jump ahead in the queue.
+    _movie_data_manager.startup_message = WorkerStartupInfo(0)
+    _movie_data_manager.tasks_per_worker = 1
+    _movie_data_manager.start(movie_data_worker_count)
 
 def shutdown():
-    """Shutdown the worker process."""
+    """Shutdown the worker processes."""
     _subprocess_manager.shutdown()
+    _movie_data_manager.shutdown()
 
 # API for sending tasks
-def send(msg, callback, errback):
+def send(msg, callback, errback, started_callback=None):
     """Send a message to the worker process.
 
     :param msg: Message to send
     :param callback: function to call on success
     :param errback: function to call on error
+    :param started_callback: function to call when we hand the task to a
+                             worker process
     """
-    _miro_task_queue.add_task(msg, callback, errback)
+    _miro_task_queue.add_task(msg, callback, errback, started_callback)
 
 def cancel_tasks_for_files(paths):
-    """Cancel mutagen and movie data tasks for a list of paths."""
+    """Cancel mutagen and movie data tasks for a list of paths.
+
+    The cancel message goes to every worker process in both pools.
+    """
     msg = CancelFileOperations(paths)
     # we don't care about the return value, but we still want to use the task
     # queue to queue up this message.
     def null_callback(msg, result):
         pass
     send(msg, null_callback, null_callback)
+    _movie_data_manager.cancel_file_operations(CancelFileOperations(paths))
@@ -255,7 +255,7 @@ class ItemListModel(signals.SignalEmitter):
         for id in ids_changed:
             self.emit("row-changed", self.item_list.get_index(id))
 
-    def on_list_changed(self, item_list):
+    def on_list_changed(self, item_list, changes):
         self.emit("structure-will-change")
 
     def _iter_for_row(self, row):